@@ -1,16 +1,36 @@
 import argparse
+import ast
+import atexit
 import collections
+import concurrent.futures
+import configparser
+import contextlib
+import difflib
+import errno
+import gzip
+import hashlib
+import io
 import json
 import logging
+import lzma
+import mmap
 import os
 import platform
+import pprint
 import re
 import shutil
+import socket
+import struct
 import subprocess
+import sys
 import tarfile
+import tempfile
+import threading
+import time
 import urllib.parse
 import zipfile
-from typing import Dict, List, Optional
+import zlib
+from typing import Dict, List, Optional, Tuple
 
 logging.basicConfig(level=logging.INFO)
 
@@ -45,6 +65,9 @@ def cmd(args, **kwargs):
         resolve = True
     if resolve:
         args = [shutil.which(args[0]), *args[1:]]
+    if TELEMETRY is not None:
+        with TELEMETRY.step(TELEMETRY.step_name(args)):
+            return subprocess.run(args, **kwargs)
     return subprocess.run(args, **kwargs)
 
 
@@ -66,10 +89,407 @@ def rm_rf(path: str):
         os.remove(path)
         logging.debug(f'rm -rf {path} => file removed')
     if os.path.isdir(path):
+        if BACKGROUND_REMOVER is not None and BACKGROUND_REMOVER.remove(path):
+            logging.debug(f'rm -rf {path} => directory moved to trash')
+            return
         shutil.rmtree(path)
         logging.debug(f'rm -rf {path} => directory removed')
 
 
+TRASH_ROOTS_FILE = '.roots'
+
+
+def read_trash_roots() -> List[str]:
+    path = os.path.join(BASE_DIR, '_trash', TRASH_ROOTS_FILE)
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+# ゴミ箱のディレクトリ。削除するディレクトリと同じファイルシステムにないと一瞬で移動できないので、
+# BASE_DIR と別のファイルシステムの場合は親ディレクトリに作り、その場所を TRASH_ROOTS_FILE に記録しておく。
+def get_trash_dir(path: str) -> str:
+    trash = os.path.join(BASE_DIR, '_trash')
+    parent = os.path.dirname(os.path.abspath(path))
+    if os.stat(parent).st_dev == os.stat(BASE_DIR).st_dev:
+        return trash
+    foreign = os.path.join(parent, '.trash')
+    if foreign not in read_trash_roots():
+        mkdir_p(trash)
+        with open(os.path.join(trash, TRASH_ROOTS_FILE), 'a') as f:
+            f.write(foreign + '\n')
+    return foreign
+
+
+# rm_rf でディレクトリを削除する時に、まずゴミ箱に移動してから、複数のスレッドで中身を並列に削除する。
+# detach=True の場合、終了時に削除が終わっていなければ待たずに `run.py gc` を別プロセスで起動して任せる。
+# ゴミ箱の中のディレクトリを再帰的に分割して、ディレクトリごとに並列に削除する深さ。
+# これより深いディレクトリは 1 つのスレッドでまとめて削除する。
+BACKGROUND_REMOVER_SPLIT_DEPTH = 6
+
+
+class BackgroundRemover(object):
+    def __init__(self, workers: int = 4, detach=False):
+        self.detach = detach
+        self.cond = threading.Condition()
+        self.tasks = []
+        # ゴミ箱に移動したディレクトリのうち、削除が終わっていないもの
+        self.pending = set()
+        # 削除中のディレクトリごとの (親ディレクトリ, 深さ, 削除が終わっていないサブディレクトリの数)
+        self.nodes = {}
+        self.counter = 0
+        for _ in range(workers):
+            threading.Thread(target=self._worker, daemon=True).start()
+
+    def remove(self, path: str) -> bool:
+        trash = get_trash_dir(path)
+        mkdir_p(trash)
+        with self.cond:
+            self.counter += 1
+            dst = os.path.join(trash, f'{os.path.basename(path)}.{os.getpid()}.{self.counter}')
+        try:
+            os.rename(path, dst)
+        except OSError as e:
+            logging.debug(f'Failed to move {path} to trash: {e}')
+            return False
+        self.enqueue(dst)
+        return True
+
+    def enqueue(self, root: str):
+        with self.cond:
+            self.pending.add(root)
+            self.nodes[root] = [None, 0, None]
+            self.tasks.append(root)
+            self.cond.notify_all()
+
+    # 削除できなかったファイルはゴミ箱に残るので、黙って無視せずにログに出す
+    @staticmethod
+    def _log_error(func, path, exc_info):
+        # 中身を削除できなかった親ディレクトリの ENOTEMPTY は、中身の失敗として既にログに出ている
+        if not isinstance(exc_info[1], FileNotFoundError) and getattr(exc_info[1], 'errno', None) != errno.ENOTEMPTY:
+            logging.warning(f'Background deletion: failed to remove {path}: {exc_info[1]}')
+
+    # ディレクトリの中のファイルを削除して、サブディレクトリを新しいタスクにする。
+    # 例外が起きてもノードを必ず終わらせる。そうしないと pending が空にならず wait() が終わらない
+    def _process(self, dir: str):
+        depth = self.nodes[dir][1]
+        subdirs = []
+        try:
+            if depth >= BACKGROUND_REMOVER_SPLIT_DEPTH:
+                shutil.rmtree(dir, onerror=self._log_error)
+            else:
+                try:
+                    # 同時に実行している `run.py gc` に先に削除されている場合がある
+                    entries = list(os.scandir(dir))
+                except (FileNotFoundError, NotADirectoryError):
+                    entries = []
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.path)
+                        else:
+                            os.remove(entry.path)
+                    except FileNotFoundError:
+                        pass
+                    except OSError as e:
+                        logging.warning(f'Background deletion: failed to remove {entry.path}: {e}')
+        except Exception as e:
+            logging.warning(f'Background deletion: failed to process {dir}: {e}')
+            # 残った中身は _finish でまとめて削除を試みる
+            subdirs = []
+        finally:
+            with self.cond:
+                self.nodes[dir][2] = len(subdirs)
+                for subdir in subdirs:
+                    self.nodes[subdir] = [dir, depth + 1, None]
+                    self.tasks.append(subdir)
+                if len(subdirs) == 0:
+                    self._finish(dir)
+                self.cond.notify_all()
+
+    # 中身が空になったディレクトリを削除し、親ディレクトリも空になっていれば続けて削除する。cond を取得した状態で呼ぶ
+    def _finish(self, dir: str):
+        while dir is not None:
+            shutil.rmtree(dir, onerror=self._log_error)
+            parent = self.nodes.pop(dir)[0]
+            if parent is None:
+                self.pending.discard(dir)
+                break
+            self.nodes[parent][2] -= 1
+            if self.nodes[parent][2] != 0:
+                break
+            dir = parent
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                while len(self.tasks) == 0:
+                    self.cond.wait()
+                dir = self.tasks.pop()
+            self._process(dir)
+
+    def wait(self):
+        with self.cond:
+            if len(self.pending) != 0:
+                logging.info(f'Waiting for background deletion of {len(self.pending)} directories')
+            while len(self.pending) != 0:
+                self.cond.wait()
+
+    def close(self):
+        with self.cond:
+            done = len(self.pending) == 0
+        if done:
+            return
+        if self.detach:
+            logging.info('Handing off background deletion to `run.py gc`')
+            subprocess.Popen([sys.executable, os.path.join(BASE_DIR, 'run.py'), 'gc'],
+                             stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                             start_new_session=True)
+            return
+        self.wait()
+
+
+BACKGROUND_REMOVER: Optional[BackgroundRemover] = None
+
+
+# ゴミ箱に残っているディレクトリを全て削除する
+def gc_trash(workers: int = 8):
+    remover = BackgroundRemover(workers)
+    trash = os.path.join(BASE_DIR, '_trash')
+    roots = read_trash_roots()
+    for dir in [trash, *roots]:
+        if not os.path.isdir(dir):
+            continue
+        for entry in os.scandir(dir):
+            if entry.name == TRASH_ROOTS_FILE:
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                logging.info(f'Removing {entry.path}')
+                remover.enqueue(entry.path)
+            else:
+                os.remove(entry.path)
+    remover.wait()
+    for root in roots:
+        if os.path.isdir(root) and len(os.listdir(root)) == 0:
+            os.rmdir(root)
+    # 削除中に他のプロセスが追加したものや、削除しきれなかったものが残っていれば記録を残しておく
+    remaining = [root for root in read_trash_roots() if os.path.isdir(root)]
+    if len(remaining) != 0:
+        with open(os.path.join(trash, TRASH_ROOTS_FILE), 'w') as f:
+            f.writelines(f'{root}\n' for root in remaining)
+    else:
+        rm_rf(os.path.join(trash, TRASH_ROOTS_FILE))
+
+
+# ビルド中のシステムのリソース使用量を定期的に記録する。
+# cmd() で実行しているコマンドをステップとして、/proc から読み取った値を時系列で書き出す。
+# /proc を使うので Linux でのみ動作する。
+class ResourceSampler(object):
+    def __init__(self, output_dir: str, build_dir: str, target: str, interval: float = 1.0):
+        self._output_dir = output_dir
+        self._build_dir = build_dir
+        self._target = target
+        self._interval = interval
+        self._step = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._file = None
+        self._summary = {}
+        self._prev_cpu = None
+        self._prev_disk = None
+        self._prev_time = None
+        self.path = None
+        self.summary_path = None
+
+    @staticmethod
+    def available() -> bool:
+        return os.path.exists('/proc/stat') and os.path.exists('/proc/meminfo')
+
+    def start(self):
+        mkdir_p(self._output_dir)
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        self.path = os.path.join(self._output_dir, f'telemetry-{stamp}.jsonl')
+        self.summary_path = os.path.join(self._output_dir, f'telemetry-{stamp}.summary.json')
+        self._file = open(self.path, 'w')
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        logging.info(f'Telemetry: sampling every {self._interval}s into {self.path}')
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self._file.close()
+        summary = {
+            'target': self._target,
+            'interval': self._interval,
+            'samples': self.path,
+            'steps': self._summary,
+        }
+        with open(self.summary_path, 'w') as f:
+            f.write(json.dumps(summary, indent=4))
+        for name, s in self._summary.items():
+            logging.info(f'Telemetry: {name}: peak_tree_rss={s["peak_tree_rss"] >> 20}MiB '
+                         f'peak_mem_used={s["peak_mem_used"] >> 20}MiB peak_swap_used={s["peak_swap_used"] >> 20}MiB '
+                         f'duration={s["duration"]:.1f}s')
+        logging.info(f'Telemetry: summary written to {self.summary_path}')
+
+    @contextlib.contextmanager
+    def step(self, name: str):
+        prev = self._step
+        self._step = name
+        try:
+            yield
+        finally:
+            self._step = prev
+
+    def step_name(self, args) -> str:
+        args = [str(arg) for arg in args]
+        name = os.path.basename(args[0])
+        if name in ('ninja', 'ninja.exe') and '-C' in args:
+            work_dir = args[args.index('-C') + 1]
+            return f'ninja:{os.path.relpath(work_dir, self._build_dir)}'
+        for arg in args[1:]:
+            if not arg.startswith('-'):
+                return f'{name} {os.path.basename(arg)}'
+        return name
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            step = self._step
+            if step is None:
+                # ステップ間はベースラインを取り直すだけ
+                self._sample_counters()
+                continue
+            try:
+                sample = self._sample(step)
+            except Exception as e:
+                logging.debug(f'Telemetry: failed to sample: {e}')
+                continue
+            if sample is None:
+                continue
+            self._file.write(json.dumps(sample) + '\n')
+            self._file.flush()
+            self._update_summary(sample)
+
+    def _sample_counters(self):
+        now = time.monotonic()
+        cpu = self._read_cpu()
+        disk = self._read_disk()
+        prev = (self._prev_time, self._prev_cpu, self._prev_disk)
+        self._prev_time, self._prev_cpu, self._prev_disk = now, cpu, disk
+        return now, cpu, disk, prev
+
+    def _sample(self, step):
+        now, cpu, disk, (prev_time, prev_cpu, prev_disk) = self._sample_counters()
+        if prev_time is None:
+            return None
+        elapsed = now - prev_time
+        busy = cpu[0] - prev_cpu[0]
+        total = cpu[1] - prev_cpu[1]
+        mem = self._read_meminfo()
+        return {
+            'time': time.time(),
+            'step': step,
+            'cpu_percent': round(100.0 * busy / total, 1) if total > 0 else 0.0,
+            'mem_total': mem.get('MemTotal', 0),
+            'mem_used': mem.get('MemTotal', 0) - mem.get('MemAvailable', 0),
+            'swap_used': mem.get('SwapTotal', 0) - mem.get('SwapFree', 0),
+            'disk_read_bps': int((disk[0] - prev_disk[0]) / elapsed),
+            'disk_write_bps': int((disk[1] - prev_disk[1]) / elapsed),
+            'tree_rss': self._read_tree_rss(),
+        }
+
+    def _update_summary(self, sample):
+        s = self._summary.setdefault(sample['step'], {
+            'start': sample['time'],
+            'duration': 0.0,
+            'samples': 0,
+            'cpu_percent_avg': 0.0,
+            'peak_tree_rss': 0,
+            'peak_mem_used': 0,
+            'peak_swap_used': 0,
+            'peak_disk_read_bps': 0,
+            'peak_disk_write_bps': 0,
+        })
+        s['duration'] = sample['time'] - s['start']
+        s['cpu_percent_avg'] = round(
+            (s['cpu_percent_avg'] * s['samples'] + sample['cpu_percent']) / (s['samples'] + 1), 1)
+        s['samples'] += 1
+        s['peak_tree_rss'] = max(s['peak_tree_rss'], sample['tree_rss'])
+        s['peak_mem_used'] = max(s['peak_mem_used'], sample['mem_used'])
+        s['peak_swap_used'] = max(s['peak_swap_used'], sample['swap_used'])
+        s['peak_disk_read_bps'] = max(s['peak_disk_read_bps'], sample['disk_read_bps'])
+        s['peak_disk_write_bps'] = max(s['peak_disk_write_bps'], sample['disk_write_bps'])
+
+    @staticmethod
+    def _read_cpu():
+        with open('/proc/stat') as f:
+            values = [int(x) for x in f.readline().split()[1:]]
+        # idle + iowait 以外を busy とみなす
+        idle = values[3] + (values[4] if len(values) > 4 else 0)
+        total = sum(values)
+        return total - idle, total
+
+    @staticmethod
+    def _read_meminfo():
+        mem = {}
+        with open('/proc/meminfo') as f:
+            for line in f:
+                name, value = line.split(':', 1)
+                mem[name] = int(value.split()[0]) * 1024
+        return mem
+
+    @staticmethod
+    def _read_disk():
+        read = 0
+        write = 0
+        if not os.path.exists('/proc/diskstats'):
+            return 0, 0
+        with open('/proc/diskstats') as f:
+            for line in f:
+                fields = line.split()
+                # パーティションを二重に数えないように、ディスク全体のエントリだけを集計する
+                if len(fields) < 10 or not os.path.exists(f'/sys/block/{fields[2]}/device'):
+                    continue
+                read += int(fields[5]) * 512
+                write += int(fields[9]) * 512
+        return read, write
+
+    @staticmethod
+    def _read_tree_rss():
+        children = collections.defaultdict(list)
+        for pid in os.listdir('/proc'):
+            if not pid.isdigit():
+                continue
+            try:
+                with open(f'/proc/{pid}/stat') as f:
+                    stat = f.read()
+            except OSError:
+                continue
+            # comm にスペースや括弧が含まれる場合があるので、最後の ')' 以降を読む
+            ppid = int(stat[stat.rfind(')') + 2:].split()[1])
+            children[ppid].append(int(pid))
+        page_size = os.sysconf('SC_PAGE_SIZE')
+        rss = 0
+        pids = list(children[os.getpid()])
+        while pids:
+            pid = pids.pop()
+            pids += children[pid]
+            try:
+                with open(f'/proc/{pid}/statm') as f:
+                    rss += int(f.read().split()[1]) * page_size
+            except OSError:
+                pass
+        return rss
+
+
+TELEMETRY: Optional[ResourceSampler] = None
+
+
 def mkdir_p(path: str):
     if os.path.exists(path):
         logging.debug(f'mkdir -p {path} => already exists')
@@ -290,8 +710,175 @@ def apply_patch(patch, dir, depth):
                 cmd(['patch', f'-p{depth}'], stdin=stdin)
 
 
+WEBRTC_GIT_URL = 'https://webrtc.googlesource.com/src.git'
+
+# ソースの取得方法
+# - full: 全ての履歴を取得する
+# - shallow: src も依存リポジトリも指定したリビジョンだけを取得する (--no-history)
+# - blobless: src は履歴を持つが blob は必要になるまで取得しない partial clone にし、依存リポジトリは --no-history で取得する
+WEBRTC_FETCH_MODES = ['full', 'shallow', 'blobless']
+
+
+# get_webrtc で同期した状態を記録するファイル。--webrtc-fetch の時にこれと一致していれば gclient sync を省略する
+FETCH_STATE_FILE = 'fetch_state.json'
+
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# DEPS のうち git 以外 (cipd や gcs) の依存のハッシュ。これが変わった場合は gclient sync が必要になる
+def get_nongit_deps_hash(deps: str) -> str:
+    scope = eval_deps(deps)
+    nongit = {path: dep for path, dep in scope.get('deps', {}).items()
+              if isinstance(dep, dict) and dep.get('dep_type', 'git') != 'git'}
+    return hashlib.sha256(json.dumps(nongit, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+# パッチが変更するファイルと、そのファイルを含む git リポジトリ (src からの相対パス)
+def get_patched_files_and_repos(src_dir: str, patch_dir: str, patches: List[str]):
+    files = []
+    repos = set()
+    for patch in patches:
+        for file in get_patch_target_files(patch_dir, patch):
+            files.append(file)
+            repo = find_git_root(os.path.join(src_dir, file), src_dir)
+            repos.add(os.path.relpath(repo, src_dir).replace(os.sep, '/'))
+    return sorted(set(files)), sorted(repos)
+
+
+def get_patched_file_hashes(src_dir: str, files: List[str]) -> Dict[str, Optional[str]]:
+    return {file: file_sha256(os.path.join(src_dir, file)) if os.path.isfile(os.path.join(src_dir, file)) else None
+            for file in files}
+
+
+def get_patch_ledger(patch_dir: str, target: str) -> List[List[str]]:
+    return [[patch, file_sha256(os.path.join(patch_dir, patch))] for patch in PATCHES[target]]
+
+
+def load_fetch_state(webrtc_source_dir: str) -> Optional[dict]:
+    path = os.path.join(webrtc_source_dir, FETCH_STATE_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_fetch_state(webrtc_source_dir: str, patch_dir: str, target: str, version: str, fetch_mode: str):
+    src_dir = os.path.join(webrtc_source_dir, 'src')
+    with open(os.path.join(src_dir, 'DEPS')) as f:
+        deps = f.read()
+    files, repos = get_patched_files_and_repos(src_dir, patch_dir, PATCHES[target])
+    state = {
+        'version': version,
+        'fetch_mode': fetch_mode,
+        'gclient_config': file_sha256(os.path.join(webrtc_source_dir, '.gclient')),
+        'src_head': cmdcap(['git', '-C', src_dir, 'rev-parse', 'HEAD']),
+        'deps_hash': hashlib.sha256(deps.encode('utf-8')).hexdigest(),
+        'deps': parse_deps_revisions(deps),
+        'nongit_deps_hash': get_nongit_deps_hash(deps),
+        'patches': get_patch_ledger(patch_dir, target),
+        'patched_repos': repos,
+        'patched_files': get_patched_file_hashes(src_dir, files),
+    }
+    with open(os.path.join(webrtc_source_dir, FETCH_STATE_FILE), 'w') as f:
+        json.dump(state, f, indent=2)
+
+
+def git_resolve_commit(repo: str, revision: str) -> Optional[str]:
+    r = cmd(['git', '-C', repo, 'rev-parse', '--verify', '-q', f'{revision}^{{commit}}'],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='utf-8', check=False)
+    return r.stdout.strip() if r.returncode == 0 else None
+
+
+def git_fetch_revision(repo: str, revision: str, fetch_mode: str) -> Optional[str]:
+    commit = git_resolve_commit(repo, revision)
+    if commit is not None:
+        return commit
+    depth = [] if fetch_mode == 'full' else ['--depth=1']
+    cmd(['git', '-C', repo, 'fetch', *depth, 'origin', revision], check=False)
+    commit = git_resolve_commit(repo, revision)
+    if commit is None:
+        commit = git_resolve_commit(repo, 'FETCH_HEAD')
+    return commit
+
+
+# 前回の同期の記録と比べて、必要な部分だけを更新する。
+# 全て一致していれば何もせず、ずれている git の依存だけをチェックアウトし直してパッチを当て直す。
+# gclient sync が必要な変更 (.gclient、git 以外の依存、依存の追加) があった場合は False を返す。
+def fetch_webrtc_fast(webrtc_source_dir: str, patch_dir: str, version: str, target: str, fetch_mode: str,
+                      profile: Optional[dict]) -> bool:
+    state = load_fetch_state(webrtc_source_dir)
+    if state is None or version == 'HEAD' or state.get('fetch_mode') != fetch_mode:
+        return False
+    src_dir = os.path.join(webrtc_source_dir, 'src')
+
+    write_gclient_config(webrtc_source_dir, profile)
+    if file_sha256(os.path.join(webrtc_source_dir, '.gclient')) != state['gclient_config']:
+        logging.info('Fast fetch: .gclient changed')
+        return False
+    commit = git_fetch_revision(src_dir, version, fetch_mode)
+    if commit is None:
+        return False
+    deps = cmd(['git', '-C', src_dir, 'show', f'{commit}:DEPS'], stdout=subprocess.PIPE, encoding='utf-8').stdout
+    if get_nongit_deps_hash(deps) != state['nongit_deps_hash']:
+        logging.info('Fast fetch: non-git dependencies changed')
+        return False
+    revisions = parse_deps_revisions(deps)
+    drifted = [path for path, revision in revisions.items() if state['deps'].get(path) != revision]
+    for path in drifted:
+        if not os.path.exists(os.path.join(src_dir, path, '.git')):
+            logging.info(f'Fast fetch: new dependency {path}')
+            return False
+    # 記録と同じでも、手動でチェックアウトやリセットをしていれば実際の HEAD はずれている
+    for path, revision in revisions.items():
+        repo = os.path.join(src_dir, path)
+        if path in drifted or not os.path.exists(os.path.join(repo, '.git')):
+            continue
+        if git_resolve_commit(repo, 'HEAD') != git_resolve_commit(repo, revision):
+            logging.info(f'Fast fetch: {path} is not at {revision}')
+            drifted.append(path)
+
+    files, repos = get_patched_files_and_repos(src_dir, patch_dir, PATCHES[target])
+    patches_changed = get_patch_ledger(patch_dir, target) != state['patches']
+    files_changed = get_patched_file_hashes(src_dir, files) != state['patched_files']
+    src_head = git_resolve_commit(src_dir, 'HEAD')
+    if commit == src_head and len(drifted) == 0 and not patches_changed and not files_changed:
+        logging.info(f'Fast fetch: already at {commit}, skipped gclient sync')
+        return True
+
+    os.remove(os.path.join(webrtc_source_dir, FETCH_STATE_FILE))
+    # パッチを当て直すので、パッチが当たっているリポジトリも元に戻す
+    reset = sorted(set(drifted) | set(repos) | set(state['patched_repos']) | {'.'})
+    logging.info(f'Fast fetch: checking out {len(reset)} repositories ({len(drifted)} drifted)')
+    for path in reset:
+        repo = os.path.join(src_dir, path)
+        if path == '.':
+            revision = commit
+        elif path in revisions:
+            revision = git_fetch_revision(repo, revisions[path], fetch_mode)
+            if revision is None:
+                return False
+        else:
+            revision = 'HEAD'
+        cmd(['git', '-C', repo, 'checkout', '-f', revision])
+        cmd(['git', '-C', repo, 'clean', '-df'])
+    if hashlib.sha256(deps.encode('utf-8')).hexdigest() != state['deps_hash']:
+        with cd(webrtc_source_dir):
+            cmd(['gclient', 'runhooks'])
+    for patch in PATCHES[target]:
+        depth, dirs = PATCH_INFO.get(patch, (1, ['.']))
+        apply_patch(os.path.join(patch_dir, patch), os.path.join(src_dir, *dirs), depth)
+    write_fetch_state(webrtc_source_dir, patch_dir, target, version, fetch_mode)
+    return True
+
+
 def get_webrtc(source_dir, patch_dir, version, target,
-               webrtc_source_dir=None, force=False, fetch=False):
+               webrtc_source_dir=None, force=False, fetch=False, fetch_mode='full', prune_deps=False):
     if webrtc_source_dir is None:
         webrtc_source_dir = os.path.join(source_dir, 'webrtc')
     if force:
@@ -302,7 +889,15 @@ def get_webrtc(source_dir, patch_dir, version, target,
     if not os.path.exists(os.path.join(webrtc_source_dir, 'src')):
         with cd(webrtc_source_dir):
             cmd(['gclient'])
-            cmd(['fetch', 'webrtc'])
+            if fetch_mode == 'shallow':
+                # 後で gclient sync するので、ここでは hooks を実行しない
+                cmd(['fetch', '--nohooks', '--no-history', 'webrtc'])
+            elif fetch_mode == 'blobless':
+                # fetch は partial clone に対応していないので、src は自前で clone してから gclient に管理させる
+                cmd(['gclient', 'config', '--name', 'src', '--unmanaged', WEBRTC_GIT_URL])
+                cmd(['git', 'clone', '--filter=blob:none', '--no-checkout', WEBRTC_GIT_URL, 'src'])
+            else:
+                cmd(['fetch', 'webrtc'])
             if target == 'android':
                 with open('.gclient', 'a') as f:
                     f.write("target_os = [ 'android' ]\n")
@@ -313,18 +908,794 @@ def get_webrtc(source_dir, patch_dir, version, target,
 
     src_dir = os.path.join(webrtc_source_dir, 'src')
     if fetch:
+        profile = load_gclient_profile(target) if prune_deps else None
+        if fetch_webrtc_fast(webrtc_source_dir, patch_dir, version, target, fetch_mode, profile):
+            return
+        rm_rf(os.path.join(webrtc_source_dir, FETCH_STATE_FILE))
         with cd(src_dir):
-            cmd(['git', 'fetch'])
+            if fetch_mode == 'shallow':
+                cmd(['git', 'fetch', '--depth=1', 'origin', *([] if version == 'HEAD' else [version])])
+            else:
+                cmd(['git', 'fetch'])
             if version == 'HEAD':
                 cmd(['git', 'checkout', '-f', 'origin/HEAD'])
             else:
                 cmd(['git', 'checkout', '-f', version])
             cmd(['git', 'clean', '-df'])
-            cmd(['gclient', 'sync', '-D', '--force', '--reset', '--with_branch_heads'])
+            write_gclient_config(webrtc_source_dir, profile)
+            sync_args = ['-D', '--force', '--reset']
+            if fetch_mode == 'full':
+                sync_args += ['--with_branch_heads']
+            else:
+                sync_args += ['--no-history']
+            start = time.time()
+            cmd(['gclient', 'sync', *sync_args])
+            record_sync_stats(webrtc_source_dir, time.time() - start, profile,
+                              cmdcap(['git', 'rev-parse', 'HEAD']))
             for patch in PATCHES[target]:
                 depth, dirs = PATCH_INFO.get(patch, (1, ['.']))
                 dir = os.path.join(src_dir, *dirs)
                 apply_patch(os.path.join(patch_dir, patch), dir, depth)
+        write_fetch_state(webrtc_source_dir, patch_dir, target, version, fetch_mode)
+
+
+# 同期してパッチを当てた WebRTC のソースのスナップショット。
+# コミット、パッチ、取得方法ごとに保存しておき、同じ状態のソースが必要になった時にコピーオンライトで復元する。
+SNAPSHOT_INFO_FILE = 'snapshot.json'
+SNAPSHOT_USED_FILE = '.last_used'
+
+
+# 依存を絞る場合は、同期する依存の集合が変わるので gclient のプロファイルの内容もキーに含める
+def get_snapshot_key(patch_dir: str, version: str, target: str, fetch_mode: str, profile: Optional[dict]) -> str:
+    h = hashlib.sha256()
+    h.update(f'{version}\0{target}\0{fetch_mode}\0'.encode('utf-8'))
+    h.update(json.dumps(profile, sort_keys=True).encode('utf-8'))
+    h.update(get_patch_set_hash(patch_dir, target).encode('utf-8'))
+    return f'{target}-{version[:12]}-{h.hexdigest()[:12]}'
+
+
+# git のオブジェクト (.git/objects 以下) は一度書かれたら変更されないので、ハードリンクで共有しても安全
+def is_git_object_dir(rel: str) -> bool:
+    parts = rel.split(os.sep)
+    return any(parts[i] == '.git' and parts[i + 1] == 'objects' for i in range(len(parts) - 1))
+
+
+# git のオブジェクトだけをハードリンクで共有し、作業ツリーなどはコピーする。
+# 作業ツリーのファイルは patchdev などが shutil.copy2 で直接書き換えるので、ハードリンクで共有するとスナップショットも書き換わってしまう。
+def hardlink_tree(src: str, dst: str):
+    for root, dirs, files in os.walk(src):
+        rel = os.path.relpath(root, src)
+        target_root = os.path.normpath(os.path.join(dst, rel))
+        os.makedirs(target_root, exist_ok=True)
+        link = is_git_object_dir(rel)
+        for name in [*files, *[d for d in dirs if os.path.islink(os.path.join(root, d))]]:
+            path = os.path.join(root, name)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), os.path.join(target_root, name))
+            elif link:
+                os.link(path, os.path.join(target_root, name))
+            else:
+                shutil.copy2(path, os.path.join(target_root, name))
+        shutil.copystat(root, target_root)
+
+
+# ディレクトリをコピーオンライトで複製する。
+# reflink (Linux の btrfs, XFS など) → clonefile (macOS の APFS) → ハードリンクの順に試して、使えた方法を返す。
+def clone_tree(src: str, dst: str) -> str:
+    if platform.system() == 'Linux':
+        r = cmd(['cp', '-a', '--reflink=always', src, dst], stderr=subprocess.DEVNULL, check=False)
+        if r.returncode == 0:
+            return 'reflink'
+    elif platform.system() == 'Darwin':
+        r = cmd(['cp', '-c', '-R', '-p', src, dst], stderr=subprocess.DEVNULL, check=False)
+        if r.returncode == 0:
+            return 'clonefile'
+    if os.path.exists(dst):
+        shutil.rmtree(dst)
+    hardlink_tree(src, dst)
+    return 'hardlink'
+
+
+# 実際のディスク使用量。ハードリンクで共有しているファイルは 1 回だけ数える
+def get_disk_usage(dir: str) -> int:
+    inodes = set()
+    size = 0
+    for root, dirs, files in os.walk(dir):
+        for name in [*dirs, *files]:
+            try:
+                st = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            if (st.st_dev, st.st_ino) in inodes:
+                continue
+            inodes.add((st.st_dev, st.st_ino))
+            size += st.st_blocks * 512
+    return size
+
+
+def list_snapshots(snapshot_dir: str) -> List[dict]:
+    snapshots = []
+    if not os.path.isdir(snapshot_dir):
+        return snapshots
+    for key in os.listdir(snapshot_dir):
+        info_file = os.path.join(snapshot_dir, key, SNAPSHOT_INFO_FILE)
+        if not os.path.exists(info_file):
+            continue
+        with open(info_file) as f:
+            info = json.load(f)
+        used_file = os.path.join(snapshot_dir, key, SNAPSHOT_USED_FILE)
+        info['last_used'] = os.path.getmtime(used_file) if os.path.exists(used_file) else info['created']
+        snapshots.append(info)
+    return snapshots
+
+
+def touch_snapshot(snapshot_dir: str, key: str):
+    with open(os.path.join(snapshot_dir, key, SNAPSHOT_USED_FILE), 'w'):
+        pass
+
+
+# スナップショットがあれば webrtc_source_dir をそれで置き換える。
+# 復元した場合は get_webrtc を通らないので、スナップショットの同期の記録がバージョンやパッチと一致するかをここで確認する
+def restore_webrtc_snapshot(snapshot_dir: str, key: str, webrtc_source_dir: str, patch_dir: str,
+                            version: str, target: str, fetch_mode: str) -> bool:
+    snapshot = os.path.join(snapshot_dir, key)
+    if not os.path.exists(os.path.join(snapshot, SNAPSHOT_INFO_FILE)):
+        return False
+    state = load_fetch_state(os.path.join(snapshot, 'webrtc'))
+    if state is None or state['version'] != version or state.get('fetch_mode') != fetch_mode or \
+            state['patches'] != get_patch_ledger(patch_dir, target):
+        logging.warning(f'Snapshot {key} does not match the version or patches, removed')
+        rm_rf(snapshot)
+        return False
+    start = time.time()
+    rm_rf(webrtc_source_dir)
+    mkdir_p(os.path.dirname(webrtc_source_dir))
+    method = clone_tree(os.path.join(snapshot, 'webrtc'), webrtc_source_dir)
+    touch_snapshot(snapshot_dir, key)
+    logging.info(f'Restored WebRTC source from snapshot {key} ({method}, {time.time() - start:.1f}s)')
+    return True
+
+
+# 同期とパッチの適用が完了しているソースのスナップショットを保存し、予算を超えた分を古い順に削除する
+def save_webrtc_snapshot(snapshot_dir: str, key: str, webrtc_source_dir: str, patch_dir: str,
+                         version: str, target: str, budget: int):
+    snapshot = os.path.join(snapshot_dir, key)
+    if os.path.exists(os.path.join(snapshot, SNAPSHOT_INFO_FILE)):
+        touch_snapshot(snapshot_dir, key)
+        return
+    state = load_fetch_state(webrtc_source_dir)
+    if state is None or state['version'] != version or state['patches'] != get_patch_ledger(patch_dir, target):
+        logging.info('Snapshot: the source is not in a synced and patched state, skipped')
+        return
+
+    start = time.time()
+    rm_rf(snapshot)
+    mkdir_p(snapshot)
+    free = shutil.disk_usage(snapshot).free
+    method = clone_tree(webrtc_source_dir, os.path.join(snapshot, 'webrtc'))
+    touch_snapshot(snapshot_dir, key)
+    # reflink や clonefile で共有しているブロックは st_blocks では分からないので、空き容量の減り方も見て小さい方を使う。
+    # 空き容量は他のプロセスの書き込みでも減るので、st_blocks による値を上限にする
+    consumed = max(free - shutil.disk_usage(snapshot).free, 0)
+    info = {
+        'key': key,
+        'target': target,
+        'version': version,
+        'method': method,
+        'size': min(consumed, get_disk_usage(os.path.join(snapshot, 'webrtc'))),
+        'created': time.time(),
+    }
+    # snapshot.json が無いものは作成途中とみなすので、最後に書く
+    with open(os.path.join(snapshot, SNAPSHOT_INFO_FILE), 'w') as f:
+        json.dump(info, f, indent=2)
+    logging.info(f'Saved WebRTC source snapshot {key} ({method}, {info["size"] >> 20}MiB, '
+                 f'{time.time() - start:.1f}s)')
+    evict_snapshots(snapshot_dir, budget, keep=key)
+
+
+def evict_snapshots(snapshot_dir: str, budget: int, keep: Optional[str] = None):
+    snapshots = sorted(list_snapshots(snapshot_dir), key=lambda s: s['last_used'])
+    total = sum(s['size'] for s in snapshots)
+    for snapshot in snapshots:
+        if total <= budget:
+            break
+        if snapshot['key'] == keep:
+            continue
+        logging.info(f'Evicting WebRTC source snapshot {snapshot["key"]}')
+        rm_rf(os.path.join(snapshot_dir, snapshot['key']))
+        total -= snapshot['size']
+
+
+# ターゲットごとに gclient sync で取得しない依存を定義したプロファイル。
+# gclient-profile コマンドで、同期済みのソースとビルドディレクトリから生成する。
+GCLIENT_PROFILE_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'gclient_profiles')
+
+# どのターゲットでも使わない依存。プロファイルを使う時にだけ適用する
+GCLIENT_COMMON_CUSTOM_VARS = {
+    'checkout_instrumented_libraries': False,
+}
+
+# ビルドグラフに現れなくても、gclient の hooks やパッケージングで使うので取得する必要がある依存
+GCLIENT_REQUIRED_DEPS = [
+    'src/build',
+    'src/buildtools',
+    'src/testing',
+    'src/third_party',
+    'src/third_party/libc++/src',
+    'src/third_party/libc++abi/src',
+    'src/third_party/libunwind/src',
+    'src/tools',
+]
+
+
+def load_gclient_profile(target: str) -> Optional[dict]:
+    path = os.path.join(GCLIENT_PROFILE_DIR, f'{target}.json')
+    if not os.path.exists(path):
+        logging.warning(f'gclient profile for {target} not found. Run `python3 run.py gclient-profile {target}` first')
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+# プロファイルで .gclient に設定した custom_vars と custom_deps の記録
+GCLIENT_PROFILE_APPLIED_FILE = 'gclient_profile_applied.json'
+
+
+# .gclient の src ソリューションに、プロファイルの custom_vars と custom_deps を設定する。
+# profile が None の場合は、以前にプロファイルで設定したものだけを取り除き、それ以外は .gclient に触らない。
+def write_gclient_config(webrtc_source_dir: str, profile: Optional[dict]):
+    path = os.path.join(webrtc_source_dir, '.gclient')
+    applied_path = os.path.join(webrtc_source_dir, GCLIENT_PROFILE_APPLIED_FILE)
+    applied = None
+    if os.path.exists(applied_path):
+        with open(applied_path) as f:
+            applied = json.load(f)
+    if profile is None and applied is None:
+        return
+
+    with open(path) as f:
+        scope = eval_deps(f.read())
+    for solution in scope['solutions']:
+        if solution.get('name') != 'src':
+            continue
+        custom_vars = dict(solution.get('custom_vars', {}))
+        custom_deps = dict(solution.get('custom_deps', {}))
+        if applied is not None:
+            for name in applied['custom_vars']:
+                custom_vars.pop(name, None)
+            for name in applied['custom_deps']:
+                custom_deps.pop(name, None)
+        if profile is not None:
+            applied = {
+                'custom_vars': {**GCLIENT_COMMON_CUSTOM_VARS, **profile.get('custom_vars', {})},
+                'custom_deps': profile.get('custom_deps', {}),
+            }
+            custom_vars.update(applied['custom_vars'])
+            custom_deps.update(applied['custom_deps'])
+        solution['custom_vars'] = custom_vars
+        solution['custom_deps'] = custom_deps
+        logging.info(f'.gclient: custom_vars={custom_vars} custom_deps={len(custom_deps)} entries')
+    with open(path, 'w') as f:
+        for name, value in scope.items():
+            f.write(f'{name} = {pprint.pformat(value)}\n')
+    if profile is not None:
+        with open(applied_path, 'w') as f:
+            json.dump(applied, f, indent=2)
+    else:
+        os.remove(applied_path)
+
+
+def record_sync_stats(webrtc_source_dir: str, seconds: float, profile: Optional[dict], commit: str):
+    path = os.path.join(webrtc_source_dir, 'sync_stats.json')
+    stats = []
+    if os.path.exists(path):
+        with open(path) as f:
+            stats = json.load(f)
+    stats.append({
+        'time': time.time(),
+        'seconds': round(seconds, 1),
+        'commit': commit,
+        'pruned': profile is not None,
+        'pruned_bytes': profile.get('total_bytes', 0) if profile is not None else 0,
+    })
+    with open(path, 'w') as f:
+        f.write(json.dumps(stats, indent=4))
+    logging.info(f'gclient sync took {seconds:.1f}s')
+
+
+def get_dir_size(dir: str) -> int:
+    size = 0
+    for root, _, files in os.walk(dir):
+        for file in files:
+            try:
+                size += os.lstat(os.path.join(root, file)).st_size
+            except OSError:
+                pass
+    return size
+
+
+# ビルドディレクトリの gn と ninja の情報から、ビルドに使われているファイル (src からの相対パス) を集める
+def collect_build_graph_files(webrtc_src_dir: str, build_dir: str, targets: List[str]) -> set:
+    files = set()
+
+    def add(path):
+        path = os.path.normpath(os.path.join(build_dir, path))
+        rel = os.path.relpath(path, webrtc_src_dir).replace(os.sep, '/')
+        if not rel.startswith('../'):
+            files.add(rel)
+
+    # gn gen で読み込まれた全ての .gn/.gni ファイル
+    ninja_d = os.path.join(build_dir, 'build.ninja.d')
+    if os.path.exists(ninja_d):
+        with open(ninja_d) as f:
+            for path in f.read().split(':', 1)[-1].split():
+                add(path)
+    # ビルド対象の入力ファイル
+    r = cmd(['ninja', '-C', build_dir, '-t', 'inputs', *targets],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='utf-8', check=False)
+    for path in r.stdout.splitlines():
+        add(path)
+    # ビルド済みであれば、インクルードされたヘッダーファイル
+    r = cmd(['ninja', '-C', build_dir, '-t', 'deps'],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='utf-8', check=False)
+    for line in r.stdout.splitlines():
+        if line.startswith('    '):
+            add(line.strip())
+    return files
+
+
+# 同期済みのソースとビルドディレクトリから、ターゲットのビルドに使われない依存を調べてプロファイルを生成する
+def generate_gclient_profile(webrtc_source_dir: str, webrtc_build_dir: str, target: str) -> dict:
+    webrtc_src_dir = os.path.join(webrtc_source_dir, 'src')
+    with open(os.path.join(webrtc_src_dir, 'DEPS')) as f:
+        deps_content = f.read()
+    deps = ['src/' + path for path in parse_deps_revisions(deps_content).keys()]
+    deps = [dep for dep in deps if os.path.isdir(os.path.join(webrtc_source_dir, dep))]
+
+    used = set()
+    for root, dirnames, filenames in os.walk(webrtc_build_dir):
+        if 'build.ninja' in filenames:
+            logging.info(f'Collecting build graph: {root}')
+            used |= collect_build_graph_files(webrtc_src_dir, root, get_build_targets(target))
+            dirnames[:] = []
+    used = set('src/' + path for path in used)
+    # hooks で参照されているパス
+    hooks = ' '.join(' '.join(str(a) for a in hook.get('action', []))
+                     for hook in eval_deps(deps_content).get('hooks', []))
+    for path in re.findall(r'src/[\w\-./+]+', hooks):
+        used.add(path)
+
+    custom_deps = {}
+    bytes = {}
+    for dep in sorted(deps):
+        if any(dep == required or required.startswith(dep + '/') for required in GCLIENT_REQUIRED_DEPS):
+            continue
+        prefix = dep + '/'
+        # 使われているファイルや、使われている依存を内側に含む依存は削除できない
+        if any(path.startswith(prefix) or dep.startswith(path + '/') for path in used):
+            continue
+        custom_deps[dep] = None
+        bytes[dep] = get_dir_size(os.path.join(webrtc_source_dir, dep))
+        logging.info(f'Unused: {dep} ({bytes[dep] >> 20}MiB)')
+
+    profile = {
+        'target': target,
+        'custom_vars': {},
+        'custom_deps': custom_deps,
+        'bytes': bytes,
+        'total_bytes': sum(bytes.values()),
+    }
+    mkdir_p(GCLIENT_PROFILE_DIR)
+    with open(os.path.join(GCLIENT_PROFILE_DIR, f'{target}.json'), 'w') as f:
+        f.write(json.dumps(profile, indent=4) + '\n')
+    return profile
+
+
+# プロファイルによって削減されるサイズと、直近の gclient sync の時間を表示する
+def print_gclient_profile_summary(targets: List[str]):
+    for target in targets:
+        path = os.path.join(GCLIENT_PROFILE_DIR, f'{target}.json')
+        if not os.path.exists(path):
+            continue
+        with open(path) as f:
+            profile = json.load(f)
+        line = f'{target}: {len(profile["custom_deps"])} deps pruned, {profile["total_bytes"] >> 20}MiB saved'
+        stats_path = os.path.join(BASE_DIR, '_source', target, 'webrtc', 'sync_stats.json')
+        if os.path.exists(stats_path):
+            with open(stats_path) as f:
+                stats = json.load(f)
+            # 別のコミットの同期時間は比較できないので、同じコミットで両方の記録があるものだけを比べる
+            for pruned in reversed([s for s in stats if s['pruned'] and 'commit' in s]):
+                full = [s for s in stats if not s['pruned'] and s.get('commit') == pruned['commit']]
+                if len(full) != 0:
+                    saved = full[-1]['seconds'] - pruned['seconds']
+                    line += (f', sync at {pruned["commit"][:12]} {full[-1]["seconds"]:.0f}s -> '
+                             f'{pruned["seconds"]:.0f}s ({saved:.0f}s saved)')
+                    break
+        logging.info(line)
+
+
+# パッチが変更するファイルのパスを、パッチに書かれている通りに（strip せずに）返す
+def get_patch_files(patch: str) -> List[str]:
+    files = []
+    old_path = None
+    with open(patch, encoding='utf-8', errors='replace') as f:
+        for line in f:
+            if line.startswith('--- '):
+                old_path = line[4:].rstrip('\n').split('\t')[0]
+            elif line.startswith('+++ ') and old_path is not None:
+                new_path = line[4:].rstrip('\n').split('\t')[0]
+                path = new_path if new_path != '/dev/null' else old_path
+                if path not in files:
+                    files.append(path)
+                old_path = None
+    return files
+
+
+# パッチを当てるファイルの、WebRTC の src ディレクトリからの相対パス → パッチに書かれているパス (a/ や b/ を除く) を返す
+def get_patch_file_map(patch_dir: str, patch: str) -> Dict[str, str]:
+    depth, dirs = PATCH_INFO.get(patch, (1, ['.']))
+    files = {}
+    for path in get_patch_files(os.path.join(patch_dir, patch)):
+        components = path.split('/')
+        file = os.path.normpath(os.path.join(*dirs, *components[depth:])).replace(os.sep, '/')
+        files[file] = '/'.join(components[1:])
+    return files
+
+
+# パッチを当てるファイルの、WebRTC の src ディレクトリからの相対パスを返す
+def get_patch_target_files(patch_dir: str, patch: str) -> List[str]:
+    return list(get_patch_file_map(patch_dir, patch).keys())
+
+
+# ファイルが属する git リポジトリのトップレベルのディレクトリを返す。
+# WebRTC のソースは build や third_party などが別リポジトリになっているため、src より下を優先して探す。
+def find_git_root(path: str, top: str) -> str:
+    top = os.path.normpath(top)
+    dir = os.path.normpath(os.path.dirname(path))
+    while dir != top and dir.startswith(top + os.sep):
+        if os.path.exists(os.path.join(dir, '.git')):
+            return dir
+        dir = os.path.dirname(dir)
+    return top
+
+
+# git cat-file --batch で、指定したリビジョンのファイルの内容をまとめて読み込む。
+# 存在しないファイルは None になる。
+def read_git_blobs(repo: str, revision: str, paths: List[str]) -> Dict[str, Optional[bytes]]:
+    if len(paths) == 0:
+        return {}
+    input = ''.join(f'{revision}:{path}\n' for path in paths).encode('utf-8')
+    output = cmd(['git', '-C', repo, 'cat-file', '--batch'], input=input, stdout=subprocess.PIPE).stdout
+    blobs = {}
+    pos = 0
+    for path in paths:
+        end = output.index(b'\n', pos)
+        header = output[pos:end].decode('utf-8').split()
+        pos = end + 1
+        if len(header) != 3 or header[1] != 'blob':
+            blobs[path] = None
+            continue
+        size = int(header[2])
+        blobs[path] = output[pos:pos + size]
+        pos += size + 1
+    return blobs
+
+
+# WebRTC のソースツリーから、パッチ適用前のファイルの内容を読み込む。
+# revisions にリポジトリごとのリビジョンを指定しなかった場合は HEAD を読む。
+def read_pristine_files(webrtc_src_dir: str, files: List[str],
+                        revisions: Optional[Dict[str, str]] = None) -> Dict[str, Optional[bytes]]:
+    repos = collections.defaultdict(list)
+    for file in files:
+        repo = find_git_root(os.path.join(webrtc_src_dir, file), webrtc_src_dir)
+        repos[repo].append(file)
+    result = {}
+    for repo, repo_files in repos.items():
+        revision = 'HEAD'
+        if revisions is not None:
+            revision = revisions.get(os.path.relpath(repo, webrtc_src_dir).replace(os.sep, '/'), 'HEAD')
+        relpaths = [os.path.relpath(os.path.join(webrtc_src_dir, f), repo).replace(os.sep, '/') for f in repo_files]
+        blobs = read_git_blobs(repo, revision, relpaths)
+        for file, relpath in zip(repo_files, relpaths):
+            result[file] = blobs[relpath]
+    return result
+
+
+def try_apply_patch(patch: str, dir: str, depth: int) -> Optional[str]:
+    if platform.system() in ['Windows']:
+        base = ['git', 'apply', f'-p{depth}',
+                '--ignore-space-change', '--ignore-whitespace', '--whitespace=nowarn']
+        check = [*base, '--check', patch]
+        apply = [*base, patch]
+        stdin = None
+    else:
+        base = ['patch', f'-p{depth}', '--batch', '--forward', '--no-backup-if-mismatch', '-r', '-']
+        check = [*base, '--dry-run']
+        apply = base
+        stdin = patch
+    for args in (check, apply):
+        with open(stdin) if stdin is not None else contextlib.nullcontext() as f:
+            r = cmd(args, cwd=dir, stdin=f, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                    encoding='utf-8', check=False)
+        if r.returncode != 0:
+            return r.stdout
+    return None
+
+
+def write_scratch_files(dir: str, files: Dict[str, Optional[bytes]]):
+    for file, content in files.items():
+        path = os.path.join(dir, *file.split('/'))
+        if content is None:
+            rm_rf(path)
+            continue
+        mkdir_p(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(content)
+
+
+def read_scratch_files(dir: str, files: List[str]) -> Dict[str, Optional[bytes]]:
+    result = {}
+    for file in files:
+        path = os.path.join(dir, *file.split('/'))
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                result[file] = f.read()
+        else:
+            result[file] = None
+    return result
+
+
+PatchCheckResult = collections.namedtuple('PatchCheckResult', [
+    'target',
+    'patch',
+    'ok',
+    'output',
+])
+
+
+# パッチが変更するファイルだけを一時ディレクトリに展開し、ターゲットのパッチを順番に当ててみる。
+# ソースツリー自体には一切触れない。
+def check_patch_series(patch_dir: str, target: str, pristine: Dict[str, Optional[bytes]],
+                       patches: Optional[List[str]] = None) -> List[PatchCheckResult]:
+    if patches is None:
+        patches = PATCHES[target]
+    results = []
+    with tempfile.TemporaryDirectory(prefix=f'check-patches-{target}-') as work_dir:
+        write_scratch_files(work_dir, pristine)
+        for patch in patches:
+            depth, dirs = PATCH_INFO.get(patch, (1, ['.']))
+            dir = os.path.join(work_dir, *dirs)
+            mkdir_p(dir)
+            output = try_apply_patch(os.path.join(patch_dir, patch), dir, depth)
+            results.append(PatchCheckResult(target=target, patch=patch, ok=output is None, output=output or ''))
+    return results
+
+
+def find_webrtc_src_dir(targets: List[str]) -> Optional[str]:
+    for target in targets:
+        dir = os.path.join(BASE_DIR, '_source', target, 'webrtc', 'src')
+        if os.path.exists(os.path.join(dir, '.git')):
+            return dir
+    return None
+
+
+def check_patches(patch_dir: str, webrtc_src_dir: str, targets: List[str], jobs: Optional[int] = None) -> bool:
+    files = []
+    for target in targets:
+        for patch in PATCHES[target]:
+            files += get_patch_target_files(patch_dir, patch)
+    pristine = read_pristine_files(webrtc_src_dir, sorted(set(files)))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(check_patch_series, patch_dir, target, pristine) for target in targets]
+        results = [future.result() for future in futures]
+
+    ok = True
+    for target, target_results in zip(targets, results):
+        failed = [r for r in target_results if not r.ok]
+        if len(failed) == 0:
+            logging.info(f'{target}: OK ({len(target_results)} patches)')
+            continue
+        ok = False
+        for r in failed:
+            logging.error(f'{target}: {r.patch} does not apply')
+            for line in r.output.splitlines():
+                logging.error(f'  {line}')
+    return ok
+
+
+# DEPS や .gclient を exec せずに評価する。
+# gclient_eval と同じく、代入文とリテラル、Var()、Str()、文字列の + だけを受け付ける
+def eval_deps(deps: str) -> dict:
+    scope = {}
+
+    def evaluate(node):
+        if isinstance(node, ast.Constant) and isinstance(node.value, (str, int, float, bool, type(None))):
+            return node.value
+        if isinstance(node, ast.List):
+            return [evaluate(e) for e in node.elts]
+        if isinstance(node, ast.Tuple):
+            return tuple(evaluate(e) for e in node.elts)
+        if isinstance(node, ast.Dict) and None not in node.keys:
+            return {evaluate(k): evaluate(v) for k, v in zip(node.keys, node.values)}
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+            left = evaluate(node.left)
+            right = evaluate(node.right)
+            if isinstance(left, str) and isinstance(right, str):
+                return left + right
+        if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in ('Var', 'Str')
+                and len(node.args) == 1 and len(node.keywords) == 0):
+            arg = evaluate(node.args[0])
+            if isinstance(arg, str):
+                if node.func.id == 'Str':
+                    return arg
+                vars = scope.get('vars', {})
+                if arg not in vars:
+                    raise ValueError(f'Undefined variable in DEPS: {arg} (line {node.lineno})')
+                return vars[arg]
+        raise ValueError(f'Unsupported expression in DEPS: {ast.dump(node)} (line {getattr(node, "lineno", "?")})')
+
+    for statement in ast.parse(deps).body:
+        if (not isinstance(statement, ast.Assign) or len(statement.targets) != 1
+                or not isinstance(statement.targets[0], ast.Name)):
+            raise ValueError(f'Unsupported statement in DEPS: {ast.dump(statement)} (line {statement.lineno})')
+        scope[statement.targets[0].id] = evaluate(statement.value)
+    return scope
+
+
+# DEPS ファイルを評価して、依存リポジトリの src からの相対パス → リビジョンを返す
+def parse_deps_revisions(deps: str) -> Dict[str, str]:
+    scope = eval_deps(deps)
+    vars = {k: v for k, v in scope.get('vars', {}).items() if isinstance(v, str)}
+    revisions = {}
+    for path, dep in scope.get('deps', {}).items():
+        if isinstance(dep, dict):
+            if dep.get('dep_type', 'git') != 'git':
+                continue
+            dep = dep.get('url')
+        if not isinstance(dep, str) or '@' not in dep or not path.startswith('src/'):
+            continue
+        try:
+            dep = dep.format(**vars)
+        except (KeyError, IndexError, ValueError):
+            pass
+        revisions[path[len('src/'):]] = dep.rsplit('@', 1)[1]
+    return revisions
+
+
+# 手元にないコミットを blob 無しで取得する。blob は必要になった時に遅延取得される
+def git_fetch_commit_blobless(repo: str, revision: str):
+    r = cmd(['git', '-C', repo, 'cat-file', '-e', f'{revision}^{{commit}}'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+    if r.returncode == 0:
+        return
+    logging.info(f'git fetch --filter=blob:none origin {revision} ({repo})')
+    cmd(['git', '-C', repo, 'fetch', '--filter=blob:none', 'origin', revision])
+
+
+def git_merge_file(ours: bytes, base: bytes, theirs: bytes) -> Tuple[bytes, bool]:
+    with tempfile.TemporaryDirectory(prefix='merge-file-') as dir:
+        paths = []
+        for name, content in (('ours', ours), ('base', base), ('theirs', theirs)):
+            path = os.path.join(dir, name)
+            with open(path, 'wb') as f:
+                f.write(content)
+            paths.append(path)
+        r = cmd(['git', 'merge-file', '-p', '-L', 'patched', '-L', 'base', '-L', 'new', *paths],
+                stdout=subprocess.PIPE, check=False)
+        if r.returncode < 0:
+            raise Exception('git merge-file failed')
+        return r.stdout, r.returncode == 0
+
+
+def make_unified_diff(file: str, old: Optional[bytes], new: Optional[bytes]) -> str:
+    old_lines = old.decode('utf-8', errors='replace').splitlines(keepends=True) if old is not None else []
+    new_lines = new.decode('utf-8', errors='replace').splitlines(keepends=True) if new is not None else []
+    if old_lines == new_lines:
+        return ''
+    lines = [f'diff --git a/{file} b/{file}\n']
+    for line in difflib.unified_diff(old_lines, new_lines,
+                                     'a/' + file if old is not None else '/dev/null',
+                                     'b/' + file if new is not None else '/dev/null'):
+        lines.append(line if line.endswith('\n') else line + '\n\\ No newline at end of file\n')
+    return ''.join(lines)
+
+
+PatchRebaseResult = collections.namedtuple('PatchRebaseResult', [
+    'patch',
+    'status',
+    'targets',
+    'conflicts',
+])
+
+
+# 新しいコミットに対して、各ターゲットのパッチを順番に当ててみる。
+# 当たらなかったパッチは、元のリビジョン・パッチ適用後・新しいリビジョンの 3-way マージで書き直した下書きを作る。
+def rebase_patches(patch_dir: str, webrtc_src_dir: str, commit: str, output_dir: str,
+                   targets: List[str]) -> List[PatchRebaseResult]:
+    git_fetch_commit_blobless(webrtc_src_dir, commit)
+    new_deps = parse_deps_revisions(cmdcap(['git', '-C', webrtc_src_dir, 'show', f'{commit}:DEPS']))
+
+    series = {target: PATCHES[target] for target in targets}
+    # どのターゲットでも使われていないパッチは単体で確認する
+    used = set(p for patches in series.values() for p in patches)
+    for patch in sorted(os.listdir(patch_dir)):
+        if patch.endswith('.patch') and patch not in used:
+            series[f'({patch})'] = [patch]
+
+    files = sorted(set(f for patches in series.values() for p in patches for f in get_patch_target_files(patch_dir, p)))
+    new_revisions = {'.': commit}
+    for file in files:
+        repo = find_git_root(os.path.join(webrtc_src_dir, file), webrtc_src_dir)
+        rel = os.path.relpath(repo, webrtc_src_dir).replace(os.sep, '/')
+        if rel != '.' and rel not in new_revisions:
+            if rel not in new_deps:
+                logging.warning(f'{rel} is not found in DEPS of {commit}, using HEAD')
+                continue
+            new_revisions[rel] = new_deps[rel]
+            git_fetch_commit_blobless(repo, new_deps[rel])
+    old_pristine = read_pristine_files(webrtc_src_dir, files)
+    new_pristine = read_pristine_files(webrtc_src_dir, files, new_revisions)
+
+    results = {}
+    drafts = {}
+    for target, patches in series.items():
+        with tempfile.TemporaryDirectory(prefix=f'rebase-old-{target}-') as old_dir, \
+                tempfile.TemporaryDirectory(prefix=f'rebase-new-{target}-') as new_dir:
+            write_scratch_files(old_dir, old_pristine)
+            write_scratch_files(new_dir, new_pristine)
+            for patch in patches:
+                depth, dirs = PATCH_INFO.get(patch, (1, ['.']))
+                patch_path = os.path.join(patch_dir, patch)
+                patch_file_map = get_patch_file_map(patch_dir, patch)
+                patch_files = list(patch_file_map.keys())
+                base = read_scratch_files(old_dir, patch_files)
+                old_ok = try_apply_patch(patch_path, os.path.join(old_dir, *dirs), depth) is None
+                ours = read_scratch_files(old_dir, patch_files)
+                new_ok = try_apply_patch(patch_path, os.path.join(new_dir, *dirs), depth) is None
+                result = results.setdefault(
+                    patch, PatchRebaseResult(patch=patch, status='ok', targets=[], conflicts=[]))
+                result.targets.append(target)
+                if new_ok:
+                    continue
+                if not old_ok:
+                    results[patch] = result._replace(status='broken')
+                    continue
+                # 3-way マージして、新しいリビジョンの状態を作り直す
+                theirs = read_scratch_files(new_dir, patch_files)
+                merged = {}
+                draft = []
+                conflicts = []
+                for file in patch_files:
+                    if base[file] == ours[file]:
+                        continue
+                    content, clean = git_merge_file(ours[file] or b'', base[file] or b'', theirs[file] or b'')
+                    if ours[file] is None and theirs[file] is None:
+                        content = None
+                    merged[file] = content
+                    if not clean:
+                        conflicts.append(file)
+                    diff = make_unified_diff(patch_file_map[file], theirs[file], content)
+                    draft.append(diff)
+                write_scratch_files(new_dir, merged)
+                status = 'conflict' if len(conflicts) != 0 else 'rebased'
+                if results[patch].status in ('ok', 'rebased'):
+                    results[patch] = result._replace(status=status, conflicts=sorted(set(result.conflicts + conflicts)))
+                drafts.setdefault(patch, ''.join(draft))
+
+    mkdir_p(output_dir)
+    for patch, draft in drafts.items():
+        with open(os.path.join(output_dir, patch), 'w') as f:
+            f.write(draft)
+    with open(os.path.join(output_dir, 'status.json'), 'w') as f:
+        f.write(json.dumps({
+            'commit': commit,
+            'revisions': new_revisions,
+            'patches': {r.patch: {'status': r.status, 'targets': r.targets, 'conflicts': r.conflicts}
+                        for r in results.values()},
+        }, indent=4))
+    return list(results.values())
 
 
 def git_get_url_and_revision(dir):
@@ -344,13 +1715,214 @@ DepsInfo = collections.namedtuple('DepsInfo', [
 ])
 
 
-def archive_objects(ar, dir, output):
+def find_objects(dir) -> List[str]:
+    with cd(dir):
+        return sorted(cmdcap(['find', '.', '-name', '*.o']).splitlines())
+
+
+# ninja の依存グラフから、ビルド対象に必要なオブジェクトファイルを obj からの相対パスで返す。
+# 以前にビルドした別のターゲットや、ついでにビルドされたもののオブジェクトファイルは含まれない。
+def list_build_graph_objects(dir, targets: List[str]) -> Optional[List[str]]:
+    build_dir = os.path.dirname(dir)
+    r = cmd(['ninja', '-C', build_dir, '-t', 'inputs', *targets],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='utf-8', check=False)
+    if r.returncode != 0:
+        return None
+    files = set()
+    for path in r.stdout.splitlines():
+        path = path.strip().replace(os.sep, '/')
+        if path.startswith('obj/') and path.endswith('.o'):
+            files.add('./' + path[len('obj/'):])
+    # 古い ninja の -t inputs は直接の入力しか返さないので、オブジェクトファイルが見つからない
+    if len(files) == 0:
+        return None
+    return sorted(files)
+
+
+# アーカイブに含めるオブジェクトファイルの一覧。
+# targets が指定されていれば ninja の依存グラフから取得し、取得できなければ obj 以下の全てのオブジェクトファイルを使う。
+def list_archive_objects(dir, targets: Optional[List[str]] = None, report_file: Optional[str] = None) -> List[str]:
+    found = find_objects(dir)
+    if targets is None:
+        return found
+    files = list_build_graph_objects(dir, targets)
+    if files is None:
+        logging.warning(f'Failed to get objects from the build graph of {os.path.dirname(dir)}, '
+                        'archiving all objects')
+        return found
+
+    found_set = set(found)
+    files_set = set(files)
+    extra = [file for file in found if file not in files_set]
+    missing = [file for file in files if file not in found_set]
+    logging.info(f'Archive objects: {len(files)} from the build graph, {len(found)} in {dir}, '
+                 f'{len(extra)} not in the build graph')
+    for file in extra[:20]:
+        logging.info(f'  not in the build graph: {file}')
+    if missing:
+        # ninja のグラフには含まれるが生成されていないもの（ビルドされていない場合など）
+        logging.warning(f'{len(missing)} objects in the build graph do not exist, e.g. {missing[0]}')
+    if report_file is not None:
+        with open(report_file, 'w') as f:
+            json.dump({
+                'targets': targets,
+                'objects': len(files) - len(missing),
+                'found_objects': len(found),
+                'not_in_build_graph': extra,
+                'missing': missing,
+            }, f, indent=2)
+    return [file for file in files if file in found_set]
+
+
+def archive_objects(ar, dir, output, targets: Optional[List[str]] = None):
+    files = list_archive_objects(dir, targets, os.path.join(os.path.dirname(output), 'archive_objects.json'))
     with cd(dir):
-        files = cmdcap(['find', '.', '-name', '*.o']).splitlines()
         rm_rf(output)
         cmd([ar, '-rc', output, *files])
 
 
+# 公開 API として残すオブジェクトファイルのディレクトリ (obj からの相対パス)
+PRUNE_ROOT_DIRS = ['api', 'pc', 'sdk']
+
+NM_LINE_RE = re.compile(r'^(.+?): *(?:[0-9a-fA-F]+)? +([A-Za-z?]) (.+)$')
+
+
+# llvm-nm で各オブジェクトファイルの定義済みシンボルと未定義シンボルを取得する
+def read_object_symbols(nm: str, dir: str, files: List[str]):
+    defined = {}
+    undefined = {}
+    ctors = set()
+    with cd(dir):
+        # コマンドラインが長くなりすぎないように分割する
+        for i in range(0, len(files), 500):
+            r = cmd([nm, '--print-file-name', '--no-sort', *files[i:i + 500]],
+                    stdout=subprocess.PIPE, encoding='utf-8', errors='replace')
+            for line in r.stdout.splitlines():
+                m = NM_LINE_RE.match(line)
+                if m is None:
+                    continue
+                file, type, symbol = m.groups()
+                if type == 'U':
+                    undefined.setdefault(file, []).append(symbol)
+                elif type.isupper():
+                    defined.setdefault(file, []).append((symbol, type in 'WV'))
+                elif symbol.startswith('_GLOBAL__sub_I_'):
+                    # 静的初期化子を持つオブジェクトは参照されなくても残す
+                    ctors.add(file)
+    return defined, undefined, ctors
+
+
+# 公開 API のオブジェクトファイルと静的初期化子を持つオブジェクトファイルを起点に、
+# 未定義シンボルを解決するのに必要なオブジェクトファイルだけを辿る
+def collect_reachable_objects(files: List[str], defined, undefined, ctors, roots: List[str]):
+    providers = {}
+    for file in files:
+        for symbol, weak in defined.get(file, []):
+            if symbol not in providers or (providers[symbol][1] and not weak):
+                providers[symbol] = (file, weak)
+
+    root_files = [f for f in files
+                  if f in ctors or any(f.startswith(f'./{root}/') for root in roots)]
+    reachable = set()
+    queue = list(root_files)
+    while queue:
+        file = queue.pop()
+        if file in reachable:
+            continue
+        reachable.add(file)
+        for symbol in undefined.get(file, []):
+            provider = providers.get(symbol)
+            if provider is not None and provider[0] not in reachable:
+                queue.append(provider[0])
+    return [f for f in files if f in reachable], root_files
+
+
+# ELF の e_machine と ld.lld のエミュレーション名の対応。
+# 入力がアーカイブだけの場合、ld.lld はターゲットを決められないので -m で明示する
+LLD_EMULATIONS = {
+    3: 'elf_i386',
+    40: 'armelf_linux_eabi',
+    62: 'elf_x86_64',
+    183: 'aarch64linux',
+}
+
+
+def get_lld_emulation(obj: str) -> Optional[str]:
+    with open(obj, 'rb') as f:
+        header = f.read(20)
+    if len(header) < 20 or header[:4] != b'\x7fELF':
+        return None
+    machine, = struct.unpack('<H' if header[5] == 1 else '>H', header[18:20])
+    return LLD_EMULATIONS.get(machine)
+
+
+# 起点のシンボルを全て参照する共有ライブラリを、アーカイブだけからリンクする時間を計る。
+# 利用者側の実際のリンクではなく、アーカイブの大きさによる差を見るための合成的なリンク。
+# 失敗した場合は警告を出して None を返す。
+def measure_link_time(lld: str, archive: str, symbols: List[str], work_dir: str,
+                      emulation: Optional[str]) -> Optional[float]:
+    rsp = os.path.join(work_dir, 'link.rsp')
+    with open(rsp, 'w') as f:
+        for symbol in symbols:
+            f.write(f'-u "{symbol}"\n')
+    output = os.path.join(work_dir, 'link_test.so')
+    start = time.time()
+    r = cmd([lld, *(['-m', emulation] if emulation is not None else []),
+             '-shared', '--gc-sections', '--unresolved-symbols=ignore-all',
+             '-o', output, f'@{rsp}', archive], check=False)
+    elapsed = time.time() - start
+    rm_rf(output)
+    os.remove(rsp)
+    if r.returncode != 0:
+        logging.warning(f'Failed to measure the link time of {archive}')
+        return None
+    return elapsed
+
+
+# libwebrtc.a から公開 API から到達できないオブジェクトファイルを取り除いた libwebrtc.pruned.a を生成する。
+# prelink が指定された場合は、それを ld -r で 1 つにまとめた libwebrtc.o も生成する。
+def prune_objects(webrtc_src_dir: str, work_dir: str, roots: Optional[List[str]] = None, prelink=False,
+                  targets: Optional[List[str]] = None):
+    bin_dir = os.path.join(webrtc_src_dir, 'third_party/llvm-build/Release+Asserts/bin')
+    ar = os.path.join(bin_dir, 'llvm-ar')
+    lld = os.path.join(bin_dir, 'ld.lld')
+    obj_dir = os.path.join(work_dir, 'obj')
+    archive = os.path.join(work_dir, 'libwebrtc.a')
+    pruned = os.path.join(work_dir, 'libwebrtc.pruned.a')
+
+    files = list_archive_objects(obj_dir, targets)
+    defined, undefined, ctors = read_object_symbols(os.path.join(bin_dir, 'llvm-nm'), obj_dir, files)
+    reachable, root_files = collect_reachable_objects(files, defined, undefined, ctors,
+                                                      [*PRUNE_ROOT_DIRS, *(roots or [])])
+    logging.info(f'Pruned objects: {len(reachable)} / {len(files)} ({len(root_files)} roots)')
+    with cd(obj_dir):
+        rm_rf(pruned)
+        cmd([ar, '-rc', pruned, *reachable])
+
+    emulation = get_lld_emulation(os.path.join(obj_dir, reachable[0])) if len(reachable) != 0 else None
+    emulation_args = ['-m', emulation] if emulation is not None else []
+    if prelink:
+        cmd([lld, *emulation_args, '-r', '-o', os.path.join(work_dir, 'libwebrtc.o'), '--whole-archive', pruned])
+
+    symbols = sorted(set(symbol for file in root_files for symbol, _ in defined.get(file, [])))
+    report = {
+        'objects': len(files),
+        'pruned_objects': len(reachable),
+        'root_objects': len(root_files),
+        'archive_size': os.path.getsize(archive),
+        'pruned_archive_size': os.path.getsize(pruned),
+        # 利用者側のリンク時間ではなく、起点のシンボルだけを参照する共有ライブラリを合成的にリンクした時間
+        'link_time_kind': 'synthetic',
+        'link_time': measure_link_time(lld, archive, symbols, work_dir, emulation),
+        'pruned_link_time': measure_link_time(lld, pruned, symbols, work_dir, emulation),
+    }
+    with open(os.path.join(work_dir, 'prune_report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+    if report['link_time'] is not None and report['pruned_link_time'] is not None:
+        logging.info(f'Synthetic link time (not the consumer\'s link): '
+                     f'{report["link_time"]:.2f}s -> {report["pruned_link_time"]:.2f}s')
+
+
 MultistrapConfig = collections.namedtuple('MultistrapConfig', [
     'config_file',
     'arch',
@@ -390,15 +1962,23 @@ MULTISTRAP_CONFIGS = {
 }
 
 
-def init_rootfs(sysroot: str, config: MultistrapConfig, force=False):
+def init_rootfs(sysroot: str, config: MultistrapConfig, force=False, builder='multistrap',
+                mirror: Optional[str] = None, cache_dir: Optional[str] = None):
     if force:
         rm_rf(sysroot)
 
     if os.path.exists(sysroot):
         return
 
-    cmd(['multistrap', '--no-auth', '-a', config.arch, '-d', sysroot, '-f', os.path.join(*config.config_file)])
+    if builder == 'builtin':
+        build_rootfs(sysroot, config, cache_dir, mirror)
+    else:
+        cmd(['multistrap', '--no-auth', '-a', config.arch, '-d', sysroot, '-f', os.path.join(*config.config_file)])
+    fixup_rootfs_links(sysroot, config)
+
 
+# 絶対パスのシンボリックリンクを sysroot 内を指すように張り直す
+def fixup_rootfs_links(sysroot: str, config: MultistrapConfig):
     lines = cmdcap(['find', f'{sysroot}/usr/lib/{config.triplet}', '-lname', '/*', '-printf', '%p %l\n']).splitlines()
     for line in lines:
         [link, target] = line.split()
@@ -417,6 +1997,302 @@ def init_rootfs(sysroot: str, config: MultistrapConfig, force=False):
              f'{sysroot}/usr/share/pkgconfig/{target}'])
 
 
+DebPackage = collections.namedtuple('DebPackage', [
+    'name',
+    'version',
+    'depends',
+    'provides',
+    'priority',
+    'url',
+    'path',
+    'sha256',
+])
+
+
+def parse_multistrap_conf(path: str):
+    parser = configparser.ConfigParser(interpolation=None)
+    parser.read(path)
+    sources = []
+    for name in parser['General']['bootstrap'].split():
+        section = parser[name]
+        sources.append({
+            'name': name,
+            'packages': section.get('packages', '').split(),
+            'source': section['source'].rstrip('/'),
+            'suite': section['suite'],
+            'components': section.get('components', 'main').split(),
+        })
+    return sources
+
+
+# Debian のバージョン比較 (dpkg --compare-versions と同じ順序)
+def debian_version_key(version: str):
+    def order(c):
+        if c == '~':
+            return -1
+        if c.isalpha():
+            return ord(c)
+        return ord(c) + 256
+
+    def part_key(s):
+        key = []
+        while s:
+            m = re.match(r'^([^0-9]*)([0-9]*)', s)
+            nondigit, digit = m.group(1), m.group(2)
+            key.append(tuple(order(c) for c in nondigit) + (0,))
+            key.append(int(digit) if digit else 0)
+            s = s[len(nondigit) + len(digit):]
+        # 文字列の終わりは '~' より後、他の文字より前になる
+        key.append((0,))
+        return key
+
+    epoch = 0
+    if ':' in version:
+        epoch_str, version = version.split(':', 1)
+        epoch = int(epoch_str)
+    upstream, _, revision = version.rpartition('-') if '-' in version else (version, '', '')
+    return (epoch, part_key(upstream), part_key(revision))
+
+
+def parse_deb_relations(value: str) -> List[List[str]]:
+    relations = []
+    for group in value.split(','):
+        alternatives = []
+        for alternative in group.split('|'):
+            name = alternative.strip().split(' ')[0].split('(')[0].split(':')[0]
+            if name:
+                alternatives.append(name)
+        if alternatives:
+            relations.append(alternatives)
+    return relations
+
+
+def parse_packages_index(text: str, base_url: str, mirror_dir: Optional[str]) -> List[DebPackage]:
+    packages = []
+    for stanza in text.split('\n\n'):
+        fields = {}
+        key = None
+        for line in stanza.splitlines():
+            if line.startswith((' ', '\t')):
+                if key is not None:
+                    fields[key] += line
+                continue
+            if ':' not in line:
+                continue
+            key, value = line.split(':', 1)
+            fields[key] = value.strip()
+        if 'Package' not in fields or 'Filename' not in fields:
+            continue
+        packages.append(DebPackage(
+            name=fields['Package'],
+            version=fields.get('Version', '0'),
+            depends=parse_deb_relations(', '.join(v for v in [fields.get('Pre-Depends'), fields.get('Depends')] if v)),
+            provides=[p[0] for p in parse_deb_relations(fields.get('Provides', ''))],
+            priority=fields.get('Priority', 'optional'),
+            url=f"{base_url}/{urllib.parse.quote(fields['Filename'])}",
+            path=os.path.join(mirror_dir, *fields['Filename'].split('/')) if mirror_dir is not None else None,
+            sha256=fields.get('SHA256'),
+        ))
+    return packages
+
+
+# ソースの URL をローカルのミラーのディレクトリに置き換える。ミラーは <mirror>/<ホスト名>/<パス> の構成 (apt-mirror と同じ)
+def get_mirror_dir(source: str, mirror: Optional[str]) -> Optional[str]:
+    url = urllib.parse.urlparse(source)
+    if url.scheme == 'file':
+        return url.path
+    if mirror is None:
+        return None
+    return os.path.join(mirror, url.netloc, *url.path.strip('/').split('/'))
+
+
+def fetch_packages_index(source: str, suite: str, component: str, arch: str,
+                         index_dir: str, mirror: Optional[str]) -> str:
+    mirror_dir = get_mirror_dir(source, mirror)
+    base = f'dists/{suite}/{component}/binary-{arch}/Packages'
+    for ext, decompress in [('.xz', lzma.decompress), ('.gz', gzip.decompress), ('', lambda b: b)]:
+        if mirror_dir is not None:
+            path = os.path.join(mirror_dir, *base.split('/')) + ext
+            if not os.path.exists(path):
+                continue
+        else:
+            path = os.path.join(index_dir, re.sub(r'[^A-Za-z0-9.-]', '_', f'{source}/{base}{ext}'))
+            rm_rf(path)
+            try:
+                download(f'{source}/{base}{ext}', filename=path)
+            except subprocess.CalledProcessError:
+                continue
+        with open(path, 'rb') as f:
+            return decompress(f.read()).decode('utf-8', errors='replace')
+    raise Exception(f'Packages index not found: {source}/{base}')
+
+
+# multistrap と同じく、指定したパッケージと Priority: required のパッケージの依存を全て解決する
+def resolve_deb_packages(index: Dict[str, DebPackage], providers: Dict[str, List[str]],
+                         names: List[str]) -> List[DebPackage]:
+    queue = [*names, *sorted(name for name, p in index.items() if p.priority == 'required')]
+    resolved = {}
+    while queue:
+        name = queue.pop()
+        if name in resolved:
+            continue
+        if name not in index:
+            if name in providers:
+                name = providers[name][0]
+                if name in resolved:
+                    continue
+            else:
+                raise Exception(f'Package not found: {name}')
+        package = index[name]
+        resolved[name] = package
+        for alternatives in package.depends:
+            for alternative in alternatives:
+                if alternative in resolved or alternative in index or alternative in providers:
+                    queue.append(alternative)
+                    break
+            else:
+                logging.warning(f'{name}: unresolved dependency {" | ".join(alternatives)}')
+    return sorted(resolved.values(), key=lambda p: p.name)
+
+
+def fetch_deb(package: DebPackage, cache_dir: str) -> str:
+    if package.path is not None and os.path.exists(package.path):
+        return package.path
+    path = os.path.join(cache_dir, urllib.parse.unquote(package.url.split('/')[-1]))
+    if os.path.exists(path) and package.sha256 is not None and file_sha256(path) != package.sha256:
+        os.remove(path)
+    download(package.url, filename=path)
+    if package.sha256 is not None and file_sha256(path) != package.sha256:
+        os.remove(path)
+        raise Exception(f'SHA256 mismatch: {package.url}')
+    return path
+
+
+# sysroot を / とみなしてパスの途中のシンボリックリンクを解決する。
+# 絶対パスのリンクはホストではなく sysroot の中を指すものとして扱い、.. は sysroot より上には出ない
+def resolve_sysroot_path(sysroot: str, path: str) -> str:
+    parts = [p for p in path.split('/') if p not in ('', '.')]
+    resolved = []
+    links = 0
+    while parts:
+        part = parts.pop(0)
+        if part == '..':
+            if resolved:
+                resolved.pop()
+            continue
+        current = os.path.join(sysroot, *resolved, part)
+        if os.path.islink(current):
+            links += 1
+            if links > 40:
+                raise Exception(f'Too many levels of symbolic links: {path}')
+            link = os.readlink(current)
+            if link.startswith('/'):
+                resolved = []
+            parts = [p for p in link.split('/') if p not in ('', '.')] + parts
+            continue
+        resolved.append(part)
+    return os.path.join(sysroot, *resolved)
+
+
+# deb の data.tar を sysroot に展開する。
+# tarfile の extractall はシンボリックリンクをホストのパスとして解決するので、
+# 他のパッケージが作った絶対パスのリンクの下にあるファイルを展開できなかったり、ホストに書き込んでしまったりする。
+# そのため各エントリの親ディレクトリを resolve_sysroot_path で解決してから書き込む。
+# 既にあるファイルは dpkg と同じく後から展開したもので置き換える。
+def extract_deb(deb: str, sysroot: str):
+    with open(deb, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        for name, offset, size in enum_ar_members(buf):
+            if not name.startswith('data.tar'):
+                continue
+            data = buf[offset:offset + size]
+            if name.endswith('.zst'):
+                # Python の標準ライブラリは zstd に対応していないのでコマンドで展開する
+                data = subprocess.run(['zstd', '-dc'], input=data, stdout=subprocess.PIPE, check=True).stdout
+            with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+                parents = {}
+                for member in tar:
+                    if member.ischr() or member.isblk() or member.isfifo():
+                        continue
+                    rel = os.path.normpath(member.name.lstrip('/')).replace(os.sep, '/')
+                    if rel == '.' or rel == '..' or rel.startswith('../'):
+                        continue
+                    parent_rel, basename = rel.rsplit('/', 1) if '/' in rel else ('', rel)
+                    if parent_rel not in parents:
+                        parents[parent_rel] = resolve_sysroot_path(sysroot, parent_rel)
+                        mkdir_p(parents[parent_rel])
+                    path = os.path.join(parents[parent_rel], basename)
+                    if member.isdir():
+                        # usrmerge の /lib -> usr/lib のように、既にあるディレクトリへのリンクはそのまま使う
+                        if os.path.islink(path):
+                            if os.path.isdir(resolve_sysroot_path(sysroot, rel)):
+                                continue
+                            os.remove(path)
+                        elif os.path.lexists(path) and not os.path.isdir(path):
+                            os.remove(path)
+                        mkdir_p(path)
+                        os.chmod(path, (member.mode & 0o777) | 0o700)
+                        continue
+                    if os.path.islink(path) or os.path.isfile(path):
+                        os.remove(path)
+                    elif os.path.lexists(path):
+                        logging.warning(f'{os.path.basename(deb)}: {rel} conflicts with a directory, skipped')
+                        continue
+                    if member.issym():
+                        os.symlink(member.linkname, path)
+                        # パッケージの中で作ったリンクの下にも展開できるように、解決済みのパスを作り直す
+                        parents.clear()
+                    elif member.islnk():
+                        target = resolve_sysroot_path(sysroot, member.linkname)
+                        try:
+                            os.link(target, path)
+                        except OSError:
+                            shutil.copy2(target, path)
+                    elif member.isfile():
+                        with tar.extractfile(member) as src, open(path, 'wb') as dst:
+                            shutil.copyfileobj(src, dst)
+                        os.chmod(path, member.mode & 0o777)
+                        os.utime(path, (member.mtime, member.mtime))
+            return
+    raise Exception(f'data.tar not found in {deb}')
+
+
+# multistrap の設定ファイルから、パッケージの依存を解決して並列にダウンロード・展開して sysroot を作る。
+# mirror を指定した場合は、ネットワークを使わずにローカルのミラーから読み込む。
+def build_rootfs(sysroot: str, config: MultistrapConfig, cache_dir: str, mirror: Optional[str] = None,
+                 jobs: Optional[int] = None):
+    deb_dir = os.path.join(cache_dir, 'debs')
+    index_dir = os.path.join(deb_dir, 'indexes')
+    mkdir_p(index_dir)
+
+    index = {}
+    names = []
+    for source in parse_multistrap_conf(os.path.join(*config.config_file)):
+        names += source['packages']
+        mirror_dir = get_mirror_dir(source['source'], mirror)
+        base_url = f'file://{mirror_dir}' if mirror_dir is not None else source['source']
+        for component in source['components']:
+            text = fetch_packages_index(source['source'], source['suite'], component, config.arch, index_dir, mirror)
+            for package in parse_packages_index(text, base_url, mirror_dir):
+                if package.name not in index or \
+                        debian_version_key(package.version) > debian_version_key(index[package.name].version):
+                    index[package.name] = package
+    providers = {}
+    for package in index.values():
+        for provide in package.provides:
+            providers.setdefault(provide, []).append(package.name)
+
+    packages = resolve_deb_packages(index, providers, names)
+    logging.info(f'Rootfs: {len(packages)} packages')
+
+    mkdir_p(sysroot)
+    with concurrent.futures.ThreadPoolExecutor(jobs or min(16, (os.cpu_count() or 1) * 2)) as executor:
+        debs = list(executor.map(lambda p: fetch_deb(p, deb_dir), packages))
+    # 同じパスを複数のパッケージが含む場合や、他のパッケージのシンボリックリンクの下に展開する場合に
+    # 結果が変わらないように、展開は解決した順番に 1 つずつ行う
+    for deb in debs:
+        extract_deb(deb, sysroot)
+
+
 COMMON_GN_ARGS = [
     "rtc_include_tests=false",
     "rtc_use_h264=false",
@@ -460,6 +2336,331 @@ def to_gn_args(gn_args: List[str], extra_gn_args: str) -> str:
     return s + ' ' + extra_gn_args
 
 
+# ジョブ 1 つあたりのメモリ使用量の見積もり (GiB)。(コンパイル, リンク) の順。
+# Android は libjingle_peerconnection_so のリンクが特に重いので大きめに見積もる。
+JOB_MEMORY_PROFILES = {
+    'android': (1.0, 10.0),
+    'ios': (1.0, 8.0),
+    'macos_arm64': (1.0, 8.0),
+}
+DEFAULT_JOB_MEMORY_PROFILE = (1.0, 6.0)
+
+NinjaJobs = collections.namedtuple('NinjaJobs', [
+    'jobs',
+    'load_average',
+    'link_jobs',
+    'cc_wrapper',
+])
+
+
+# 利用可能な物理メモリのバイト数を返す。取得できなかった場合は None
+def get_available_memory() -> Optional[int]:
+    if platform.system() == 'Linux':
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    elif platform.system() == 'Darwin':
+        # macOS は空きメモリを積極的にキャッシュに使うので、物理メモリの総量を見る
+        return int(cmdcap(['sysctl', '-n', 'hw.memsize']))
+    elif platform.system() == 'Windows':
+        import ctypes
+
+        class MEMORYSTATUSEX(ctypes.Structure):
+            _fields_ = [
+                ('dwLength', ctypes.c_ulong),
+                ('dwMemoryLoad', ctypes.c_ulong),
+                ('ullTotalPhys', ctypes.c_ulonglong),
+                ('ullAvailPhys', ctypes.c_ulonglong),
+                ('ullTotalPageFile', ctypes.c_ulonglong),
+                ('ullAvailPageFile', ctypes.c_ulonglong),
+                ('ullTotalVirtual', ctypes.c_ulonglong),
+                ('ullAvailVirtual', ctypes.c_ulonglong),
+                ('ullAvailExtendedVirtual', ctypes.c_ulonglong),
+            ]
+        status = MEMORYSTATUSEX()
+        status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return status.ullAvailPhys
+    return None
+
+
+# CPU 数と空きメモリから ninja の -j, -l と gn の concurrent_links を決める。
+# 引数で明示的に指定された値はそのまま使う。
+# 分散コンパイルを使う場合、リモートのスロット数だけ -j を増やす（リンクはローカルで行うので concurrent_links は増やさない）。
+def get_ninja_jobs(target: str, jobs: Optional[int] = None, link_jobs: Optional[int] = None,
+                   load_average: Optional[float] = None, remote_slots: int = 0,
+                   cc_wrapper: Optional[str] = None) -> NinjaJobs:
+    cpus = os.cpu_count() or 1
+    memory = get_available_memory()
+    compile_gib, link_gib = JOB_MEMORY_PROFILES.get(target, DEFAULT_JOB_MEMORY_PROFILE)
+    memory_gib = memory / (1 << 30) if memory is not None else None
+
+    local_jobs = cpus
+    if memory_gib is not None:
+        local_jobs = max(1, min(local_jobs, int(memory_gib / compile_gib)))
+    if jobs is None:
+        jobs = local_jobs + remote_slots
+    if link_jobs is None:
+        link_jobs = min(jobs, local_jobs)
+        if memory_gib is not None:
+            link_jobs = max(1, min(link_jobs, int(memory_gib / link_gib)))
+    if load_average is None and platform.system() != 'Windows' and remote_slots == 0:
+        # Windows の ninja は -l を正しく扱えないので指定しない。
+        # 分散コンパイル時はローカルの負荷でジョブ数を絞られると困るので指定しない。
+        load_average = float(cpus)
+
+    memory_str = f'{memory_gib:.1f}GiB' if memory_gib is not None else 'unknown'
+    logging.info(f'ninja jobs: cpus={cpus} memory={memory_str} profile={compile_gib}/{link_gib}GiB '
+                 f'remote_slots={remote_slots} => -j {jobs} -l {load_average} concurrent_links={link_jobs}')
+    return NinjaJobs(jobs=jobs, load_average=load_average, link_jobs=link_jobs, cc_wrapper=cc_wrapper)
+
+
+def get_ninja_gn_args(ninja_jobs: Optional[NinjaJobs]) -> List[str]:
+    if ninja_jobs is None:
+        return []
+    gn_args = [f'concurrent_links={ninja_jobs.link_jobs}']
+    if ninja_jobs.cc_wrapper is not None:
+        gn_args.append(f'cc_wrapper="{ninja_jobs.cc_wrapper}"')
+    return gn_args
+
+
+# 分散コンパイル (distcc) のワーカー
+DistccHost = collections.namedtuple('DistccHost', [
+    'host',
+    'port',
+    'slots',
+    'options',
+])
+DISTCC_DEFAULT_PORT = 3632
+DISTCC_DEFAULT_SLOTS = 4
+
+
+# DISTCC_HOSTS と同じ形式 (HOST[:PORT][/LIMIT][,OPTIONS] を空白区切り) をパースする。
+# カンマは lzo や cpp などのオプションの区切りなので、ホストの区切りには使えない
+def parse_distcc_hosts(spec: str) -> List[DistccHost]:
+    hosts = []
+    for entry in spec.split():
+        m = re.match(r'^([^:/,]+)(?::(\d+))?(?:/(\d+))?((?:,[\w\-]+)*)$', entry)
+        if m is None:
+            raise Exception(f'Invalid distcc host: {entry}')
+        hosts.append(DistccHost(
+            host=m.group(1),
+            port=int(m.group(2)) if m.group(2) is not None else DISTCC_DEFAULT_PORT,
+            slots=int(m.group(3)) if m.group(3) is not None else DISTCC_DEFAULT_SLOTS,
+            options=m.group(4)))
+    return hosts
+
+
+def to_distcc_hosts(hosts: List[DistccHost]) -> str:
+    return ' '.join(f'{h.host}:{h.port}/{h.slots}{h.options}' for h in hosts)
+
+
+# distcc はリモートでのコンパイルに失敗するとローカルでコンパイルし直すので、接続できるだけでは分散されているか分からない。
+# フォールバックを無効にして、簡単なソースを実際にリモートでコンパイルできるかを確認する
+def check_distcc_compile(host: DistccHost, compiler: str) -> Optional[str]:
+    with tempfile.TemporaryDirectory(prefix='distcc-check-') as dir:
+        src = os.path.join(dir, 'distcc_check.c')
+        with open(src, 'w') as f:
+            f.write('int distcc_check(void) { return 0; }\n')
+        env = dict(os.environ, DISTCC_HOSTS=to_distcc_hosts([host]), DISTCC_FALLBACK='0', DISTCC_SKIP_LOCAL_RETRY='1')
+        r = cmd(['distcc', compiler, '-c', src, '-o', os.path.join(dir, 'distcc_check.o')],
+                env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding='utf-8', check=False)
+        return None if r.returncode == 0 else r.stdout.strip()
+
+
+def check_distcc_hosts(hosts: List[DistccHost], compiler: str, timeout: float = 3.0):
+    unreachable = []
+    for h in hosts:
+        try:
+            with socket.create_connection((h.host, h.port), timeout=timeout):
+                pass
+        except OSError as e:
+            logging.error(f'distcc: {h.host}:{h.port} is not reachable: {e}')
+            unreachable.append(f'{h.host}:{h.port}')
+            continue
+        error = check_distcc_compile(h, compiler)
+        if error is not None:
+            logging.error(f'distcc: {h.host}:{h.port} failed to compile with {compiler}: {error}')
+            unreachable.append(f'{h.host}:{h.port}')
+            continue
+        logging.info(f'distcc: {h.host}:{h.port} is reachable ({h.slots} slots)')
+    if len(unreachable) != 0:
+        raise Exception(f'distcc hosts not reachable: {", ".join(unreachable)}')
+
+
+# ワーカーの疎通を確認してから DISTCC_HOSTS を設定し、リモートのスロット数の合計を返す
+def setup_distcc(spec: str, compiler: str) -> int:
+    if shutil.which('distcc') is None:
+        raise Exception('distcc not found')
+    hosts = parse_distcc_hosts(spec)
+    if len(hosts) == 0:
+        raise Exception('No distcc hosts specified')
+    check_distcc_hosts(hosts, compiler)
+    os.environ['DISTCC_HOSTS'] = to_distcc_hosts(hosts)
+    return sum(h.slots for h in hosts)
+
+
+# ビルドで使うコンパイラ。WebRTC に同梱されている clang が無ければ、ホストのコンパイラを使う
+def get_distcc_compiler(webrtc_src_dir: str) -> str:
+    path = os.path.join(webrtc_src_dir, 'third_party/llvm-build/Release+Asserts/bin/clang')
+    if os.path.exists(path):
+        return path
+    return shutil.which('clang') or shutil.which('cc') or 'cc'
+
+
+# 同じマシン上で distccd を複数起動して、分散コンパイルの動作確認用のワーカーにする
+def run_distcc_workers(count: int, base_port: int, slots: int, compiler: str):
+    if shutil.which('distccd') is None:
+        raise Exception('distccd not found')
+    # distccd 3.3 以降は /usr/lib/distcc にあるコンパイラしか受け付けないので、
+    # third_party/llvm-build の clang を絶対パスで使えるように --enable-tcp-insecure を指定する。
+    # ループバックでしか待ち受けないので、これで問題ない
+    help = cmd(['distccd', '--help'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+               encoding='utf-8', check=False).stdout
+    insecure = ['--enable-tcp-insecure'] if '--enable-tcp-insecure' in help else []
+    procs = []
+    hosts = []
+    try:
+        for i in range(count):
+            port = base_port + i
+            procs.append(subprocess.Popen([
+                shutil.which('distccd'), '--daemon', '--no-detach', '--log-stderr', *insecure,
+                '--allow', '127.0.0.1/32', '--listen', '127.0.0.1',
+                '--port', str(port), '--jobs', str(slots)]))
+            hosts.append(DistccHost(host='127.0.0.1', port=port, slots=slots, options=''))
+        # 起動を待ってから疎通確認する
+        time.sleep(1)
+        check_distcc_hosts(hosts, compiler)
+        logging.info(f'distcc workers are running. Use --distcc-hosts "{to_distcc_hosts(hosts)}"')
+        for proc in procs:
+            proc.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for proc in procs:
+            if proc.poll() is None:
+                proc.terminate()
+                proc.wait()
+
+
+# ninja の進捗を書き出す JSON Lines のファイル。None の場合は ninja の出力をそのまま端末に出す
+NINJA_PROGRESS_FILE: Optional[str] = None
+
+NINJA_STATUS_RE = re.compile(r'^\[(\d+)/(\d+)\] (.*)$')
+
+
+# .ninja_log から出力ファイルごとの直近のビルド時間 (ms) を読み込む
+def load_ninja_log(work_dir: str) -> Dict[str, int]:
+    durations = {}
+    path = os.path.join(work_dir, '.ninja_log')
+    if not os.path.exists(path):
+        return durations
+    with open(path, encoding='utf-8', errors='replace') as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) != 5:
+                continue
+            durations[fields[4]] = int(fields[1]) - int(fields[0])
+    return durations
+
+
+# 前回のビルド時間から残り時間を見積もる。
+# 終わったステップの出力ファイルを .ninja_log と突き合わせて、残りのステップの平均ビルド時間を求め、
+# それを今回のビルドで実際に出ている並列度で割る。
+class NinjaEta(object):
+    def __init__(self, work_dir: str, jobs: int):
+        self.durations = load_ninja_log(work_dir)
+        self.jobs = jobs
+        self.average = sum(self.durations.values()) / len(self.durations) if self.durations else 0
+        self.unseen_total = sum(self.durations.values())
+        self.unseen_count = len(self.durations)
+        self.done_work = 0
+        self.seen = set()
+
+    def finish(self, description: str):
+        output = description.split(' ')[-1]
+        if output in self.durations and output not in self.seen:
+            self.seen.add(output)
+            self.done_work += self.durations[output]
+            self.unseen_total -= self.durations[output]
+            self.unseen_count -= 1
+        else:
+            self.done_work += self.average
+
+    def estimate(self, finished: int, total: int, elapsed: float) -> Optional[float]:
+        if len(self.durations) == 0:
+            return None
+        average = self.unseen_total / self.unseen_count if self.unseen_count > 0 else self.average
+        remaining_work = (total - finished) * average
+        concurrency = self.done_work / (elapsed * 1000) if elapsed >= 10 and self.done_work > 0 else self.jobs
+        return remaining_work / max(concurrency, 0.1) / 1000
+
+
+# NINJA_STATUS を使って ninja の進捗を読み取り、NINJA_PROGRESS_FILE に JSON Lines で書き出す
+def ninja_build_with_progress(args: List[str], work_dir: str, jobs: int):
+    env = dict(os.environ)
+    env['NINJA_STATUS'] = '[%f/%t] '
+    eta = NinjaEta(work_dir, jobs)
+    start = time.time()
+    last_event = 0
+    with open(NINJA_PROGRESS_FILE, 'a') as progress:
+        def emit(event, finished, total, step):
+            elapsed = time.time() - start
+            progress.write(json.dumps({
+                'event': event,
+                'time': time.time(),
+                'build_dir': work_dir,
+                'finished': finished,
+                'total': total,
+                'percent': 100.0 if event == 'finish' else finished * 100.0 / total if total > 0 else 0.0,
+                'rate': finished / elapsed if elapsed > 0 else 0.0,
+                'elapsed': elapsed,
+                'eta': eta.estimate(finished, total, elapsed),
+                'step': step,
+            }) + '\n')
+            progress.flush()
+
+        finished, total, step = 0, 0, None
+        emit('start', finished, total, step)
+        logging.debug(f'+{args}')
+        with contextlib.ExitStack() as stack:
+            if TELEMETRY is not None:
+                stack.enter_context(TELEMETRY.step(TELEMETRY.step_name(args)))
+            p = subprocess.Popen([shutil.which(args[0]), *args[1:]], env=env, stdout=subprocess.PIPE,
+                                 encoding='utf-8', errors='replace')
+            for line in p.stdout:
+                sys.stdout.write(line)
+                m = NINJA_STATUS_RE.match(line.rstrip('\n'))
+                if m is None:
+                    continue
+                finished, total, step = int(m.group(1)), int(m.group(2)), m.group(3)
+                eta.finish(step)
+                # 書き出しすぎないように 1 秒に 1 回にする
+                if time.time() - last_event >= 1.0:
+                    last_event = time.time()
+                    emit('progress', finished, total, step)
+            returncode = p.wait()
+        emit('finish' if returncode == 0 else 'error', finished, total, step)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, args)
+
+
+def ninja_build(work_dir: str, targets: List[str], ninja_jobs: Optional[NinjaJobs] = None):
+    args = ['ninja', '-C', work_dir]
+    if ninja_jobs is not None:
+        args += ['-j', str(ninja_jobs.jobs)]
+        if ninja_jobs.load_average is not None:
+            args += ['-l', str(ninja_jobs.load_average)]
+    if NINJA_PROGRESS_FILE is not None:
+        ninja_build_with_progress([*args, *targets], work_dir,
+                                  ninja_jobs.jobs if ninja_jobs is not None else os.cpu_count() or 1)
+        return
+    cmd([*args, *targets])
+
+
 def gn_gen(webrtc_src_dir: str, webrtc_build_dir: str, gn_args: List[str], extra_gn_args: str):
     with cd(webrtc_src_dir):
         args = ['gn', 'gen', webrtc_build_dir, '--args=' + to_gn_args(gn_args, extra_gn_args)]
@@ -490,7 +2691,7 @@ def build_webrtc_ios(
         debug=False,
         gen=False, gen_force=False,
         nobuild=False, nobuild_framework=False,
-        overlap_build_dir=False):
+        overlap_build_dir=False, ninja_jobs: Optional[NinjaJobs] = None):
     if webrtc_source_dir is None:
         webrtc_source_dir = os.path.join(source_dir, 'webrtc')
     if webrtc_build_dir is None:
@@ -514,6 +2715,7 @@ def build_webrtc_ios(
         'rtc_enable_objc_symbol_export=true',
         'treat_warnings_as_errors=false',
         *COMMON_GN_ARGS,
+        *get_ninja_gn_args(ninja_jobs),
     ]
 
     # WebRTC.xcframework のビルド
@@ -566,9 +2768,10 @@ def build_webrtc_ios(
             ]
             gn_gen(webrtc_src_dir, work_dir, gn_args, extra_gn_args)
         if not nobuild:
-            cmd(['ninja', '-C', work_dir, *get_build_targets('ios')])
+            ninja_build(work_dir, get_build_targets('ios'), ninja_jobs)
             ar = '/usr/bin/ar'
-            archive_objects(ar, os.path.join(work_dir, 'obj'), os.path.join(work_dir, 'libwebrtc.a'))
+            archive_objects(ar, os.path.join(work_dir, 'obj'), os.path.join(work_dir, 'libwebrtc.a'),
+                            get_build_targets('ios'))
         libs.append(os.path.join(work_dir, 'libwebrtc.a'))
 
     cmd(['lipo', *libs, '-create', '-output', os.path.join(webrtc_build_dir, 'libwebrtc.a')])
@@ -588,7 +2791,8 @@ def build_webrtc_android(
         webrtc_source_dir=None, webrtc_build_dir=None,
         debug=False,
         gen=False, gen_force=False,
-        nobuild=False, nobuild_aar=False):
+        nobuild=False, nobuild_aar=False, ninja_jobs: Optional[NinjaJobs] = None,
+        prune_archive=False, prune_roots: Optional[List[str]] = None, prelink=False):
     if webrtc_source_dir is None:
         webrtc_source_dir = os.path.join(source_dir, 'webrtc')
     if webrtc_build_dir is None:
@@ -615,7 +2819,8 @@ def build_webrtc_android(
     gn_args_base = [
         f"is_debug={'true' if debug else 'false'}",
         f"is_java_debug={'true' if debug else 'false'}",
-        *COMMON_GN_ARGS
+        *COMMON_GN_ARGS,
+        *get_ninja_gn_args(ninja_jobs),
     ]
 
     # aar 生成
@@ -642,9 +2847,69 @@ def build_webrtc_android(
             ]
             gn_gen(webrtc_src_dir, work_dir, gn_args, extra_gn_args)
         if not nobuild:
-            cmd(['ninja', '-C', work_dir, *get_build_targets('android')])
+            ninja_build(work_dir, get_build_targets('android'), ninja_jobs)
             ar = os.path.join(webrtc_src_dir, 'third_party/llvm-build/Release+Asserts/bin/llvm-ar')
-            archive_objects(ar, os.path.join(work_dir, 'obj'), os.path.join(work_dir, 'libwebrtc.a'))
+            archive_objects(ar, os.path.join(work_dir, 'obj'), os.path.join(work_dir, 'libwebrtc.a'),
+                            get_build_targets('android'))
+            if prune_archive or prelink:
+                prune_objects(webrtc_src_dir, work_dir, prune_roots, prelink, get_build_targets('android'))
+
+
+# テストやベンチマークのバイナリをビルドするための gn の引数
+def get_test_gn_args(ninja_jobs: Optional[NinjaJobs] = None, debug=False) -> List[str]:
+    return [
+        f"is_debug={'true' if debug else 'false'}",
+        *[arg for arg in COMMON_GN_ARGS if not arg.startswith('rtc_include_tests=')],
+        'rtc_include_tests=true',
+        *get_ninja_gn_args(ninja_jobs),
+        'target_os="linux"',
+        'rtc_use_pipewire=false',
+    ]
+
+
+PGO_TARGETS = ['ubuntu-20.04_x86_64', 'ubuntu-22.04_x86_64']
+
+# PGO のプロファイルを取るための実行内容。(ninja のターゲット, バイナリ, 引数) の順。
+# コーデック、RTP、輻輳制御、音声処理のテストを実行する。
+PGO_TRAINING_RUNS = [
+    ('modules:modules_unittests', 'modules_unittests', [
+        '--gtest_filter=TestVp8Impl.*:TestVp9Impl.*:LibvpxVp8*:*RtpPacketizer*:RtpVideoSender*:'
+        'GoogCc*:*AudioProcessing*:*Opus*',
+    ]),
+]
+
+
+def get_llvm_profdata(webrtc_src_dir: str) -> str:
+    path = os.path.join(webrtc_src_dir, 'third_party/llvm-build/Release+Asserts/bin/llvm-profdata')
+    if not os.path.exists(path):
+        # llvm-profdata は通常の clang のパッケージに含まれていないので追加で取得する
+        cmd(['python3', os.path.join(webrtc_src_dir, 'tools', 'clang', 'scripts', 'update.py'),
+             '--package=coverage_tools'])
+    return path
+
+
+# 計測用のビルドを行い、トレーニング用のテストを実行してプロファイルを生成する
+def generate_pgo_profile(webrtc_src_dir: str, work_dir: str, output: str, extra_gn_args,
+                         ninja_jobs: Optional[NinjaJobs] = None):
+    build_dir = os.path.join(work_dir, 'instrumented')
+    profraw_dir = os.path.join(work_dir, 'profraw')
+    gn_gen(webrtc_src_dir, build_dir, [*get_test_gn_args(ninja_jobs), 'chrome_pgo_phase=1'], extra_gn_args)
+    ninja_build(build_dir, [target for target, _, _ in PGO_TRAINING_RUNS], ninja_jobs)
+
+    rm_rf(profraw_dir)
+    mkdir_p(profraw_dir)
+    env = dict(os.environ)
+    env['LLVM_PROFILE_FILE'] = os.path.join(profraw_dir, '%p-%m.profraw')
+    for _, binary, args in PGO_TRAINING_RUNS:
+        # 失敗するテストがあってもプロファイルは取れるので終了コードは見ない
+        with cd(webrtc_src_dir):
+            cmd([os.path.join(build_dir, binary), *args], env=env, check=False, resolve=False)
+
+    profraws = [os.path.join(profraw_dir, f) for f in os.listdir(profraw_dir) if f.endswith('.profraw')]
+    if len(profraws) == 0:
+        raise Exception('No profile data was generated by the training runs')
+    cmd([get_llvm_profdata(webrtc_src_dir), 'merge', '-o', output, *profraws], resolve=False)
+    logging.info(f'PGO profile: {output} ({len(profraws)} raw profiles)')
 
 
 def build_webrtc(
@@ -652,7 +2917,9 @@ def build_webrtc(
         webrtc_source_dir=None, webrtc_build_dir=None,
         debug=False,
         gen=False, gen_force=False,
-        nobuild=False, nobuild_macos_framework=False):
+        nobuild=False, nobuild_macos_framework=False, ninja_jobs: Optional[NinjaJobs] = None,
+        prune_archive=False, prune_roots: Optional[List[str]] = None, prelink=False,
+        pgo=False, pgo_profile: Optional[str] = None):
     if webrtc_source_dir is None:
         webrtc_source_dir = os.path.join(source_dir, 'webrtc')
     if webrtc_build_dir is None:
@@ -660,15 +2927,34 @@ def build_webrtc(
 
     webrtc_src_dir = os.path.join(webrtc_source_dir, 'src')
 
+    # PGO のプロファイルもビルドディレクトリに置くので、先に削除しておく
+    if gen_force:
+        rm_rf(webrtc_build_dir)
     mkdir_p(webrtc_build_dir)
 
+    # PGO: 計測用ビルドでプロファイルを取ってから、そのプロファイルを使ってビルドする
+    if pgo or pgo_profile is not None:
+        if target not in PGO_TARGETS:
+            raise Exception(f'PGO is not supported on {target}')
+        profile = os.path.join(webrtc_build_dir, 'webrtc.profdata')
+        if pgo_profile is not None:
+            if os.path.abspath(pgo_profile) != profile:
+                shutil.copyfile(pgo_profile, profile)
+        elif not nobuild:
+            generate_pgo_profile(webrtc_src_dir, os.path.join(build_dir, 'pgo'), profile,
+                                 extra_gn_args, ninja_jobs)
+        if not os.path.exists(profile):
+            raise Exception(f'PGO profile {profile} not found. '
+                            'Build without --webrtc-nobuild or specify --webrtc-pgo-profile')
+        # プロファイルが変わると gn の引数も変わるので常に gn gen する
+        gen = True
+
     # ビルド
-    if gen_force:
-        rm_rf(webrtc_build_dir)
     if not os.path.exists(os.path.join(webrtc_build_dir, 'args.gn')) or gen:
         gn_args = [
             f"is_debug={'true' if debug else 'false'}",
             *COMMON_GN_ARGS,
+            *get_ninja_gn_args(ninja_jobs),
         ]
         if target in ['windows_x86_64', 'windows_arm64']:
             gn_args += [
@@ -720,6 +3006,11 @@ def build_webrtc(
                 'target_os="linux"',
                 'rtc_use_pipewire=false',
             ]
+            if pgo or pgo_profile is not None:
+                gn_args += [
+                    'chrome_pgo_phase=2',
+                    f'pgo_data_path="{os.path.join(webrtc_build_dir, "webrtc.profdata")}"',
+                ]
         else:
             raise Exception(f'Target {target} is not supported')
 
@@ -728,7 +3019,7 @@ def build_webrtc(
     if nobuild:
         return
 
-    cmd(['ninja', '-C', webrtc_build_dir, *get_build_targets(target)])
+    ninja_build(webrtc_build_dir, get_build_targets(target), ninja_jobs)
     if target in ['windows_x86_64', 'windows_arm64']:
         pass
     elif target in ('macos_arm64',):
@@ -738,7 +3029,15 @@ def build_webrtc(
 
     # ar で libwebrtc.a を生成する
     if target not in ['windows_x86_64', 'windows_arm64']:
-        archive_objects(ar, os.path.join(webrtc_build_dir, 'obj'), os.path.join(webrtc_build_dir, 'libwebrtc.a'))
+        archive_objects(ar, os.path.join(webrtc_build_dir, 'obj'), os.path.join(webrtc_build_dir, 'libwebrtc.a'),
+                        get_build_targets(target))
+
+    # 公開 API から到達できないオブジェクトファイルを取り除いたライブラリを生成する
+    if prune_archive or prelink:
+        if target in ['windows_x86_64', 'windows_arm64', 'macos_arm64']:
+            logging.warning(f'--webrtc-prune-archive is not supported on {target}, skipped')
+        else:
+            prune_objects(webrtc_src_dir, webrtc_build_dir, prune_roots, prelink, get_build_targets(target))
 
     # macOS の場合は WebRTC.framework に追加情報を入れる
     if (target in ('macos_arm64',)) and not nobuild_macos_framework:
@@ -767,8 +3066,344 @@ def build_webrtc(
              '-output', os.path.join(webrtc_build_dir, 'WebRTC.xcframework')])
 
 
-def copy_headers(webrtc_src_dir, webrtc_package_dir, target):
-    if target in ['windows_x86_64', 'windows_arm64']:
+# コンパイル時間の計測。
+# compiler_timing=true で clang に -ftime-trace を付けると、オブジェクトファイルの隣に
+# Chrome のトレース形式の JSON が出力されるので、これを集計する。
+COMPILE_PROFILE_GN_ARGS = 'compiler_timing=true'
+COMPILE_PROFILE_TOP = 50
+
+
+# 以前に --webrtc-profile-compile でビルドしたビルドディレクトリか。
+# iOS や Android はアーキテクチャごとのサブディレクトリに args.gn がある
+def has_compile_profile_args(webrtc_build_dir: str) -> bool:
+    if not os.path.isdir(webrtc_build_dir):
+        return False
+    dirs = [webrtc_build_dir, *[e.path for e in os.scandir(webrtc_build_dir) if e.is_dir()]]
+    for dir in dirs:
+        args_gn = os.path.join(dir, 'args.gn')
+        if os.path.exists(args_gn):
+            with open(args_gn) as f:
+                if re.search(r'\bcompiler_timing\s*=\s*true\b', f.read()):
+                    return True
+    return False
+
+
+def find_time_traces(webrtc_build_dir: str):
+    for root, dirs, files in os.walk(webrtc_build_dir):
+        parts = os.path.relpath(root, webrtc_build_dir).split(os.sep)
+        if 'obj' not in parts:
+            continue
+        # コンパイル時のカレントディレクトリ（obj の親）
+        ninja_dir = os.path.join(webrtc_build_dir, *parts[:parts.index('obj')])
+        names = set(files)
+        for file in files:
+            stem, ext = os.path.splitext(file)
+            if ext == '.json' and (f'{stem}.o' in names or f'{stem}.obj' in names):
+                yield ninja_dir, os.path.join(root, file)
+
+
+def summarize_time_trace(path: str):
+    with open(path) as f:
+        events = json.load(f).get('traceEvents', [])
+    totals = {}
+    sources = []
+    instantiations = []
+    for ev in events:
+        if ev.get('ph') != 'X':
+            continue
+        name = ev.get('name', '')
+        dur = ev.get('dur', 0)
+        if name.startswith('Total '):
+            totals[name[len('Total '):]] = dur
+        elif name == 'Source':
+            sources.append((ev['args']['detail'], dur))
+        elif name in ('InstantiateClass', 'InstantiateFunction'):
+            instantiations.append((ev['args']['detail'], dur))
+    return totals, sources, instantiations
+
+
+def add_profile_entry(entries: Dict[str, List[int]], key: str, dur: int):
+    entry = entries.setdefault(key, [0, 0])
+    entry[0] += dur
+    entry[1] += 1
+
+
+def top_profile_entries(entries: Dict[str, List[int]], top: int, **extra):
+    return [{'name': k, 'time_ms': v[0] // 1000, 'count': v[1], **{n: f(k) for n, f in extra.items()}}
+            for k, v in sorted(entries.items(), key=lambda x: -x[1][0])[:top]]
+
+
+# -ftime-trace の結果を集計して、重いヘッダー、テンプレートのインスタンス化、
+# フロントエンドとバックエンドの時間をレポートにする。
+# ヘッダーの時間はそのヘッダーからインクルードしたものも含む。
+def generate_compile_profile(webrtc_src_dir: str, webrtc_build_dir: str, patch_dir: str, target: str,
+                             output: str, top: int = COMPILE_PROFILE_TOP):
+    patched = {}
+    for patch in PATCHES[target]:
+        for file in get_patch_target_files(patch_dir, patch):
+            patched.setdefault(file.replace(os.sep, '/'), []).append(patch)
+
+    headers = {}
+    instantiations = {}
+    templates = {}
+    units = {}
+    phases = {}
+    for ninja_dir, path in find_time_traces(webrtc_build_dir):
+        try:
+            totals, sources, insts = summarize_time_trace(path)
+        except (ValueError, KeyError) as e:
+            logging.warning(f'Failed to read {path}: {e}')
+            continue
+        for phase in ('ExecuteCompiler', 'Frontend', 'Backend'):
+            phases[phase] = phases.get(phase, 0) + totals.get(phase, 0)
+        unit = os.path.splitext(os.path.relpath(path, webrtc_build_dir))[0].replace(os.sep, '/')
+        units[unit] = [totals.get('ExecuteCompiler', 0), 1]
+        for detail, dur in sources:
+            header = os.path.normpath(os.path.join(ninja_dir, detail))
+            if header.startswith(webrtc_src_dir + os.sep):
+                header = os.path.relpath(header, webrtc_src_dir)
+            add_profile_entry(headers, header.replace(os.sep, '/'), dur)
+        for detail, dur in insts:
+            add_profile_entry(instantiations, detail, dur)
+            add_profile_entry(templates, detail.split('<', 1)[0], dur)
+
+    if len(units) == 0:
+        logging.warning(f'No time trace found in {webrtc_build_dir}')
+        return None
+
+    report = {
+        'units': len(units),
+        'time_ms': {k: v // 1000 for k, v in phases.items()},
+        'slowest_units': top_profile_entries(units, top),
+        'headers': top_profile_entries(headers, top, patches=lambda k: patched.get(k, [])),
+        'patched_headers': top_profile_entries({k: v for k, v in headers.items() if k in patched}, top,
+                                               patches=lambda k: patched[k]),
+        'templates': top_profile_entries(templates, top),
+        'instantiations': top_profile_entries(instantiations, top),
+    }
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    total = max(phases.get('ExecuteCompiler', 0), 1)
+    logging.info(f'Compile profile: {len(units)} units, total {phases.get("ExecuteCompiler", 0) / 1e6:.1f}s, '
+                 f'frontend {phases.get("Frontend", 0) / total * 100:.1f}%, '
+                 f'backend {phases.get("Backend", 0) / total * 100:.1f}%')
+    for h in report['headers'][:20]:
+        mark = f' (patched: {", ".join(h["patches"])})' if h['patches'] else ''
+        logging.info(f'  {h["time_ms"] / 1000:8.1f}s {h["count"]:6d}x {h["name"]}{mark}')
+    logging.info(f'Compile profile written to {output}')
+    return report
+
+
+BENCH_TARGETS = ['ubuntu-20.04_x86_64', 'ubuntu-22.04_x86_64']
+
+# ベンチマーク。(名前, ninja のターゲット, バイナリ, 引数) の順。
+# ユニットテストではなく、WebRTC の性能計測用のテストを使う。
+BENCH_SUITES = [
+    # libvpx の VP8/VP9 で実際の映像をエンコード・デコードする
+    ('video_codec', 'modules/video_coding:video_codec_perf_tests', 'video_codec_perf_tests', [
+        '--gtest_filter=VideoCodecTestLibvpx.*',
+    ]),
+    # 各音声コーデックのエンコード・デコード速度
+    ('audio_codec', 'modules/audio_coding:audio_codec_speed_tests', 'audio_codec_speed_tests', []),
+    # APM (エコーキャンセラ、ノイズ抑制、AGC) の処理時間。計測用のテストは DISABLED_ になっているので明示的に実行する
+    ('audio_processing', 'modules/audio_processing:audio_processing_perf_tests', 'audio_processing_perf_tests', [
+        '--gtest_also_run_disabled_tests',
+    ]),
+    # RTP パケタイザ専用のベンチマークは WebRTC に無いので、各コーデックのパケタイザのテストを繰り返し実行する
+    ('rtp_packetizer', 'modules:modules_unittests', 'modules_unittests', [
+        '--gtest_filter=*RtpPacketizer*',
+        '--gtest_repeat=200',
+    ]),
+    # 送信から受信までの映像パイプライン全体（キャプチャ、エンコード、RTP、輻輳制御、デコード）
+    ('full_stack', 'webrtc_perf_tests', 'webrtc_perf_tests', [
+        '--gtest_filter=FullStackTest.Foreman_Cif_Net_Delay_0_0_Plr_0*',
+        '--nologs',
+    ]),
+]
+
+
+def run_bench_suite(binary: str, args: List[str], output_json: str):
+    start_times = os.times()
+    start = time.time()
+    r = cmd([binary, *args, f'--gtest_output=json:{output_json}'], check=False, resolve=False)
+    elapsed = time.time() - start
+    end_times = os.times()
+    cpu = (end_times.children_user - start_times.children_user) + \
+        (end_times.children_system - start_times.children_system)
+    tests = {}
+    if os.path.exists(output_json):
+        with open(output_json) as f:
+            for suite in json.load(f).get('testsuites', []):
+                for test in suite.get('testsuite', []):
+                    tests[f"{suite['name']}.{test['name']}"] = float(test.get('time', '0s').rstrip('s'))
+    return {'returncode': r.returncode, 'wall_time': elapsed, 'cpu_time': cpu, 'tests': tests}
+
+
+# テストを有効にしたビルドでベンチマークを実行し、結果を WEBRTC_BUILD_VERSION ごとに保存する
+def bench_webrtc(webrtc_src_dir: str, work_dir: str, results_dir: str, version_info: VersionInfo,
+                 suites: Optional[List[str]] = None, repeat=3, gen=False, debug=False,
+                 ninja_jobs: Optional[NinjaJobs] = None):
+    suites = [s for s in BENCH_SUITES if suites is None or len(suites) == 0 or s[0] in suites]
+    if not os.path.exists(os.path.join(work_dir, 'args.gn')) or gen:
+        gn_gen(webrtc_src_dir, work_dir, get_test_gn_args(ninja_jobs, debug), '')
+    ninja_build(work_dir, sorted(set(target for _, target, _, _ in suites)), ninja_jobs)
+
+    results = {}
+    tmp = os.path.join(work_dir, 'bench_output.json')
+    for name, _, binary, args in suites:
+        runs = []
+        for _ in range(repeat):
+            with cd(webrtc_src_dir):
+                runs.append(run_bench_suite(os.path.join(work_dir, binary), args, tmp))
+        runs.sort(key=lambda r: r['cpu_time'])
+        # 中央値の回を結果とする
+        results[name] = {**runs[len(runs) // 2], 'runs': [{'wall_time': r['wall_time'], 'cpu_time': r['cpu_time']}
+                                                          for r in runs]}
+    rm_rf(tmp)
+
+    mkdir_p(results_dir)
+    result_file = os.path.join(results_dir, f'{version_info.webrtc_build_version}.json')
+    previous = None
+    files = [f for f in os.listdir(results_dir) if f.endswith('.json') and
+             os.path.join(results_dir, f) != result_file]
+    if len(files) != 0:
+        previous = max(files, key=lambda f: os.path.getmtime(os.path.join(results_dir, f)))
+        with open(os.path.join(results_dir, previous)) as f:
+            previous_results = json.load(f)['suites']
+    with open(result_file, 'w') as f:
+        json.dump({
+            'webrtc_build_version': version_info.webrtc_build_version,
+            'webrtc_commit': version_info.webrtc_commit,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'suites': results,
+        }, f, indent=2)
+
+    for name, r in results.items():
+        line = f'{name:20} cpu {r["cpu_time"]:8.2f}s  wall {r["wall_time"]:8.2f}s'
+        if previous is not None and name in previous_results:
+            base = previous_results[name]['cpu_time']
+            if base > 0:
+                line += f'  ({(r["cpu_time"] - base) / base * 100:+.1f}% vs {previous[:-5]})'
+        if r['returncode'] != 0:
+            line += f'  [exit {r["returncode"]}]'
+        logging.info(line)
+    logging.info(f'Benchmark results are written to {result_file}')
+
+
+# 公開 API のヘッダーファイルの起点になるディレクトリ
+HEADER_ROOT_DIRS = ['api', 'sdk', 'pc']
+
+# #include を解決する時に探すディレクトリ (src からの相対パス)
+HEADER_INCLUDE_DIRS = [
+    '.',
+    'sdk/objc',
+    'third_party/abseil-cpp',
+    'third_party/boringssl/src/include',
+    'third_party/jsoncpp/source/include',
+    'third_party/libyuv/include',
+    'third_party/libvpx/source/libvpx',
+    'third_party/opus/src/include',
+    'third_party/perfetto/include',
+    'third_party/protobuf/src',
+]
+
+HEADER_EXTENSIONS = ('.h', '.hpp')
+INCLUDE_RE = re.compile(rb'^\s*#\s*(?:include|import)\s*[<"]([^>"]+)[>"]', re.MULTILINE)
+
+
+# パッチの内容に応じて変わるキャッシュのキーに使うハッシュ
+def get_patch_set_hash(patch_dir: str, target: str) -> str:
+    h = hashlib.sha256()
+    for patch in PATCHES[target]:
+        h.update(patch.encode('utf-8') + b'\0')
+        h.update(repr(PATCH_INFO.get(patch, (1, ['.']))).encode('utf-8') + b'\0')
+        with open(os.path.join(patch_dir, patch), 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def resolve_include(webrtc_src_dir: str, includer: str, include: str) -> Optional[str]:
+    candidates = [os.path.join(os.path.dirname(includer), include)]
+    candidates += [os.path.join(dir, include) for dir in HEADER_INCLUDE_DIRS]
+    for candidate in candidates:
+        candidate = os.path.normpath(candidate).replace(os.sep, '/')
+        if candidate.startswith('../'):
+            continue
+        if os.path.isfile(os.path.join(webrtc_src_dir, candidate)):
+            return candidate
+    return None
+
+
+# ビルド対象に設定されているターゲットの sources と public に含まれるヘッダーファイル
+def get_target_headers(webrtc_src_dir: str, build_dir: str, targets: List[str]) -> List[str]:
+    headers = []
+    for target in targets:
+        label = target if target.startswith('//') else '//' + target
+        r = cmd(['gn', 'desc', build_dir, label, '--format=json'], cwd=webrtc_src_dir,
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='utf-8', check=False)
+        if r.returncode != 0:
+            logging.warning(f'gn desc {label} failed, skipping its headers')
+            continue
+        for desc in json.loads(r.stdout).values():
+            for path in [*desc.get('sources', []), *desc.get('public', [])]:
+                if path.startswith('//') and path.endswith(HEADER_EXTENSIONS):
+                    headers.append(path[2:])
+    return headers
+
+
+# 公開 API のヘッダーファイルから #include を辿って、到達可能なヘッダーファイルを全て返す。
+# ファイルごとの #include の解決結果はソースのリビジョンとパッチをキーにしてキャッシュする。
+def collect_reachable_headers(webrtc_src_dir: str, roots: List[str], cache_file: Optional[str]) -> List[str]:
+    graph = {}
+    if cache_file is not None and os.path.exists(cache_file):
+        with open(cache_file) as f:
+            graph = json.load(f)
+    cached = len(graph)
+
+    queue = []
+    for root in roots:
+        path = os.path.join(webrtc_src_dir, root)
+        if os.path.isfile(path):
+            queue.append(root)
+            continue
+        for file in enum_all_files(path, webrtc_src_dir):
+            if file.endswith(HEADER_EXTENSIONS):
+                queue.append(file.replace(os.sep, '/'))
+
+    reachable = set()
+    while queue:
+        header = queue.pop()
+        if header in reachable:
+            continue
+        reachable.add(header)
+        if header not in graph:
+            with open(os.path.join(webrtc_src_dir, header), 'rb') as f:
+                includes = INCLUDE_RE.findall(f.read())
+            graph[header] = sorted(set(filter(None, (
+                resolve_include(webrtc_src_dir, header, include.decode('utf-8', errors='replace'))
+                for include in includes))))
+        for include in graph[header]:
+            if include.endswith(HEADER_EXTENSIONS) and include not in reachable:
+                queue.append(include)
+
+    if cache_file is not None and len(graph) != cached:
+        mkdir_p(os.path.dirname(cache_file))
+        with open(cache_file, 'w') as f:
+            json.dump(graph, f)
+    logging.info(f'Reachable headers: {len(reachable)} ({len(graph) - cached} files scanned)')
+    return sorted(reachable)
+
+
+def copy_headers(webrtc_src_dir, webrtc_package_dir, target, headers='all',
+                 header_roots: Optional[List[str]] = None, cache_file: Optional[str] = None):
+    if headers == 'reachable':
+        roots = [*HEADER_ROOT_DIRS, *(header_roots or [])]
+        for header in collect_reachable_headers(webrtc_src_dir, roots, cache_file):
+            dst = os.path.join(webrtc_package_dir, 'include', *header.split('/'))
+            mkdir_p(os.path.dirname(dst))
+            shutil.copy2(os.path.join(webrtc_src_dir, header), dst)
+    elif target in ['windows_x86_64', 'windows_arm64']:
         # robocopy の戻り値は特殊なので、check=False にしてうまくエラーハンドリングする
         # https://docs.microsoft.com/ja-jp/troubleshoot/windows-server/backup-and-storage/return-codes-used-robocopy-utility
         r = cmd(['robocopy', webrtc_src_dir, os.path.join(webrtc_package_dir, 'include'),
@@ -805,6 +3440,312 @@ def generate_version_info(webrtc_src_dir, webrtc_package_dir):
         f.writelines(map(lambda x: (x + '\n').encode('utf-8'), lines))
 
 
+# サイズレポートでセクションを分類するカテゴリ
+SIZE_CATEGORIES = ['text', 'data', 'bss', 'debug', 'other']
+
+# ディレクトリごとに集計する時のディレクトリの深さ
+SIZE_REPORT_DIR_DEPTH = 2
+
+COFF_MACHINES = (0x14c, 0x1c4, 0x8664, 0xaa64)
+
+
+def new_size_sections():
+    return {c: 0 for c in SIZE_CATEGORIES}
+
+
+def elf_section_sizes(buf, offset: int, size: int) -> Dict[str, int]:
+    sections = new_size_sections()
+    is64 = buf[offset + 4] == 2
+    e = '<' if buf[offset + 5] == 1 else '>'
+    if is64:
+        shoff, = struct.unpack_from(e + 'Q', buf, offset + 0x28)
+        shentsize, shnum, shstrndx = struct.unpack_from(e + 'HHH', buf, offset + 0x3A)
+        shfmt = e + 'IIQQQQI'
+    else:
+        shoff, = struct.unpack_from(e + 'I', buf, offset + 0x20)
+        shentsize, shnum, shstrndx = struct.unpack_from(e + 'HHH', buf, offset + 0x2E)
+        shfmt = e + 'IIIIIII'
+    if shoff == 0:
+        sections['other'] = size
+        return sections
+    headers = []
+    first = struct.unpack_from(shfmt, buf, offset + shoff)
+    # セクション数が多い場合は 0 番目のセクションヘッダーに書かれている
+    if shnum == 0:
+        shnum = first[5]
+    if shstrndx == 0xffff:
+        shstrndx = first[6]
+    # 壊れている・途中で切れているオブジェクト
+    if shstrndx >= shnum:
+        sections['other'] = size
+        return sections
+    for i in range(shnum):
+        headers.append(struct.unpack_from(shfmt, buf, offset + shoff + i * shentsize))
+    strtab_offset = offset + headers[shstrndx][4]
+    accounted = 0
+    for name_offset, type, flags, _, sh_offset, sh_size, _ in headers[1:]:
+        end = buf.find(b'\0', strtab_offset + name_offset)
+        name = bytes(buf[strtab_offset + name_offset:end]).decode('utf-8', errors='replace')
+        if type == 8:  # SHT_NOBITS
+            sections['bss'] += sh_size
+            continue
+        if name.startswith(('.debug', '.zdebug')):
+            category = 'debug'
+        elif flags & 0x4:  # SHF_EXECINSTR
+            category = 'text'
+        elif flags & 0x2:  # SHF_ALLOC
+            category = 'data'
+        else:
+            category = 'other'
+        sections[category] += sh_size
+        accounted += sh_size
+    sections['other'] += max(0, size - accounted)
+    return sections
+
+
+def macho_section_sizes(buf, offset: int, size: int) -> Dict[str, int]:
+    sections = new_size_sections()
+    ncmds, = struct.unpack_from('<I', buf, offset + 16)
+    pos = offset + 32
+    accounted = 0
+    for _ in range(ncmds):
+        lc, lcsize = struct.unpack_from('<II', buf, pos)
+        if lc == 0x19:  # LC_SEGMENT_64
+            segname = bytes(buf[pos + 8:pos + 24]).rstrip(b'\0')
+            nsects, = struct.unpack_from('<I', buf, pos + 64)
+            for i in range(nsects):
+                sect = pos + 72 + i * 80
+                sect_size, = struct.unpack_from('<Q', buf, sect + 40)
+                flags, = struct.unpack_from('<I', buf, sect + 64)
+                if flags & 0xff in (0x1, 0xc, 0x12):  # S_ZEROFILL, S_GB_ZEROFILL, S_THREAD_LOCAL_ZEROFILL
+                    sections['bss'] += sect_size
+                    continue
+                if segname == b'__DWARF':
+                    category = 'debug'
+                elif flags & 0x80000400:  # S_ATTR_PURE_INSTRUCTIONS, S_ATTR_SOME_INSTRUCTIONS
+                    category = 'text'
+                else:
+                    category = 'data'
+                sections[category] += sect_size
+                accounted += sect_size
+        pos += lcsize
+    sections['other'] += max(0, size - accounted)
+    return sections
+
+
+def coff_section_sizes(buf, offset: int, size: int, bigobj: bool) -> Dict[str, int]:
+    sections = new_size_sections()
+    if bigobj:
+        nsections, = struct.unpack_from('<I', buf, offset + 44)
+        pos = offset + 56
+    else:
+        nsections, = struct.unpack_from('<H', buf, offset + 2)
+        optsize, = struct.unpack_from('<H', buf, offset + 16)
+        pos = offset + 20 + optsize
+    accounted = 0
+    for i in range(nsections):
+        sect = pos + i * 40
+        name = bytes(buf[sect:sect + 8]).rstrip(b'\0')
+        raw_size, = struct.unpack_from('<I', buf, sect + 16)
+        flags, = struct.unpack_from('<I', buf, sect + 36)
+        if name.startswith(b'.debug'):
+            category = 'debug'
+        elif flags & 0x20000020:  # IMAGE_SCN_CNT_CODE, IMAGE_SCN_MEM_EXECUTE
+            category = 'text'
+        elif flags & 0x80 and raw_size == 0:  # IMAGE_SCN_CNT_UNINITIALIZED_DATA
+            category = 'bss'
+        elif flags & 0xc0:
+            category = 'data'
+        else:
+            category = 'other'
+        sections[category] += raw_size
+        accounted += raw_size
+    sections['other'] += max(0, size - accounted)
+    return sections
+
+
+# オブジェクトファイル、共有ライブラリ、実行ファイルのセクションのサイズをカテゴリごとに集計する
+def object_section_sizes(buf, offset: int, size: int) -> Dict[str, int]:
+    magic = bytes(buf[offset:offset + 4])
+    try:
+        if magic == b'\x7fELF':
+            return elf_section_sizes(buf, offset, size)
+        if magic == b'\xcf\xfa\xed\xfe':
+            return macho_section_sizes(buf, offset, size)
+        if magic == b'\xca\xfe\xba\xbe':
+            # Universal Binary は含まれる全てのアーキテクチャの合計にする
+            sections = new_size_sections()
+            narchs, = struct.unpack_from('>I', buf, offset + 4)
+            for i in range(narchs):
+                arch_offset, arch_size = struct.unpack_from('>II', buf, offset + 8 + i * 20 + 8)
+                for k, v in object_section_sizes(buf, offset + arch_offset, arch_size).items():
+                    sections[k] += v
+            return sections
+        sig1, sig2, machine = struct.unpack_from('<HHH', buf, offset)
+        if sig1 == 0 and sig2 == 0xffff and struct.unpack_from('<H', buf, offset + 6)[0] in COFF_MACHINES:
+            return coff_section_sizes(buf, offset, size, True)
+        if sig1 in COFF_MACHINES:
+            return coff_section_sizes(buf, offset, size, False)
+    except (struct.error, IndexError):
+        pass
+    sections = new_size_sections()
+    sections['other'] = size
+    return sections
+
+
+# ar 形式のアーカイブのメンバーを (名前, オフセット, サイズ) で列挙する。GNU 形式と BSD 形式に対応する。
+def enum_ar_members(buf):
+    pos = 8
+    long_names = b''
+    while pos + 60 <= len(buf):
+        header = bytes(buf[pos:pos + 60])
+        name = header[0:16].rstrip(b' ')
+        size = int(header[48:58].strip() or b'0')
+        data = pos + 60
+        pos = data + size + (size & 1)
+        if name == b'//':
+            long_names = bytes(buf[data:data + size])
+            continue
+        if name in (b'/', b'/SYM64/', b'__.SYMDEF', b'__.SYMDEF SORTED') or name.startswith(b'__.SYMDEF'):
+            continue
+        if name.startswith(b'#1/'):
+            name_len = int(name[3:])
+            name = bytes(buf[data:data + name_len]).rstrip(b'\0')
+            data += name_len
+            size -= name_len
+            if name.startswith(b'__.SYMDEF'):
+                continue
+        elif name.startswith(b'/') and name[1:].isdigit():
+            start = int(name[1:])
+            name = long_names[start:long_names.index(b'\n', start)].rstrip(b'/')
+        else:
+            name = name.rstrip(b'/')
+        yield name.decode('utf-8', errors='replace'), data, size
+
+
+# オブジェクトファイルのファイル名とサイズから、ビルドディレクトリの obj 以下のパスを引けるようにする。
+# ar のメンバー名にはディレクトリが含まれないので、ソースのディレクトリを知るために使う。
+def build_object_map(obj_dir: Optional[str]):
+    objects = {}
+    if obj_dir is None or not os.path.isdir(obj_dir):
+        return objects
+    for root, _, files in os.walk(obj_dir):
+        for file in files:
+            if file.endswith(('.o', '.obj')):
+                path = os.path.join(root, file)
+                objects.setdefault((file, os.path.getsize(path)), os.path.relpath(path, obj_dir).replace(os.sep, '/'))
+    return objects
+
+
+def add_size_sections(dst: Dict[str, int], src: Dict[str, int]):
+    for k, v in src.items():
+        dst[k] = dst.get(k, 0) + v
+
+
+def analyze_binary(buf, size: int, obj_dir: Optional[str] = None):
+    if bytes(buf[:8]) != b'!<arch>\n':
+        return {'size': size, 'sections': object_section_sizes(buf, 0, size)}
+
+    objects = build_object_map(obj_dir)
+    sections = new_size_sections()
+    directories = {}
+    members = []
+    for name, offset, member_size in enum_ar_members(buf):
+        member_sections = object_section_sizes(buf, offset, member_size)
+        add_size_sections(sections, member_sections)
+        path = objects.get((name, member_size))
+        directory = '/'.join(path.split('/')[:-1][:SIZE_REPORT_DIR_DEPTH]) or '.' if path is not None else '(unknown)'
+        d = directories.setdefault(directory, {'size': 0, 'members': 0, 'sections': new_size_sections()})
+        d['size'] += member_size
+        d['members'] += 1
+        add_size_sections(d['sections'], member_sections)
+        members.append({'name': path or name, 'size': member_size, 'sections': member_sections})
+    members.sort(key=lambda m: m['size'], reverse=True)
+    return {
+        'size': size,
+        'sections': sections,
+        'members': len(members),
+        'directories': dict(sorted(directories.items(), key=lambda d: d[1]['size'], reverse=True)),
+        'largest_members': members[:50],
+    }
+
+
+BINARY_MAGICS = (b'!<arch>\n', b'\x7fELF', b'\xcf\xfa\xed\xfe', b'\xca\xfe\xba\xbe')
+
+
+# パッケージに含まれるライブラリのサイズを、アーカイブのメンバー、ソースのディレクトリ、セクションごとに集計する。
+# obj_dirs はパッケージ内のパスから、そのライブラリを作ったビルドディレクトリの obj へのマップ。
+def generate_size_report(webrtc_package_dir: str, output: str, obj_dirs: Dict[str, str]):
+    report = {}
+    for file in sorted(enum_all_files(webrtc_package_dir, webrtc_package_dir)):
+        path = os.path.join(webrtc_package_dir, file)
+        name = file.replace(os.sep, '/')
+        if os.path.islink(path) or os.path.getsize(path) < 8:
+            continue
+        with open(path, 'rb') as f:
+            magic = f.read(8)
+            if file.endswith('.aar'):
+                # aar に含まれる共有ライブラリ
+                with zipfile.ZipFile(f) as z:
+                    for info in z.infolist():
+                        if info.filename.endswith('.so'):
+                            data = z.read(info)
+                            report[f'{name}!{info.filename}'] = analyze_binary(data, len(data))
+                continue
+            if not magic.startswith(BINARY_MAGICS):
+                continue
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                report[name] = analyze_binary(buf, len(buf), obj_dirs.get(name))
+    with open(output, 'w') as f:
+        json.dump({'files': report}, f, indent=2)
+    for name, r in report.items():
+        logging.info(f'{name}: {r["size"] >> 10}KiB ' +
+                     ', '.join(f'{k}={v >> 10}KiB' for k, v in r['sections'].items()))
+    return report
+
+
+def format_size_delta(old: int, new: int) -> str:
+    if old == 0:
+        return f'{new - old:+,d} bytes (new)'
+    return f'{new - old:+,d} bytes ({(new - old) / old * 100:+.2f}%)'
+
+
+# 2 つのサイズレポートを比較して、閾値を超えて大きくなったものを表示する。大きくなったものがあれば False を返す。
+def compare_size_reports(old_file: str, new_file: str, threshold: float, min_bytes: int) -> bool:
+    with open(old_file) as f:
+        old = json.load(f)['files']
+    with open(new_file) as f:
+        new = json.load(f)['files']
+
+    def grown(old_size, new_size):
+        return new_size - old_size >= min_bytes and \
+            (old_size == 0 or (new_size - old_size) / old_size * 100 >= threshold)
+
+    ok = True
+    for name in sorted(set(old) | set(new)):
+        if name not in new:
+            print(f'{name}: removed')
+            continue
+        if name not in old:
+            print(f'{name}: added ({new[name]["size"]:,d} bytes)')
+            continue
+        o, n = old[name], new[name]
+        flagged = grown(o['size'], n['size'])
+        ok = ok and not flagged
+        print(f'{"!" if flagged else " "} {name}: {format_size_delta(o["size"], n["size"])}')
+        for category in SIZE_CATEGORIES:
+            os_, ns = o['sections'].get(category, 0), n['sections'].get(category, 0)
+            if os_ != ns:
+                print(f'{"!" if grown(os_, ns) else " "}     {category}: {format_size_delta(os_, ns)}')
+        od, nd = o.get('directories', {}), n.get('directories', {})
+        for directory in sorted(set(od) | set(nd)):
+            os_ = od.get(directory, {'size': 0})['size']
+            ns = nd.get(directory, {'size': 0})['size']
+            if grown(os_, ns):
+                print(f'!     {directory}/: {format_size_delta(os_, ns)}')
+    return ok
+
+
 def generate_deps_info(webrtc_src_dir, webrtc_package_dir):
     shutil.copyfile('DEPS', os.path.join(webrtc_package_dir, 'DEPS'))
     with cd(os.path.join(webrtc_src_dir, 'tools_webrtc', 'ios')):
@@ -816,9 +3757,223 @@ def generate_deps_info(webrtc_src_dir, webrtc_package_dir):
         f.write(f'IOS_DEPLOYMENT_TARGET={ios_deployment_target}\n'.encode('utf-8'))
 
 
+# インデックス付き tar.gz の 1 つの gzip メンバーに入れるデータサイズの目安
+ARCHIVE_INDEX_MEMBER_SIZE = 4 * 1024 * 1024
+
+
+# ファイルをいくつかずつ別々の gzip メンバーに圧縮した tar.gz と、各ファイルの位置を記録したインデックスを書き出す。
+# gzip は複数のメンバーを連結したものも 1 つのストリームとして扱うので、通常の tar.gz としてもそのまま展開できる。
+# インデックスがあれば、必要なファイルを含むメンバーだけをシークして展開できる。
+def write_indexed_tar(archive: str, files: List[str], member_size: int = ARCHIVE_INDEX_MEMBER_SIZE):
+    members = []
+    entries = []
+    tar = tarfile.TarFile(fileobj=io.BytesIO(), mode='w')
+    with open(archive, 'wb') as f:
+        z = None
+        member_start = 0
+        member_offset = 0
+
+        def finish_member():
+            nonlocal z
+            f.write(z.flush())
+            members.append({'offset': member_start, 'length': f.tell() - member_start, 'size': member_offset})
+            z = None
+
+        for file in files:
+            info = tar.gettarinfo(name=file, arcname=file)
+            header = info.tobuf(tarfile.DEFAULT_FORMAT, tarfile.ENCODING, 'surrogateescape')
+            # 大きいファイルは単独のメンバーにする
+            size = len(header) + (info.size if info.isreg() else 0)
+            if z is not None and (member_offset >= member_size or size >= member_size):
+                finish_member()
+            if z is None:
+                z = zlib.compressobj(9, zlib.DEFLATED, 31)
+                member_start = f.tell()
+                member_offset = 0
+
+            f.write(z.compress(header))
+            member_offset += len(header)
+            entry = {'name': file.replace(os.sep, '/'), 'member': len(members), 'offset': member_offset,
+                     'size': info.size if info.isreg() else 0, 'mode': info.mode, 'mtime': int(info.mtime)}
+            if info.issym():
+                entry['linkname'] = info.linkname
+            entries.append(entry)
+            if info.isreg():
+                with open(file, 'rb') as src:
+                    for chunk in iter(lambda: src.read(1024 * 1024), b''):
+                        f.write(z.compress(chunk))
+                padding = -info.size % tarfile.BLOCKSIZE
+                f.write(z.compress(tarfile.NUL * padding))
+                member_offset += info.size + padding
+        if z is not None:
+            finish_member()
+
+        # tar の終端
+        member_start = f.tell()
+        z = zlib.compressobj(9, zlib.DEFLATED, 31)
+        member_offset = tarfile.BLOCKSIZE * 2
+        f.write(z.compress(tarfile.NUL * member_offset))
+        finish_member()
+
+    with open(f'{archive}.index.json', 'w') as f:
+        json.dump({'version': 1, 'archive': os.path.basename(archive),
+                   'members': members, 'files': entries}, f, indent=2)
+    logging.info(f'Wrote {archive}: {len(entries)} files in {len(members)} gzip members')
+
+
+# 並列に圧縮する時のチャンクサイズ
+ZIP_CHUNK_SIZE = 4 * 1024 * 1024
+ZIP64_LIMIT = 0xffffffff
+
+
+# チャンクを raw deflate で圧縮する。直前のチャンクの末尾 32KiB を辞書にすることで、
+# チャンクを独立して圧縮しても圧縮率がほとんど落ちないようにしている。
+# 最後以外のチャンクは Z_SYNC_FLUSH でバイト境界に揃えて終わるので、そのまま連結すれば 1 つの deflate ストリームになる。
+def deflate_chunk(data: bytes, zdict: Optional[bytes], last: bool, level: int) -> bytes:
+    if zdict:
+        z = zlib.compressobj(level, zlib.DEFLATED, -15, 9, zlib.Z_DEFAULT_STRATEGY, zdict)
+    else:
+        z = zlib.compressobj(level, zlib.DEFLATED, -15, 9, zlib.Z_DEFAULT_STRATEGY)
+    return z.compress(data) + z.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+# zip ファイルを書き出す。各ファイルをチャンクに分けて複数のスレッドで並列に deflate 圧縮し、順番通りに書き込む。
+# ローカルファイルヘッダーの CRC とサイズは書き込んだ後にシークして埋める。4GiB を超える場合は ZIP64 にする。
+# level=0 の場合は圧縮せずに格納する。
+def write_parallel_zip(archive: str, files: List[str], level: int = 6, workers: Optional[int] = None):
+    if workers is None:
+        workers = os.cpu_count() or 1
+    method = zipfile.ZIP_DEFLATED if level > 0 else zipfile.ZIP_STORED
+    # zipfile と同じく、Windows で作った場合は MS-DOS 形式の属性にする
+    create_system = 0 if platform.system() == 'Windows' else 3
+    entries = []
+
+    def chunks(path):
+        with open(path, 'rb') as f:
+            data = f.read(ZIP_CHUNK_SIZE)
+            zdict = None
+            while True:
+                next_data = f.read(ZIP_CHUNK_SIZE)
+                yield data, zdict, len(next_data) == 0
+                if len(next_data) == 0:
+                    return
+                zdict = data[-32768:]
+                data = next_data
+
+    with open(archive, 'wb') as out, concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        for file in files:
+            st = os.stat(file)
+            name = file.replace(os.sep, '/')
+            encoded = name.encode('utf-8')
+            flags = 0x800 if not name.isascii() else 0
+            mtime = time.localtime(st.st_mtime)
+            dostime = mtime.tm_hour << 11 | mtime.tm_min << 5 | mtime.tm_sec // 2
+            dosdate = max(mtime.tm_year - 1980, 0) << 9 | mtime.tm_mon << 5 | mtime.tm_mday
+            # 圧縮後のサイズは書き込むまで分からないので、大きいファイルは最初から ZIP64 にしておく
+            zip64 = st.st_size >= ZIP64_LIMIT - ZIP_CHUNK_SIZE
+            offset = out.tell()
+            extra = struct.pack('<HHQQ', 1, 16, 0, 0) if zip64 else b''
+            out.write(struct.pack('<IHHHHHIIIHH', 0x04034b50, 45 if zip64 else 20, flags, method,
+                                  dostime, dosdate, 0, 0, 0, len(encoded), len(extra)))
+            out.write(encoded)
+            out.write(extra)
+
+            crc = 0
+            compressed_size = 0
+            # 先読みしすぎてメモリを使いすぎないように、同時に圧縮するチャンク数を制限する
+            pending = collections.deque()
+
+            def write_front():
+                nonlocal crc, compressed_size
+                data, future = pending.popleft()
+                crc = zlib.crc32(data, crc)
+                compressed = future.result() if future is not None else data
+                out.write(compressed)
+                compressed_size += len(compressed)
+
+            for data, zdict, last in chunks(file):
+                future = executor.submit(deflate_chunk, data, zdict, last, level) if level > 0 else None
+                pending.append((data, future))
+                if len(pending) >= workers * 2:
+                    write_front()
+            while pending:
+                write_front()
+
+            if compressed_size >= ZIP64_LIMIT and not zip64:
+                raise Exception(f'{file}: compressed size exceeds 4GiB without ZIP64')
+            end = out.tell()
+            out.seek(offset + 14)
+            if zip64:
+                out.write(struct.pack('<III', crc, 0xffffffff, 0xffffffff))
+                out.seek(offset + 30 + len(encoded) + 4)
+                out.write(struct.pack('<QQ', st.st_size, compressed_size))
+            else:
+                out.write(struct.pack('<III', crc, compressed_size, st.st_size))
+            out.seek(end)
+            entries.append((encoded, flags, dostime, dosdate, crc, compressed_size, st.st_size, offset, st.st_mode))
+
+        # セントラルディレクトリ
+        cd_offset = out.tell()
+        for encoded, flags, dostime, dosdate, crc, compressed_size, size, offset, mode in entries:
+            values = []
+            if size >= ZIP64_LIMIT or compressed_size >= ZIP64_LIMIT:
+                values += [size, compressed_size]
+                size = compressed_size = 0xffffffff
+            if offset >= ZIP64_LIMIT:
+                values.append(offset)
+                offset = 0xffffffff
+            extra = struct.pack(f'<HH{len(values)}Q', 1, 8 * len(values), *values) if values else b''
+            version = 45 if values else 20
+            out.write(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, create_system << 8 | version, version,
+                                  flags, method, dostime, dosdate, crc, compressed_size, size,
+                                  len(encoded), len(extra), 0, 0, 0,
+                                  (mode & 0xffff) << 16 if create_system == 3 else 0, offset))
+            out.write(encoded)
+            out.write(extra)
+        cd_end = out.tell()
+        cd_size = cd_end - cd_offset
+        count = len(entries)
+        if count > 0xffff or cd_offset >= ZIP64_LIMIT or cd_size >= ZIP64_LIMIT:
+            # ZIP64 のエンドレコードとロケーター
+            out.write(struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0, count, count, cd_size, cd_offset))
+            out.write(struct.pack('<IIQI', 0x07064b50, 0, cd_end, 1))
+            out.write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, min(count, 0xffff), min(count, 0xffff),
+                                  min(cd_size, 0xffffffff), min(cd_offset, 0xffffffff), 0))
+        else:
+            out.write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, count, count, cd_size, cd_offset, 0))
+    logging.info(f'Wrote {archive}: {len(entries)} files (level={level})')
+
+
+# ライセンスファイルはソースのリビジョン、パッチ、ビルド対象、gn の引数だけで決まるので、それらをキーにしてキャッシュする
+# ビルドの並列度や計測のための gn の引数。NOTICE の内容には影響しないので、ライセンスのキャッシュのキーからは除く。
+# concurrent_links は gn gen した時の空きメモリで変わるので、これを含めると毎回キャッシュが外れてしまう
+LICENSE_CACHE_IGNORED_GN_ARGS = ['concurrent_links', 'cc_wrapper', 'compiler_timing']
+LICENSE_CACHE_IGNORED_GN_ARGS_RE = re.compile(
+    r'\b(?:' + '|'.join(LICENSE_CACHE_IGNORED_GN_ARGS) + r')\s*=\s*(?:"[^"]*"|\S+)')
+
+
+def get_license_cache_key(webrtc_src_dir: str, patch_dir: str, target: str, build_dirs: List[str]) -> str:
+    h = hashlib.sha256()
+    h.update(cmdcap(['git', '-C', webrtc_src_dir, 'rev-parse', 'HEAD']).encode('utf-8') + b'\0')
+    h.update(get_patch_set_hash(patch_dir, target).encode('utf-8') + b'\0')
+    for t in get_build_targets(target):
+        h.update(t.encode('utf-8') + b'\0')
+    for dir in build_dirs:
+        args_gn = os.path.join(dir, 'args.gn')
+        h.update(os.path.basename(dir).encode('utf-8') + b'\0')
+        if os.path.exists(args_gn):
+            with open(args_gn, encoding='utf-8') as f:
+                args = LICENSE_CACHE_IGNORED_GN_ARGS_RE.sub('', f.read())
+            h.update(' '.join(args.split()).encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
 def package_webrtc(source_dir, build_dir, package_dir, target,
                    webrtc_source_dir=None, webrtc_build_dir=None, webrtc_package_dir=None,
-                   overlap_ios_build_dir=False):
+                   overlap_ios_build_dir=False, patch_dir=None, cache_dir=None,
+                   headers='all', header_roots: Optional[List[str]] = None, archive_index=False,
+                   zip_level=6):
     if webrtc_source_dir is None:
         webrtc_source_dir = os.path.join(source_dir, 'webrtc')
     if webrtc_build_dir is None:
@@ -851,15 +4006,34 @@ def package_webrtc(source_dir, build_dir, package_dir, target,
                 dirs.append(os.path.join(webrtc_build_dir, device, arch))
     else:
         dirs = [webrtc_build_dir]
-    ts = []
-    for t in get_build_targets(target):
-        ts += ['--target', t]
-    cmd(['python3', os.path.join(webrtc_src_dir, 'tools_webrtc', 'libs', 'generate_licenses.py'),
-        *ts, webrtc_package_dir, *dirs])
-    os.rename(os.path.join(webrtc_package_dir, 'LICENSE.md'), os.path.join(webrtc_package_dir, 'NOTICE'))
+    notice_cache_file = None
+    if cache_dir is not None and patch_dir is not None:
+        key = get_license_cache_key(webrtc_src_dir, patch_dir, target, dirs)
+        notice_cache_file = os.path.join(cache_dir, 'licenses', f'{key}.md')
+    if notice_cache_file is not None and os.path.exists(notice_cache_file):
+        logging.info(f'Using cached NOTICE: {notice_cache_file}')
+        shutil.copyfile(notice_cache_file, os.path.join(webrtc_package_dir, 'NOTICE'))
+    else:
+        ts = []
+        for t in get_build_targets(target):
+            ts += ['--target', t]
+        cmd(['python3', os.path.join(webrtc_src_dir, 'tools_webrtc', 'libs', 'generate_licenses.py'),
+            *ts, webrtc_package_dir, *dirs])
+        os.rename(os.path.join(webrtc_package_dir, 'LICENSE.md'), os.path.join(webrtc_package_dir, 'NOTICE'))
+        if notice_cache_file is not None:
+            mkdir_p(os.path.dirname(notice_cache_file))
+            shutil.copyfile(os.path.join(webrtc_package_dir, 'NOTICE'), notice_cache_file)
 
     # ヘッダーファイルをコピー
-    copy_headers(webrtc_src_dir, webrtc_package_dir, target)
+    header_cache_file = None
+    if headers == 'reachable':
+        header_roots = [*(header_roots or []), *get_target_headers(webrtc_src_dir, dirs[0], get_build_targets(target))]
+        if cache_dir is not None and patch_dir is not None:
+            revision = cmdcap(['git', '-C', webrtc_src_dir, 'rev-parse', 'HEAD'])
+            header_cache_file = os.path.join(cache_dir, 'header_graph',
+                                             f'{revision}-{get_patch_set_hash(patch_dir, target)[:16]}.json')
+    copy_headers(webrtc_src_dir, webrtc_package_dir, target, headers=headers,
+                 header_roots=header_roots, cache_file=header_cache_file)
 
     # バージョン情報
     generate_version_info(webrtc_src_dir, webrtc_package_dir)
@@ -900,10 +4074,20 @@ def package_webrtc(source_dir, build_dir, package_dir, target,
         ]
         for arch in ANDROID_ARCHS:
             files.append(([arch, 'libwebrtc.a'], ['lib', arch, 'libwebrtc.a']))
+            # --webrtc-prune-archive, --webrtc-prelink を指定してビルドした場合
+            for name in ['libwebrtc.pruned.a', 'libwebrtc.o']:
+                if os.path.exists(os.path.join(webrtc_build_dir, arch, name)):
+                    files.append(([arch, name], ['lib', arch, name]))
     else:
         files = [
             (['libwebrtc.a'], ['lib', 'libwebrtc.a']),
         ]
+        for name in ['libwebrtc.pruned.a', 'libwebrtc.o']:
+            if os.path.exists(os.path.join(webrtc_build_dir, name)):
+                files.append(([name], ['lib', name]))
+        # PGO でビルドした場合はプロファイルも含める
+        if os.path.exists(os.path.join(webrtc_build_dir, 'webrtc.profdata')):
+            files.append((['webrtc.profdata'], ['pgo', 'webrtc.profdata']))
     for src, dst in files:
         dstpath = os.path.join(webrtc_package_dir, *dst)
         mkdir_p(os.path.dirname(dstpath))
@@ -913,12 +4097,20 @@ def package_webrtc(source_dir, build_dir, package_dir, target,
         else:
             shutil.copy2(os.path.join(webrtc_build_dir, *src), dstpath)
 
+    # サイズレポート
+    obj_dirs = {}
+    for src, dst in files:
+        if dst[-1].endswith(('.a', '.lib')):
+            dir = os.path.join(webrtc_build_dir, *src[:-1])
+            obj_dirs['/'.join(dst)] = dir if os.path.basename(dir) == 'obj' else os.path.join(dir, 'obj')
+    generate_size_report(webrtc_package_dir, os.path.join(package_dir, 'size_report.json'), obj_dirs)
+
     # 圧縮
     with cd(package_dir):
         if target in ['windows_x86_64', 'windows_arm64']:
-            with zipfile.ZipFile(f'webrtc.{target}.zip', 'w') as f:
-                for file in enum_all_files('webrtc', '.'):
-                    f.write(filename=file, arcname=file)
+            write_parallel_zip(f'webrtc.{target}.zip', list(enum_all_files('webrtc', '.')), level=zip_level)
+        elif archive_index:
+            write_indexed_tar(f'webrtc.{target}.tar.gz', sorted(enum_all_files('webrtc', '.')))
         else:
             with tarfile.open(f'webrtc.{target}.tar.gz', 'w:gz') as f:
                 for file in enum_all_files('webrtc', '.'):
@@ -1002,6 +4194,8 @@ def main():
             - gen-force 系: 既存のビルドディレクトリは完全に削除してから gn gen をやり直す
             - nobuild 系: ビルドを行わない
     """
+    global TELEMETRY, NINJA_PROGRESS_FILE, BACKGROUND_REMOVER
+
     parser = argparse.ArgumentParser()
     sp = parser.add_subparsers()
     bp = sp.add_parser('build')
@@ -1011,18 +4205,40 @@ def main():
     bp.add_argument("--source-dir")
     bp.add_argument("--build-dir")
     bp.add_argument("--rootfs-fetch-force", action='store_true')
+    bp.add_argument("--rootfs-builder", choices=['multistrap', 'builtin'], default='multistrap')
+    bp.add_argument("--rootfs-mirror")
     bp.add_argument('--depottools-fetch', action='store_true')
     bp.add_argument("--webrtc-fetch", action='store_true')
     bp.add_argument("--webrtc-fetch-force", action='store_true')
+    bp.add_argument("--webrtc-fetch-mode", choices=WEBRTC_FETCH_MODES, default='full')
+    bp.add_argument("--webrtc-prune-deps", action='store_true')
+    bp.add_argument("--webrtc-snapshot", action='store_true')
+    bp.add_argument("--webrtc-snapshot-dir")
+    bp.add_argument("--webrtc-snapshot-budget", type=float, default=100.0, help='GiB')
     bp.add_argument("--webrtc-gen", action='store_true')
     bp.add_argument("--webrtc-gen-force", action='store_true')
     bp.add_argument("--webrtc-extra-gn-args", default='')
     bp.add_argument("--webrtc-nobuild", action='store_true')
     bp.add_argument("--webrtc-nobuild-ios-framework", action='store_true')
     bp.add_argument("--webrtc-nobuild-android-aar", action='store_true')
+    bp.add_argument("--webrtc-prune-archive", action='store_true')
+    bp.add_argument("--webrtc-prune-root", action='append', default=[])
+    bp.add_argument("--webrtc-prelink", action='store_true')
+    bp.add_argument("--webrtc-pgo", action='store_true')
+    bp.add_argument("--webrtc-pgo-profile")
+    bp.add_argument("--webrtc-profile-compile", action='store_true')
     bp.add_argument("--webrtc-overlap-ios-build-dir", action='store_true')
     bp.add_argument("--webrtc-build-dir")
     bp.add_argument("--webrtc-source-dir")
+    bp.add_argument("--jobs", type=int)
+    bp.add_argument("--link-jobs", type=int)
+    bp.add_argument("--load-average", type=float)
+    bp.add_argument("--distcc-hosts")
+    bp.add_argument("--telemetry", action='store_true')
+    bp.add_argument("--telemetry-interval", type=float, default=1.0)
+    bp.add_argument("--progress-file")
+    bp.add_argument("--async-delete", action='store_true')
+    bp.add_argument("--async-delete-detach", action='store_true')
     # 現在 build と package を分ける意味は無いのだけど、
     # 今後複数のビルドを纏めてパッケージングする時に備えて別コマンドにしておく
     pp = sp.add_parser('package')
@@ -1036,20 +4252,141 @@ def main():
     pp.add_argument("--webrtc-source-dir")
     pp.add_argument("--webrtc-package-dir")
     pp.add_argument("--webrtc-overlap-ios-build-dir", action='store_true')
+    pp.add_argument("--headers", choices=['all', 'reachable'], default='all')
+    pp.add_argument("--headers-root", action='append', default=[])
+    pp.add_argument("--archive-index", action='store_true')
+    pp.add_argument("--zip-level", type=int, choices=range(10), default=6)
+    pp.add_argument("--async-delete", action='store_true')
+    pp.add_argument("--async-delete-detach", action='store_true')
+    cp = sp.add_parser('check-patches')
+    cp.set_defaults(op='check-patches')
+    cp.add_argument("targets", nargs='*', metavar='target', help=f'one of {", ".join(TARGETS)} (default: all)')
+    cp.add_argument("--webrtc-source-dir")
+    cp.add_argument("--jobs", type=int)
+    rp = sp.add_parser('rebase-patches')
+    rp.set_defaults(op='rebase-patches')
+    rp.add_argument("commit")
+    rp.add_argument("--webrtc-source-dir")
+    rp.add_argument("--output-dir")
+    gp = sp.add_parser('gclient-profile')
+    gp.set_defaults(op='gclient-profile')
+    gp.add_argument("targets", nargs='*', metavar='target', help=f'one of {", ".join(TARGETS)}')
+    gp.add_argument("--summary", action='store_true')
+    gp.add_argument("--debug", action='store_true')
+    gp.add_argument("--webrtc-source-dir")
+    gp.add_argument("--webrtc-build-dir")
+    benchp = sp.add_parser('bench')
+    benchp.set_defaults(op='bench')
+    benchp.add_argument("target", choices=BENCH_TARGETS)
+    benchp.add_argument("--debug", action='store_true')
+    benchp.add_argument("--source-dir")
+    benchp.add_argument("--build-dir")
+    benchp.add_argument("--webrtc-source-dir")
+    benchp.add_argument("--webrtc-build-dir")
+    benchp.add_argument("--webrtc-gen", action='store_true')
+    benchp.add_argument("--suite", action='append', default=[], choices=[s[0] for s in BENCH_SUITES])
+    benchp.add_argument("--repeat", type=int, default=3)
+    benchp.add_argument("--jobs", type=int)
+    sizep = sp.add_parser('size-compare')
+    sizep.set_defaults(op='size-compare')
+    sizep.add_argument("old_report")
+    sizep.add_argument("new_report")
+    sizep.add_argument("--threshold", type=float, default=1.0, help='percent')
+    sizep.add_argument("--min-bytes", type=int, default=16 * 1024)
+    gcp = sp.add_parser('gc')
+    gcp.set_defaults(op='gc')
+    gcp.add_argument("--jobs", type=int, default=8)
+    dp = sp.add_parser('distcc-workers')
+    dp.set_defaults(op='distcc-workers')
+    dp.add_argument("--count", type=int, default=2)
+    dp.add_argument("--base-port", type=int, default=DISTCC_DEFAULT_PORT)
+    dp.add_argument("--slots", type=int, default=DISTCC_DEFAULT_SLOTS)
+    dp.add_argument("--compiler", help='compiler used to check the workers (default: clang or cc on PATH)')
     args = parser.parse_args()
 
     if not hasattr(args, 'op'):
         parser.error('Required subcommand')
 
+    if args.op == 'gc':
+        gc_trash(args.jobs)
+        return
+    if args.op == 'size-compare':
+        if not compare_size_reports(args.old_report, args.new_report, args.threshold, args.min_bytes):
+            sys.exit(1)
+        return
+    if args.op == 'distcc-workers':
+        run_distcc_workers(args.count, args.base_port, args.slots,
+                           args.compiler or shutil.which('clang') or shutil.which('cc') or 'cc')
+        return
+
+    if args.op == 'gclient-profile':
+        for target in args.targets:
+            if target not in TARGETS:
+                parser.error(f'invalid target: {target}')
+        if args.summary:
+            print_gclient_profile_summary(args.targets if len(args.targets) != 0 else TARGETS)
+            return
+        for target in args.targets:
+            configuration = 'debug' if args.debug else 'release'
+            webrtc_source_dir = os.path.join(BASE_DIR, '_source', target, 'webrtc')
+            webrtc_build_dir = os.path.join(BASE_DIR, '_build', target, configuration, 'webrtc')
+            if args.webrtc_source_dir is not None:
+                webrtc_source_dir = os.path.abspath(args.webrtc_source_dir)
+            if args.webrtc_build_dir is not None:
+                webrtc_build_dir = os.path.abspath(args.webrtc_build_dir)
+            add_path(os.path.join(os.path.dirname(webrtc_source_dir), 'depot_tools'))
+            profile = generate_gclient_profile(webrtc_source_dir, webrtc_build_dir, target)
+            logging.info(f'{target}: {len(profile["custom_deps"])} deps pruned, '
+                         f'{profile["total_bytes"] >> 20}MiB saved')
+        return
+
+    if args.op == 'rebase-patches':
+        if args.webrtc_source_dir is not None:
+            webrtc_src_dir = os.path.join(os.path.abspath(args.webrtc_source_dir), 'src')
+        else:
+            webrtc_src_dir = find_webrtc_src_dir(TARGETS)
+        if webrtc_src_dir is None:
+            raise Exception('WebRTC source not found. Run build first or specify --webrtc-source-dir')
+        output_dir = args.output_dir or os.path.join(BASE_DIR, '_rebase', args.commit)
+        results = rebase_patches(os.path.join(BASE_DIR, 'patches'), webrtc_src_dir, args.commit,
+                                 os.path.abspath(output_dir), TARGETS)
+        for r in results:
+            logging.info(f'{r.status:8} {r.patch} ({", ".join(r.targets)})')
+            for file in r.conflicts:
+                logging.info(f'         conflict: {file}')
+        logging.info(f'Rebased patch drafts and status.json are written to {output_dir}')
+        return
+
+    if args.op == 'check-patches':
+        for target in args.targets:
+            if target not in TARGETS:
+                parser.error(f'invalid target: {target}')
+        targets = args.targets if len(args.targets) != 0 else TARGETS
+        if args.webrtc_source_dir is not None:
+            webrtc_src_dir = os.path.join(os.path.abspath(args.webrtc_source_dir), 'src')
+        else:
+            webrtc_src_dir = find_webrtc_src_dir([*targets, *TARGETS])
+        if webrtc_src_dir is None:
+            raise Exception('WebRTC source not found. Run build first or specify --webrtc-source-dir')
+        logging.info(f'Checking patches against {webrtc_src_dir}')
+        if not check_patches(os.path.join(BASE_DIR, 'patches'), webrtc_src_dir, targets, args.jobs):
+            sys.exit(1)
+        return
+
     if not check_target(args.target):
         raise Exception(f'Target {args.target} is not supported on your platform')
 
+    if args.op in ('build', 'package') and (args.async_delete or args.async_delete_detach):
+        BACKGROUND_REMOVER = BackgroundRemover(detach=args.async_delete_detach)
+        atexit.register(BACKGROUND_REMOVER.close)
+
     configuration = 'debug' if args.debug else 'release'
 
     source_dir = os.path.join(BASE_DIR, '_source', args.target)
     build_dir = os.path.join(BASE_DIR, '_build', args.target, configuration)
     package_dir = os.path.join(BASE_DIR, '_package', args.target)
     patch_dir = os.path.join(BASE_DIR, 'patches')
+    cache_dir = os.path.join(BASE_DIR, '_cache')
 
     if args.source_dir is not None:
         source_dir = os.path.abspath(args.source_dir)
@@ -1058,6 +4395,11 @@ def main():
 
     webrtc_source_dir = os.path.abspath(args.webrtc_source_dir) if args.webrtc_source_dir is not None else None
     webrtc_build_dir = os.path.abspath(args.webrtc_build_dir) if args.webrtc_build_dir is not None else None
+    if args.op == 'build':
+        pgo_profile = os.path.abspath(args.webrtc_pgo_profile) if args.webrtc_pgo_profile is not None else None
+        rootfs_mirror = os.path.abspath(args.rootfs_mirror) if args.rootfs_mirror is not None else None
+        snapshot_dir = os.path.abspath(args.webrtc_snapshot_dir) if args.webrtc_snapshot_dir is not None \
+            else os.path.join(BASE_DIR, '_snapshots')
 
     if args.op == 'package':
         if args.package_dir is not None:
@@ -1096,10 +4438,24 @@ def main():
         mkdir_p(source_dir)
         mkdir_p(build_dir)
 
+        if args.telemetry:
+            if ResourceSampler.available():
+                TELEMETRY = ResourceSampler(os.path.join(build_dir, 'telemetry'), build_dir, args.target,
+                                            interval=args.telemetry_interval)
+                TELEMETRY.start()
+                atexit.register(TELEMETRY.stop)
+            else:
+                logging.warning('Telemetry: /proc is not available on this platform, sampling is disabled')
+
+        if args.progress_file is not None:
+            NINJA_PROGRESS_FILE = os.path.abspath(args.progress_file)
+
         with cd(BASE_DIR):
             if args.target in MULTISTRAP_CONFIGS:
                 sysroot = os.path.join(source_dir, 'rootfs')
-                init_rootfs(sysroot, MULTISTRAP_CONFIGS[args.target], args.rootfs_fetch_force)
+                init_rootfs(sysroot, MULTISTRAP_CONFIGS[args.target], args.rootfs_fetch_force,
+                            builder=args.rootfs_builder,
+                            mirror=rootfs_mirror, cache_dir=cache_dir)
 
             dir = get_depot_tools(source_dir, fetch=args.depottools_fetch)
             add_path(dir)
@@ -1107,9 +4463,35 @@ def main():
                 cmd(['git', 'config', '--global', 'core.longpaths', 'true'])
 
             # ソース取得
-            get_webrtc(source_dir, patch_dir, version_info.webrtc_commit, args.target,
-                       webrtc_source_dir=webrtc_source_dir,
-                       fetch=args.webrtc_fetch, force=args.webrtc_fetch_force)
+            snapshot_key = None
+            restored = False
+            if args.webrtc_snapshot and version_info.webrtc_commit != 'HEAD':
+                snapshot_source_dir = webrtc_source_dir or os.path.join(source_dir, 'webrtc')
+                profile = load_gclient_profile(args.target) if args.webrtc_prune_deps else None
+                snapshot_key = get_snapshot_key(patch_dir, version_info.webrtc_commit, args.target,
+                                                args.webrtc_fetch_mode, profile)
+                if args.webrtc_fetch or args.webrtc_fetch_force or \
+                        not os.path.exists(os.path.join(snapshot_source_dir, 'src')):
+                    restored = restore_webrtc_snapshot(snapshot_dir, snapshot_key, snapshot_source_dir, patch_dir,
+                                                       version_info.webrtc_commit, args.target,
+                                                       args.webrtc_fetch_mode)
+            if not restored:
+                get_webrtc(source_dir, patch_dir, version_info.webrtc_commit, args.target,
+                           webrtc_source_dir=webrtc_source_dir,
+                           fetch=args.webrtc_fetch, force=args.webrtc_fetch_force,
+                           fetch_mode=args.webrtc_fetch_mode, prune_deps=args.webrtc_prune_deps)
+                if snapshot_key is not None:
+                    save_webrtc_snapshot(snapshot_dir, snapshot_key, snapshot_source_dir, patch_dir,
+                                         version_info.webrtc_commit, args.target,
+                                         int(args.webrtc_snapshot_budget * (1 << 30)))
+
+            # ソースの取得後に、ビルドで使う clang で distcc のワーカーを確認する
+            remote_slots = 0
+            cc_wrapper = None
+            if args.distcc_hosts is not None:
+                src_dir = os.path.join(webrtc_source_dir or os.path.join(source_dir, 'webrtc'), 'src')
+                remote_slots = setup_distcc(args.distcc_hosts, get_distcc_compiler(src_dir))
+                cc_wrapper = 'distcc'
 
             # ビルド
             build_webrtc_args = {
@@ -1124,25 +4506,71 @@ def main():
                 'gen': args.webrtc_gen,
                 'gen_force': args.webrtc_gen_force,
                 'nobuild': args.webrtc_nobuild,
+                'ninja_jobs': get_ninja_jobs(args.target, jobs=args.jobs, link_jobs=args.link_jobs,
+                                             load_average=args.load_average, remote_slots=remote_slots,
+                                             cc_wrapper=cc_wrapper),
+            }
+            if args.webrtc_profile_compile:
+                build_webrtc_args['extra_gn_args'] = to_gn_args([COMPILE_PROFILE_GN_ARGS], args.webrtc_extra_gn_args)
+                build_webrtc_args['gen'] = True
+            elif has_compile_profile_args(webrtc_build_dir or os.path.join(build_dir, 'webrtc')):
+                # 計測をやめた時に -ftime-trace が残らないように gn gen し直す
+                logging.info('Regenerating build files to disable compiler_timing')
+                build_webrtc_args['gen'] = True
+            prune_args = {
+                'prune_archive': args.webrtc_prune_archive,
+                'prune_roots': args.webrtc_prune_root,
+                'prelink': args.webrtc_prelink,
             }
             # iOS と Android は特殊すぎるので別枠行き
             if args.target == 'ios':
+                if args.webrtc_prune_archive or args.webrtc_prelink:
+                    logging.warning('--webrtc-prune-archive is not supported on ios, skipped')
                 build_webrtc_ios(**build_webrtc_args,
                                  nobuild_framework=args.webrtc_nobuild_ios_framework,
                                  overlap_build_dir=args.webrtc_overlap_ios_build_dir)
             elif args.target == 'android':
-                build_webrtc_android(**build_webrtc_args, nobuild_aar=args.webrtc_nobuild_android_aar)
+                build_webrtc_android(**build_webrtc_args, **prune_args, nobuild_aar=args.webrtc_nobuild_android_aar)
             else:
-                build_webrtc(**build_webrtc_args, target=args.target)
+                build_webrtc(**build_webrtc_args, **prune_args, target=args.target,
+                             pgo=args.webrtc_pgo, pgo_profile=pgo_profile)
+
+            if args.webrtc_profile_compile and not args.webrtc_nobuild:
+                profile_build_dir = webrtc_build_dir or os.path.join(build_dir, 'webrtc')
+                generate_compile_profile(os.path.join(webrtc_source_dir or os.path.join(source_dir, 'webrtc'), 'src'),
+                                         profile_build_dir, patch_dir, args.target,
+                                         os.path.join(profile_build_dir, 'compile_profile.json'))
+
+    if args.op == 'bench':
+        if webrtc_source_dir is None:
+            webrtc_source_dir = os.path.join(source_dir, 'webrtc')
+        webrtc_src_dir = os.path.join(webrtc_source_dir, 'src')
+        if not os.path.exists(webrtc_src_dir):
+            raise Exception('WebRTC source not found. Run build first')
+        with cd(BASE_DIR):
+            add_path(os.path.join(source_dir, 'depot_tools'))
+            # リリースに使うビルドディレクトリとは別のディレクトリでビルドする
+            bench_build_dir = webrtc_build_dir if webrtc_build_dir is not None else os.path.join(build_dir, 'bench')
+            # デバッグビルドの結果はリリースビルドの結果と比較しない
+            results_dir = os.path.join(BASE_DIR, '_bench', args.target, *(['debug'] if args.debug else []))
+            bench_webrtc(webrtc_src_dir, bench_build_dir, results_dir, version_info,
+                         suites=args.suite, repeat=args.repeat, gen=args.webrtc_gen, debug=args.debug,
+                         ninja_jobs=get_ninja_jobs(args.target, jobs=args.jobs))
 
     if args.op == 'package':
         mkdir_p(package_dir)
         with cd(BASE_DIR):
+            if args.headers == 'reachable':
+                # gn desc を使うので depot_tools にパスを通す
+                add_path(os.path.join(source_dir, 'depot_tools'))
             package_webrtc(source_dir, build_dir, package_dir, args.target,
                            webrtc_source_dir=webrtc_source_dir,
                            webrtc_build_dir=webrtc_build_dir,
                            webrtc_package_dir=webrtc_package_dir,
-                           overlap_ios_build_dir=args.webrtc_overlap_ios_build_dir)
+                           overlap_ios_build_dir=args.webrtc_overlap_ios_build_dir,
+                           patch_dir=patch_dir, cache_dir=cache_dir,
+                           headers=args.headers, header_roots=args.headers_root,
+                           archive_index=args.archive_index, zip_level=args.zip_level)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+# run.py package --archive-index で作ったインデックス付きの tar.gz から、
+# 必要なファイルを含む gzip メンバーだけを読み込んで展開する。
+#
+#   python3 extract_package.py webrtc.android.tar.gz --list
+#   python3 extract_package.py webrtc.android.tar.gz 'webrtc/include/' 'webrtc/lib/arm64-v8a/' -o out
+
+import argparse
+import fnmatch
+import json
+import os
+import sys
+import zlib
+
+
+def load_index(archive, index_file=None):
+    if index_file is None:
+        index_file = f'{archive}.index.json'
+    with open(index_file) as f:
+        index = json.load(f)
+    if index.get('version') != 1:
+        raise Exception(f'Unsupported index version: {index.get("version")}')
+    return index
+
+
+# パターンが / で終わっていればそのディレクトリ以下の全てのファイル、それ以外は fnmatch でマッチさせる
+def match(name, patterns):
+    if len(patterns) == 0:
+        return True
+    for pattern in patterns:
+        if pattern.endswith('/'):
+            if name.startswith(pattern):
+                return True
+        elif fnmatch.fnmatchcase(name, pattern):
+            return True
+    return False
+
+
+# gzip メンバーを先頭から必要なところまで展開して、[start, end) の範囲を返す
+def read_member_range(f, member, start, end):
+    f.seek(member['offset'])
+    remaining = member['length']
+    z = zlib.decompressobj(31)
+    data = bytearray()
+    while remaining > 0 and len(data) < end:
+        chunk = f.read(min(remaining, 1024 * 1024))
+        if len(chunk) == 0:
+            raise Exception('Unexpected end of archive')
+        remaining -= len(chunk)
+        data += z.decompress(chunk)
+    if len(data) < end:
+        raise Exception('Index does not match the archive')
+    return bytes(data[start:end])
+
+
+def is_within(path, dir):
+    return os.path.commonpath([path, dir]) == dir
+
+
+# tarfile の filter='data' と同様に、展開先の外を指すファイルやシンボリックリンクを拒否する
+def get_safe_path(output_dir, entry):
+    name = entry['name']
+    if name.startswith('/') or os.path.isabs(name) or '..' in name.split('/'):
+        raise Exception(f'Refusing to extract {name}: path is outside the output directory')
+    root = os.path.realpath(output_dir)
+    path = os.path.join(root, *name.split('/'))
+    # 途中のディレクトリがシンボリックリンクで外を指している場合も拒否する
+    if not is_within(os.path.realpath(os.path.dirname(path)), root):
+        raise Exception(f'Refusing to extract {name}: path is outside the output directory')
+    if 'linkname' in entry:
+        linkname = entry['linkname']
+        if os.path.isabs(linkname) or \
+                not is_within(os.path.realpath(os.path.join(os.path.dirname(path), linkname)), root):
+            raise Exception(f'Refusing to extract {name}: link target {linkname} is outside the output directory')
+    return path
+
+
+def extract(archive, index, patterns, output_dir):
+    entries = [e for e in index['files'] if match(e['name'], patterns)]
+    # 同じメンバーに含まれるファイルはまとめて 1 回で展開する
+    by_member = {}
+    for entry in entries:
+        by_member.setdefault(entry['member'], []).append(entry)
+
+    with open(archive, 'rb') as f:
+        for member_index, member_entries in sorted(by_member.items()):
+            member = index['members'][member_index]
+            start = min(e['offset'] for e in member_entries)
+            end = max(e['offset'] + e['size'] for e in member_entries)
+            data = read_member_range(f, member, start, end)
+            for entry in member_entries:
+                path = get_safe_path(output_dir, entry)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                if 'linkname' in entry:
+                    if os.path.lexists(path):
+                        os.remove(path)
+                    os.symlink(entry['linkname'], path)
+                    continue
+                with open(path, 'wb') as out:
+                    out.write(data[entry['offset'] - start:entry['offset'] - start + entry['size']])
+                # setuid などの特殊なビットは落とす
+                os.chmod(path, entry['mode'] & 0o777)
+                os.utime(path, (entry['mtime'], entry['mtime']))
+                print(entry['name'])
+    return len(entries)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('archive')
+    parser.add_argument('patterns', nargs='*')
+    parser.add_argument('--index')
+    parser.add_argument('--list', action='store_true')
+    parser.add_argument('-o', '--output-dir', default='.')
+    args = parser.parse_intermixed_args()
+
+    index = load_index(args.archive, args.index)
+    if args.list:
+        for entry in index['files']:
+            if match(entry['name'], args.patterns):
+                print(f"{entry['size']:>12} {entry['name']}")
+        return
+
+    if extract(args.archive, index, args.patterns, args.output_dir) == 0:
+        print('No files matched', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,18 @@
 #!/usr/bin/env python3
 
 import argparse
+import ctypes
+import filecmp
+import hashlib
+import select
 import shutil
+import struct
 import subprocess
 import sys
 import os
 import json
+import platform
+import time
 
 # トップレベルのパス
 top_dir = os.path.normpath(os.path.join(os.path.abspath(os.path.dirname(__file__)), '..'))
@@ -17,12 +24,15 @@ def init_project_with_cur_dir():
 
 
 def init_project(name):
-    global project_dir, project_src_dir, project_build_dir, project_build_patches_dir, config_file
+    global project_dir, project_src_dir, project_build_dir, project_build_patches_dir, config_file, diff_cache_file
+    global jni_cache_file
     project_dir = os.path.join(patchdev_dir, name)
     project_src_dir = os.path.join(project_dir, 'src')
     project_build_dir = os.path.join(project_dir, '_build')
     project_build_patches_dir = os.path.join(project_build_dir, 'patches')
     config_file = os.path.join(project_dir, "config.json")
+    diff_cache_file = os.path.join(project_build_dir, "diff_cache.json")
+    jni_cache_file = os.path.join(project_build_dir, "jni_cache.json")
 
 
 def rtc_src_dir(platform):
@@ -38,6 +48,11 @@ def load_config():
         return Config(json.load(f))
 
 
+# jni_classpaths に加えて、javac が型を解決するために使う Java のソースコードのディレクトリ (libwebrtc のソースコードからの相対パス)。
+# @CalledByNative などのアノテーションや、org.webrtc.Logging などが含まれている
+JNI_DEFAULT_SOURCEPATHS = ['sdk/android/src/java', 'rtc_base/java/src']
+
+
 class Config:
     def __init__(self, json):
         self.output = json["output"]
@@ -46,6 +61,10 @@ class Config:
         self.sources = [os.path.normpath(path) for path in json["sources"]]
         self.jni_classpaths = [os.path.normpath(path) for path in json["jni_classpaths"]]
         self.jni_classes = {class_name: os.path.normpath(output) for class_name, output in json["jni_classes"].items()}
+        # 省略した場合は、libwebrtc の Java のソースコードと androidx のアノテーションを使う
+        self.jni_sourcepaths = [os.path.normpath(path)
+                                for path in json.get("jni_sourcepaths", JNI_DEFAULT_SOURCEPATHS)]
+        self.jni_jars = [os.path.normpath(path) for path in json["jni_jars"]] if "jni_jars" in json else None
 
 
 def init(args):
@@ -60,7 +79,7 @@ PYTHON = python3
 TOP_DIR = ../../
 PATCHDEV = scripts/patchdev.py
 
-.PHONY: sync build build-skip-patch jni diff patch clean check
+.PHONY: sync build build-skip-patch watch jni diff patch clean check
 
 sync:
 \t@$(PYTHON) $(TOP_DIR)$(PATCHDEV) sync
@@ -68,6 +87,9 @@ sync:
 build:
 \t@$(PYTHON) $(TOP_DIR)$(PATCHDEV) build
 
+watch:
+\t@$(PYTHON) $(TOP_DIR)$(PATCHDEV) watch
+
 build-skip-patch:
 \t@$(PYTHON) $(TOP_DIR)$(PATCHDEV) build --skip-patch
 
@@ -133,27 +155,287 @@ def build(args):
     os.chdir(orig_dir)
 
 
+# inotify による監視 (Linux のみ)
+class Inotify:
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(0)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = {}
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, path.encode('utf-8'), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f'inotify_add_watch failed: {path}')
+        self.watches[wd] = path
+
+    def watched_paths(self):
+        return set(self.watches.values())
+
+    # イベントが発生したファイルのパスを返す。timeout 秒以内にイベントが無ければ空のリストを返す
+    def read(self, timeout=None):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        paths = []
+        offset = 0
+        while offset < len(data):
+            wd, _, _, length = struct.unpack_from('iIII', data, offset)
+            offset += struct.calcsize('iIII')
+            name = data[offset:offset + length].rstrip(b'\0').decode('utf-8')
+            offset += length
+            if wd in self.watches and name:
+                paths.append(os.path.join(self.watches[wd], name))
+        return paths
+
+
+def is_inotify_available():
+    return platform.system() == 'Linux'
+
+
+INOTIFY_MASK = Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO | Inotify.IN_CREATE
+
+
+# ソースコードのディレクトリを監視する。まだ存在しないディレクトリは、存在する一番近い親ディレクトリを監視しておき、
+# 作られた時に監視を追加する。新しく監視を追加したディレクトリを返す
+def watch_source_dirs(inotify, sources):
+    watched = inotify.watched_paths()
+    added = []
+    for d in sorted(set(os.path.dirname(os.path.join(project_src_dir, s)) for s in sources)):
+        while not os.path.isdir(d) and d != project_src_dir:
+            d = os.path.dirname(d)
+        if d in watched or not os.path.isdir(d):
+            continue
+        inotify.add_watch(d, INOTIFY_MASK)
+        watched.add(d)
+        added.append(d)
+    return added
+
+
+# 変更されたソースコードの一覧を返す。inotify が使えない環境では更新日時をポーリングする
+def wait_for_changes(sources, inotify, mtimes):
+    if inotify is not None:
+        paths = inotify.read()
+        # エディタの保存は複数のイベントになるので、少し待ってまとめて処理する
+        while True:
+            more = inotify.read(0.2)
+            if not more:
+                break
+            paths += more
+        changed = set()
+        for path in paths:
+            source = os.path.relpath(path, project_src_dir)
+            if source in sources:
+                changed.add(source)
+        # 新しく作られたディレクトリを監視する。監視を始める前に作られたファイルも変更として扱う
+        added = watch_source_dirs(inotify, sources)
+        for source in sources:
+            file_path = os.path.join(project_src_dir, source)
+            if os.path.dirname(file_path) in added and os.path.isfile(file_path):
+                changed.add(source)
+        return sorted(changed)
+
+    while True:
+        changed = []
+        for source in sources:
+            try:
+                mtime = os.path.getmtime(os.path.join(project_src_dir, source))
+            except OSError:
+                continue
+            if mtimes.get(source) != mtime:
+                mtimes[source] = mtime
+                changed.append(source)
+        if changed:
+            return changed
+        time.sleep(1)
+
+
+# ビルド設定に対応する、ninja ファイルが生成済みのビルドディレクトリを列挙する
+def ninja_build_dirs(config):
+    configuration = 'debug' if '--debug' in config.build_flags.split() else 'release'
+    root = os.path.join(top_dir, '_build', config.platform, configuration, 'webrtc')
+    dirs = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        if 'build.ninja' in filenames:
+            dirs.append(dirpath)
+            dirnames[:] = []
+        else:
+            dirnames.sort()
+    return dirs
+
+
+# ninja -t query で、ソースファイルを直接入力にしているビルド対象を返す
+def ninja_query_outputs(build_dir, node):
+    cmd = ['ninja', '-C', build_dir, '-t', 'query', node]
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='utf-8')
+    if result.returncode != 0:
+        return []
+    outputs = []
+    in_outputs = False
+    for line in result.stdout.splitlines():
+        if line.strip() == 'outputs:':
+            in_outputs = True
+        elif line.startswith('    ') and in_outputs:
+            outputs.append(line.strip())
+        elif not line.startswith('    '):
+            in_outputs = False
+    return outputs
+
+
+# ninja -t deps から、ヘッダーファイル → それをインクルードしているオブジェクトファイルの対応表を作る
+def ninja_header_rdeps(build_dir):
+    cmd = ['ninja', '-C', build_dir, '-t', 'deps']
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='utf-8')
+    rdeps = {}
+    output = None
+    for line in result.stdout.splitlines():
+        if len(line) == 0:
+            output = None
+        elif not line.startswith(' '):
+            output = line.split(':', 1)[0]
+        elif output is not None:
+            rdeps.setdefault(line.strip(), []).append(output)
+    return rdeps
+
+
+# 変更されたファイルに依存するビルド対象だけを ninja で直接ビルドする。
+# コンパイルが通ったら、run.py と同じターゲットをビルドしてリンクし直し、libwebrtc.a も作り直す。
+# オブジェクトファイルは最新なので、これはリンクとアーカイブだけになる。
+def rebuild_targets(config, build_dirs, changed, rdeps_cache):
+    ok = True
+    for build_dir in build_dirs:
+        targets = set()
+        full_build = False
+        for source in changed:
+            node = os.path.relpath(rtc_src_file(config.platform, source), build_dir).replace(os.sep, '/')
+            outputs = ninja_query_outputs(build_dir, node)
+            if not outputs:
+                if build_dir not in rdeps_cache:
+                    rdeps_cache[build_dir] = ninja_header_rdeps(build_dir)
+                outputs = rdeps_cache[build_dir].get(node, [])
+            if not outputs:
+                # BUILD.gn や Java のように、オブジェクトファイルに直接対応しないファイルは run.py と同じターゲットをビルドする
+                full_build = True
+            targets.update(outputs)
+        if not targets and not full_build:
+            continue
+        # インクルード関係が変わっている可能性があるので、次回は読み直す
+        rdeps_cache.pop(build_dir, None)
+        if targets:
+            cmd = ['ninja', '-C', build_dir, *sorted(targets)]
+            print(f"exec: ninja -C {build_dir} ({len(targets)} targets)")
+            if subprocess.call(cmd) != 0:
+                ok = False
+                continue
+        cmd = ['ninja', '-C', build_dir, *default_build_targets(config.platform)]
+        print(f"exec: {' '.join(cmd)}")
+        if subprocess.call(cmd) != 0:
+            ok = False
+            continue
+        archive_library(config, build_dir)
+    return ok
+
+
+def default_build_targets(platform):
+    sys.path.insert(0, top_dir)
+    from run import get_build_targets
+    return get_build_targets(platform)
+
+
+# run.py のビルドで libwebrtc.a を作っているビルドディレクトリなら、run.py と同じ方法で作り直す
+def archive_library(config, build_dir):
+    output = os.path.join(build_dir, 'libwebrtc.a')
+    if not os.path.isfile(output):
+        return
+    if config.platform in ('ios', 'macos_arm64'):
+        ar = '/usr/bin/ar'
+    else:
+        ar = os.path.join(rtc_src_dir(config.platform), 'third_party/llvm-build/Release+Asserts/bin/llvm-ar')
+    sys.path.insert(0, top_dir)
+    from run import archive_objects
+    print(f"Archiving: {output}")
+    archive_objects(ar, os.path.join(build_dir, 'obj'), output, default_build_targets(config.platform))
+
+
+def copy_changed_sources(config, changed):
+    copied = []
+    for source in changed:
+        file_path = os.path.join(project_src_dir, source)
+        if not os.path.isfile(file_path):
+            continue
+        if not check_newline_at_eof(file_path):
+            print(f"Error: The file {file_path} does not end with a newline.")
+            continue
+        target = rtc_src_file(config.platform, source)
+        if os.path.isfile(target) and filecmp.cmp(file_path, target, shallow=False):
+            continue
+        shutil.copy2(file_path, target)
+        print(f"Copied: {source}")
+        copied.append(source)
+    return copied
+
+
+def watch(args):
+    config = load_config()
+
+    build_dirs = ninja_build_dirs(config)
+    if not build_dirs:
+        print("Error: No build directory found. Run `make build` first.")
+        sys.exit(1)
+
+    inotify = None
+    mtimes = {}
+    if is_inotify_available():
+        inotify = Inotify()
+        watch_source_dirs(inotify, config.sources)
+    else:
+        for source in config.sources:
+            file_path = os.path.join(project_src_dir, source)
+            if os.path.isfile(file_path):
+                mtimes[source] = os.path.getmtime(file_path)
+
+    rdeps_cache = {}
+
+    # 監視開始前の差分を反映しておく
+    copied = copy_changed_sources(config, config.sources)
+    if copied and not rebuild_targets(config, build_dirs, copied, rdeps_cache):
+        print("Build failed")
+
+    print(f"Watching {len(config.sources)} files. Press Ctrl+C to stop.")
+    try:
+        while True:
+            changed = wait_for_changes(config.sources, inotify, mtimes)
+            copied = copy_changed_sources(config, changed)
+            if copied:
+                started = time.time()
+                if rebuild_targets(config, build_dirs, copied, rdeps_cache):
+                    print(f"Done in {time.time() - started:.1f}s")
+                else:
+                    print(f"Build failed in {time.time() - started:.1f}s")
+    except KeyboardInterrupt:
+        pass
+
+
 def generate(args):
     config = load_config()
     check_all_files(config.sources)
 
+    diffs = diff_sources(config)
+
     # パッチファイルのリスト
     patch_files = []
 
-    # 各ソースファイルに対して操作を実行
     for source in config.sources:
-        target = rtc_src_file(config.platform, source)
-        shutil.copy2(os.path.join(project_src_dir, source), target)
-        os.chdir(os.path.dirname(target))
-        cmd = ['git', 'add', '-N', os.path.basename(target)]
-        subprocess.check_output(cmd)
-        cmd = ['git', 'diff', os.path.basename(target)]
-        diff = subprocess.check_output(cmd).decode('utf-8')
-        os.chdir(project_dir)
         patch_file = os.path.join(project_build_patches_dir, f'{source}.patch')
         os.makedirs(os.path.dirname(patch_file), exist_ok=True)
         with open(patch_file, 'w') as f:
-            f.write(diff)
+            f.write(diffs[source])
         patch_files.append(patch_file)
 
     # パッチファイルを結合
@@ -163,6 +445,105 @@ def generate(args):
                 outfile.write(infile.read())
 
 
+# ファイルが属する git リポジトリのトップレベルのディレクトリを返す
+def find_git_root(path):
+    dir = os.path.dirname(path)
+    while True:
+        if os.path.exists(os.path.join(dir, '.git')):
+            return dir
+        parent = os.path.dirname(dir)
+        if parent == dir:
+            return None
+        dir = parent
+
+
+def file_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def load_diff_cache():
+    if not os.path.isfile(diff_cache_file):
+        return {}
+    with open(diff_cache_file) as f:
+        return json.load(f)
+
+
+def save_diff_cache(cache):
+    os.makedirs(os.path.dirname(diff_cache_file), exist_ok=True)
+    with open(diff_cache_file, 'w') as f:
+        json.dump(cache, f, indent=4)
+
+
+# git diff の出力をファイルごとに分割する。キーはリポジトリのトップレベルからの相対パス
+def split_git_diff(diff):
+    diffs = {}
+    path = None
+    for line in diff.splitlines(keepends=True):
+        if line.startswith('diff --git '):
+            path = line.rstrip('\n').split(' b/', 1)[1]
+            diffs[path] = ''
+        if path is not None:
+            diffs[path] += line
+    return diffs
+
+
+# インデックスに登録されているファイルの blob の ID を返す
+def get_index_blobs(repo, paths):
+    output = subprocess.check_output(['git', '-C', repo, 'ls-files', '-s', '-z', '--', *paths]).decode('utf-8')
+    blobs = {}
+    for entry in output.split('\0'):
+        if entry:
+            info, path = entry.split('\t', 1)
+            blobs[path] = info.split(' ')[1]
+    return blobs
+
+
+# src のソースコードをオリジナルにコピーし、ソースコードごとの差分を返す。
+# git の実行はリポジトリごとに git add -N と git diff の 1 回ずつにまとめる。
+# git diff はインデックスとの差分なので、ソースコードの内容とリポジトリの HEAD、インデックスの blob が前回と同じなら、
+# キャッシュした差分を使う。
+def diff_sources(config):
+    cache = load_diff_cache()
+    diffs = {}
+    repos = {}
+    for source in config.sources:
+        src_path = os.path.join(project_src_dir, source)
+        target = rtc_src_file(config.platform, source)
+        if not os.path.isfile(target) or not filecmp.cmp(src_path, target, shallow=False):
+            shutil.copy2(src_path, target)
+        repo = find_git_root(target)
+        repos.setdefault(repo, []).append((source, os.path.relpath(target, repo).replace(os.sep, '/')))
+
+    pending = {}
+    for repo, entries in repos.items():
+        head = subprocess.check_output(['git', '-C', repo, 'rev-parse', 'HEAD']).decode('utf-8').strip()
+        blobs = get_index_blobs(repo, [path for _, path in entries])
+        for source, path in entries:
+            key = f'{head}:{blobs.get(path, "")}:{file_hash(os.path.join(project_src_dir, source))}'
+            entry = cache.get(source)
+            if entry is not None and entry['key'] == key:
+                diffs[source] = entry['diff']
+                continue
+            pending.setdefault(repo, []).append((source, path, key))
+
+    for repo, entries in pending.items():
+        paths = [path for _, path, _ in entries]
+        cmd = ['git', '-C', repo, 'add', '-N', '--', *paths]
+        subprocess.check_output(cmd)
+        # diff.noprefix や color.diff などのユーザーの設定に左右されないように出力の形式を固定する
+        cmd = ['git', '-C', repo, 'diff', '--no-color', '--no-ext-diff', '--no-renames',
+               '--src-prefix=a/', '--dst-prefix=b/', '--', *paths]
+        repo_diffs = split_git_diff(subprocess.check_output(cmd).decode('utf-8'))
+        for source, path, key in entries:
+            diffs[source] = repo_diffs.get(path, '')
+            cache[source] = {'key': key, 'diff': diffs[source]}
+
+    if pending:
+        save_diff_cache(cache)
+    return diffs
+
+
 def clean(args):
     config = load_config()
 
@@ -179,16 +560,9 @@ def diff(args):
 
     check_all_files(config.sources)
 
+    diffs = diff_sources(config)
     for source in config.sources:
-        target = rtc_src_file(config.platform, source)
-        shutil.copy2(os.path.join(project_src_dir, source), target)
-        os.chdir(os.path.dirname(target))
-        cmd = ['git', 'add', '-N', os.path.basename(target)]
-        subprocess.check_output(cmd)
-        cmd = ['git', 'diff', os.path.basename(target)]
-        diff = subprocess.check_output(cmd).decode('utf-8')
-        os.chdir(project_dir)
-        print(diff)
+        print(diffs[source])
 
 
 def sync(args):
@@ -238,6 +612,107 @@ def check_newline_at_eof(file_path):
     return last == b'\n'
 
 
+# クラス名に対応する Java のソースコードを探す。ネストしたクラスの場合は外側のクラスのファイルを返す
+def find_java_source(config, class_name):
+    parts = class_name.replace('$', '.').split('.')
+    for n in range(len(parts), 0, -1):
+        for classpath in config.jni_classpaths:
+            path = os.path.join(rtc_src_dir(config.platform), classpath, *parts[:n - 1], parts[n - 1] + '.java')
+            if os.path.isfile(path):
+                return path
+    return None
+
+
+# javac が生成するヘッダーファイルの名前の候補。JDK のバージョンによってネストしたクラスの扱いが異なる
+def jni_header_names(class_name):
+    flat = class_name.replace('.', '_')
+    return [flat.replace('$', '_') + '.h', flat.replace('$', '__') + '.h']
+
+
+# libwebrtc のソースコードに含まれる JDK があればそれを使う
+def find_javac(config):
+    javac = os.path.join(rtc_src_dir(config.platform), 'third_party', 'jdk', 'current', 'bin', 'javac')
+    if os.path.isfile(javac):
+        return javac
+    return shutil.which('javac')
+
+
+# android.* のクラスを解決するために、libwebrtc のソースコードに含まれる Android SDK の android.jar を使う
+def find_android_jar(config):
+    platforms_dir = os.path.join(rtc_src_dir(config.platform), 'third_party', 'android_sdk', 'public', 'platforms')
+    if not os.path.isdir(platforms_dir):
+        return None
+    jars = [os.path.join(platforms_dir, d, 'android.jar') for d in os.listdir(platforms_dir)]
+    jars = [jar for jar in jars if os.path.isfile(jar)]
+    if not jars:
+        return None
+
+    def api_level(jar):
+        name = os.path.basename(os.path.dirname(jar))
+        return int(name.split('-')[-1]) if name.split('-')[-1].isdigit() else 0
+    return max(jars, key=api_level)
+
+
+# androidx.annotation.Nullable などを解決するための、libwebrtc のソースコードに含まれる androidx のアノテーションの jar
+def find_androidx_annotation_jars(config):
+    libs_dir = os.path.join(rtc_src_dir(config.platform), 'third_party', 'androidx', 'libs')
+    if not os.path.isdir(libs_dir):
+        return []
+    jars = []
+    for name in sorted(os.listdir(libs_dir)):
+        if not name.startswith('androidx_annotation_annotation'):
+            continue
+        for root, dirs, files in os.walk(os.path.join(libs_dir, name)):
+            dirs.sort()
+            jars += [os.path.join(root, file) for file in sorted(files) if file.endswith('.jar')]
+    return jars
+
+
+def get_jni_jars(config):
+    if config.jni_jars is not None:
+        return [os.path.join(rtc_src_dir(config.platform), jar) for jar in config.jni_jars]
+    jars = find_androidx_annotation_jars(config)
+    android_jar = find_android_jar(config)
+    if android_jar is not None:
+        jars.append(android_jar)
+    return jars
+
+
+# JDK を識別する値。javac -version は JVM の起動に時間がかかるので、
+# javac の実体のパスと更新日時、JDK の release ファイル (JAVA_VERSION などが書かれている) の内容を使う
+def get_javac_id(javac):
+    path = os.path.realpath(javac)
+    release = os.path.join(os.path.dirname(os.path.dirname(path)), 'release')
+    return [path, os.stat(path).st_mtime_ns, file_hash(release) if os.path.isfile(release) else None]
+
+
+def load_jni_cache():
+    if not os.path.isfile(jni_cache_file):
+        return {}
+    with open(jni_cache_file) as f:
+        return json.load(f)
+
+
+def save_jni_cache(cache):
+    os.makedirs(os.path.dirname(jni_cache_file), exist_ok=True)
+    with open(jni_cache_file, 'w') as f:
+        json.dump(cache, f, indent=4)
+
+
+# 内容が変わっている場合だけ書き込む。変わっていなければ更新日時も変わらないので、ninja の再ビルドも起きない
+def write_if_changed(path, data):
+    if os.path.isfile(path):
+        with open(path, 'rb') as f:
+            if f.read() == data:
+                return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return True
+
+
+# JNI のヘッダーファイルを生成する。
+# 全てのクラスを 1 回の javac -h でまとめて処理し、Java のソースコードと設定が前回と同じなら何もしない。
 def jni(args):
     config = load_config()
 
@@ -245,21 +720,73 @@ def jni(args):
     check_all_files(config.sources)
     for source in config.sources:
         if source.endswith('.java'):
-            shutil.copy2(os.path.join(project_src_dir, source), rtc_src_file(config.platform, source))
+            src_path = os.path.join(project_src_dir, source)
+            target = rtc_src_file(config.platform, source)
+            if not os.path.isfile(target) or not filecmp.cmp(src_path, target, shallow=False):
+                shutil.copy2(src_path, target)
+
+    java_sources = {}
+    for class_name in config.jni_classes:
+        path = find_java_source(config, class_name)
+        if path is None:
+            print(f"Error: The source of {class_name} is not found in {config.jni_classpaths}")
+            sys.exit(1)
+        java_sources[class_name] = path
+
+    javac = find_javac(config)
+    if javac is None:
+        print("Error: javac is not found.")
+        sys.exit(1)
+    jars = get_jni_jars(config)
+
+    # JDK を切り替えた場合も生成し直す
+    h = hashlib.sha256()
+    h.update(json.dumps([config.jni_classpaths, config.jni_sourcepaths, config.jni_classes,
+                         get_javac_id(javac), jars], sort_keys=True).encode('utf-8'))
+    for path in sorted(set(java_sources.values())):
+        h.update(f'{os.path.relpath(path, rtc_src_dir(config.platform))}:{file_hash(path)}\n'.encode('utf-8'))
+    key = h.hexdigest()
+
+    outputs = [os.path.join(project_src_dir, output) for output in config.jni_classes.values()]
+    cache = load_jni_cache()
+    if not args.force and cache.get('key') == key and all(os.path.isfile(output) for output in outputs):
+        print("JNI headers are up to date.")
+        return
+
+    work_dir = os.path.join(project_build_dir, 'jni')
+    shutil.rmtree(work_dir, ignore_errors=True)
+    header_dir = os.path.join(work_dir, 'headers')
+    classes_dir = os.path.join(work_dir, 'classes')
+    os.makedirs(header_dir)
+    os.makedirs(classes_dir)
+
+    sourcepaths = []
+    for path in [*config.jni_classpaths, *config.jni_sourcepaths]:
+        if path not in sourcepaths:
+            sourcepaths.append(path)
+    sourcepath = os.pathsep.join(os.path.join(rtc_src_dir(config.platform), path) for path in sourcepaths)
+    cmd = [javac, '-h', header_dir, '-d', classes_dir, '-sourcepath', sourcepath,
+           '-implicit:none', '-proc:none', '-nowarn']
+    if jars:
+        cmd += ['-classpath', os.pathsep.join(jars)]
+    cmd += sorted(set(java_sources.values()))
+    print(f"exec: {' '.join(cmd)}")
+    subprocess.check_call(cmd)
 
     for class_name, output in config.jni_classes.items():
-        cmd = ['javah']
-        for classpath in config.jni_classpaths:
-            cmd.append('-classpath')
-            cmd.append(os.path.join(rtc_src_dir(config.platform), classpath))
-
-        src_output = os.path.join(project_src_dir, output)
-        cmd.append('-o')
-        cmd.append(src_output)
+        headers = [os.path.join(header_dir, name) for name in jni_header_names(class_name)]
+        header = next((header for header in headers if os.path.isfile(header)), None)
+        if header is None:
+            print(f"Error: {class_name} has no native methods.")
+            sys.exit(1)
+        with open(header, 'rb') as f:
+            if write_if_changed(os.path.join(project_src_dir, output), f.read()):
+                print(f"Generated: {output}")
+            else:
+                print(f"Unchanged: {output}")
 
-        cmd.append(class_name)
-        print(f"exec: {' '.join(cmd)}")
-        subprocess.check_output(cmd)
+    cache['key'] = key
+    save_jni_cache(cache)
 
 
 def check_all_files(sources):
@@ -304,6 +831,10 @@ def main():
                               help="パッチの適用をスキップします。")
     parser_build.set_defaults(func=build)
 
+    # watch サブコマンド
+    parser_watch = subparsers.add_parser("watch", help="ソースコードの変更を監視して、変更されたファイルに依存するターゲットだけをビルドします。")
+    parser_watch.set_defaults(func=watch)
+
     # patch サブコマンド
     parser_patch = subparsers.add_parser("patch", help="パッチを生成します。")
     parser_patch.set_defaults(func=generate)
@@ -328,6 +859,8 @@ def main():
     # JNI
     parser_jni = subparsers.add_parser(
         'jni', help='JNI のヘッダーファイルを生成します。')
+    parser_jni.add_argument("--force", action="store_true",
+                            help="Java のソースコードが変わっていなくてもヘッダーファイルを生成し直します。")
     parser_jni.set_defaults(func=jni)
 
     args = parser.parse_args()